@@ -42,5 +42,6 @@ setup(
         "weasyprint>=44",
         "simpleeval>=0.9",
         "docxtpl>=0.5",
+        "mercantile>=1.0",
     ]
 )
@@ -0,0 +1,101 @@
+import codecs
+import csv
+import io
+from datetime import date, datetime, time
+
+from django.contrib.gis.gdal import DataSource, GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Point
+from geostore.models import Feature
+
+# Encoding of sources which are not valid UTF-8
+FALLBACK_ENCODING = 'iso-8859-15'
+
+
+def detect_encoding(source, fallback=FALLBACK_ENCODING):
+    """ Return utf-8-sig if the whole seekable binary source decodes as
+        UTF-8, else the fallback encoding. The source is read by chunks, and
+        rewound. """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = fallback
+
+    source.seek(0)
+    return encoding
+
+
+def csv_records(source, geometry_fields, encoding=None, **reader_kwargs):
+    """ Yield (properties, geometry) of each row of a binary CSV source.
+
+    geometry_fields is either the name of a WKT column, or the names of the
+    latitude and longitude columns. Geometries are yielded as WKT strings or
+    (latitude, longitude) pairs, to be parsed by parse_geometry. """
+    if encoding is None:
+        encoding = (detect_encoding(source) if source.seekable()
+                    else FALLBACK_ENCODING)
+
+    reader = csv.DictReader(io.TextIOWrapper(source, encoding=encoding,
+                                             newline=''),
+                            **reader_kwargs)
+    columns = ([geometry_fields] if isinstance(geometry_fields, str)
+               else geometry_fields)
+    missing = set(columns) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f'Missing geometry columns {", ".join(missing)}')
+
+    for row in reader:
+        if isinstance(geometry_fields, str):
+            geometry = row.pop(geometry_fields)
+        else:
+            geometry = tuple(row.pop(field) for field in geometry_fields)
+        yield row, geometry
+
+
+def ogr_records(path, layer=0):
+    """ Yield (properties, geometry) of each feature of a layer readable by
+        GDAL, like GeoJSON or GeoPackage. Geometries are yielded as
+        (WKB, SRID) pairs, to be parsed by parse_geometry. """
+    source_layer = DataSource(path)[layer]
+    srid = source_layer.srs.srid if source_layer.srs else 4326
+
+    # Features are read one at a time by GDAL
+    for feature in source_layer:
+        properties = {field: json_value(feature.get(field))
+                      for field in feature.fields}
+        geometry = feature.geom
+        yield properties, (bytes(geometry.wkb), srid)
+
+
+def json_value(value):
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    return value
+
+
+def parse_geometry(geometry, srid=4326):
+    """ Return the (WKB, SRID), in the SRID of stored features, of a WKT
+        string, a (latitude, longitude) pair, or a (WKB, SRID) pair.
+
+    It runs in worker processes, so it only returns builtin types: the
+    geometry, and the error which prevented parsing it, if any. """
+    try:
+        if isinstance(geometry, str):
+            geometry = GEOSGeometry(geometry, srid=srid)
+        elif isinstance(geometry[0], bytes):
+            geometry = GEOSGeometry(memoryview(geometry[0]), srid=geometry[1])
+        else:
+            latitude, longitude = geometry
+            geometry = Point(float(longitude), float(latitude), srid=srid)
+
+        if not geometry.valid:
+            return None, geometry.valid_reason
+        storage_srid = Feature._meta.get_field('geom').srid
+        if geometry.srid != storage_srid:
+            geometry.transform(storage_srid)
+        return (bytes(geometry.wkb), geometry.srid), None
+    except (GDALException, GEOSException, TypeError, ValueError) as exc:
+        return None, str(exc) or exc.__class__.__name__
@@ -1,13 +1,24 @@
 import argparse
 import csv
+import io
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import Group
-from django.core.management import BaseCommand
+from django.core.exceptions import ValidationError
+from django.core.management import BaseCommand, CommandError
 from django.db import transaction
 from django.utils.translation import ugettext as _
 
+from terracommon.data_importers.helpers import (FALLBACK_ENCODING,
+                                                detect_encoding)
+
 UserModel = get_user_model()
 
 
@@ -31,12 +42,19 @@ class Command(BaseCommand):
                             )
         parser.add_argument('-cs', '--source',
                             dest='source',
-                            type=argparse.FileType('r',
-                                                   encoding='iso-8859-15'),
-                            default=sys.stdin,
+                            type=argparse.FileType('rb'),
+                            default=sys.stdin.buffer,
                             required=True,
                             help=_('Specify CSV path'),
                             )
+        parser.add_argument('-ce', '--encoding',
+                            action='store',
+                            dest='encoding',
+                            required=False,
+                            help=_('Specify CSV encoding. By default, it is '
+                                   'UTF-8 if the file is valid UTF-8, else '
+                                   f'{FALLBACK_ENCODING}')
+                            )
         parser.add_argument('-u', '--username-field',
                             required=True,
                             action='store',
@@ -57,32 +75,253 @@ class Command(BaseCommand):
                             dest='group',
                             help=_("Default group of newly created users")
                             )
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=1000,
+                            dest='chunk_size',
+                            help=_("Number of users saved in each "
+                                   "transaction")
+                            )
+        parser.add_argument('--workers',
+                            type=int,
+                            default=os.cpu_count(),
+                            dest='workers',
+                            help=_("Number of processes hashing passwords")
+                            )
+        parser.add_argument('--upsert',
+                            action='store_true',
+                            dest='upsert',
+                            help=_("Update users whose username already "
+                                   "exists, instead of skipping them")
+                            )
+        parser.add_argument('--rejected',
+                            dest='rejected',
+                            required=False,
+                            help=_("CSV file where invalid rows are written, "
+                                   "with an error column")
+                            )
+        parser.add_argument('--checkpoint',
+                            dest='checkpoint',
+                            required=False,
+                            help=_("File keeping the number of rows already "
+                                   "imported. If it exists, the import "
+                                   "resumes after these rows.")
+                            )
 
-    @transaction.atomic
     def handle(self, *args, **options):
         username, password = (options.get('user_field'),
                               options.get('password_field'))
 
-        reader = csv.DictReader(options.get('source'),
-                                delimiter=options.get('delimiter'),
-                                quotechar=options.get('quotechar'))
+        reader, encoding = self._get_reader(options)
+        if reader.fieldnames is None or username not in reader.fieldnames:
+            raise CommandError(f'No {username} column in the source')
 
         fields = [fieldname
                   for fieldname in reader.fieldnames
                   if fieldname not in ['', username, password]]
 
-        groups = Group.objects.filter(name__in=options.get('group'))
-
-        for row in reader:
-            user = UserModel.objects.create(
-                **{
-                    UserModel.USERNAME_FIELD: row[username],
-                    'properties': {field: row.get(field) for field in fields},
-                }
-            )
-            if password:
-                user.set_password(row[password])
+        groups = list(
+            Group.objects.filter(name__in=options.get('group') or []))
+
+        checkpoint = options.get('checkpoint')
+        done = self._load_checkpoint(checkpoint)
+        rows = islice(reader, done, None)
+
+        imported, rejected_count = 0, 0
+        with self._get_rejected_writer(options, reader.fieldnames, encoding,
+                                       append=bool(done)) as reject, \
+                self._get_hasher(password, options['workers']) as hasher:
+            for chunk in self._chunks(rows, options['chunk_size']):
+                valid, invalid = self._parse_rows(chunk, done, username)
+                users = self._get_users(valid, username, password, fields,
+                                        hasher)
+
+                imported += self._save_users(
+                    users, groups, options['upsert'],
+                    ['properties', 'password'] if password else
+                    ['properties'])
+
+                # Written once the chunk is committed, so resuming does not
+                # report them twice
+                done += len(chunk)
+                rejected_count += len(invalid)
+                reject(invalid)
+                self._save_checkpoint(checkpoint, done)
+                if options['verbosity'] > 0:
+                    self.stdout.write(f'{imported} users imported, '
+                                      f'{rejected_count} rows rejected')
+
+        # The import is complete, a new one starts over
+        self._clear_checkpoint(checkpoint)
+
+    def _get_reader(self, options):
+        """ Return a reader of the source rows, read as they are imported,
+            and the encoding of the source """
+        source = options.get('source')
+        encoding = options.get('encoding')
+        if encoding is None:
+            encoding = (detect_encoding(source) if source.seekable()
+                        else FALLBACK_ENCODING)
+
+        reader = csv.DictReader(io.TextIOWrapper(source, encoding=encoding,
+                                                 newline=''),
+                                delimiter=options.get('delimiter'),
+                                quotechar=options.get('quotechar'))
+        return reader, encoding
+
+    def _parse_rows(self, rows, start, username):
+        """ Return the valid rows, and the invalid ones with their error """
+        valid, invalid = [], []
+        for index, row in enumerate(rows, start + 1):
+            error = self._validate_row(row, username)
+            if error is None:
+                valid.append(row)
             else:
-                user.set_unusable_password()
+                self.stderr.write(f'Row {index}: {error}')
+                invalid.append({**row, 'error': error})
+        return valid, invalid
+
+    def _validate_row(self, row, username):
+        """ Return why the row can not be imported, or None """
+        if None in row:
+            return _('Too many columns')
+        if None in row.values():
+            return _('Missing columns')
+        if not row[username]:
+            return f'Empty {username}'
+
+        try:
+            UserModel._meta.get_field(UserModel.USERNAME_FIELD).clean(
+                row[username], None)
+        except ValidationError as exc:
+            return ' '.join(exc.messages)
+        return None
+
+    def _get_users(self, rows, username, password, fields, hasher):
+        """ Return the unsaved users of the rows, with their hashed
+            password """
+        # Last row of a username wins
+        users = {
+            row[username]: UserModel(**{
+                UserModel.USERNAME_FIELD: row[username],
+                'properties': {field: row.get(field) for field in fields},
+            })
+            for row in rows
+        }
+        passwords = ({row[username]: row[password] for row in rows}
+                     if password else {})
+
+        for user, hashed in zip(users.values(),
+                                hasher([passwords.get(name)
+                                        for name in users])):
+            user.password = hashed
+        return list(users.values())
+
+    @contextmanager
+    def _get_hasher(self, password, workers):
+        """ Context manager of a function hashing a list of passwords.
+            Hashing is the slowest part, so it is spread on processes, which
+            are only started when passwords are imported. """
+        if not password:
+            # Users without password get an unusable one
+            yield lambda passwords: [make_password(None)
+                                     for value in passwords]
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield lambda passwords: executor.map(
+                make_password, passwords,
+                chunksize=max(1, len(passwords) // workers))
+
+    @contextmanager
+    def _get_rejected_writer(self, options, fieldnames, encoding, append):
+        """ Context manager of a function writing invalid rows to the
+            rejected file, if any """
+        if not options.get('rejected'):
+            yield lambda rows: None
+            return
+
+        with open(options['rejected'], 'a' if append else 'w', newline='',
+                  encoding=encoding) as rejected_file:
+            rejected = csv.DictWriter(
+                rejected_file,
+                fieldnames=[*fieldnames, 'error'],
+                delimiter=options.get('delimiter'),
+                quotechar=options.get('quotechar'),
+                extrasaction='ignore')
+            if not append:
+                rejected.writeheader()
+
+            def reject(rows):
+                rejected.writerows(rows)
+                rejected_file.flush()
+            yield reject
+
+    def _load_checkpoint(self, checkpoint):
+        """ Return the number of rows already imported """
+        if not checkpoint or not Path(checkpoint).exists():
+            return 0
+
+        done = int(Path(checkpoint).read_text())
+        self.stdout.write(f'Resuming after {done} rows')
+        return done
+
+    def _save_checkpoint(self, checkpoint, done):
+        if not checkpoint:
+            return
+        # Replaced at once, so an interruption never leaves it truncated
+        tmp_path = f'{checkpoint}.tmp'
+        Path(tmp_path).write_text(str(done))
+        os.replace(tmp_path, checkpoint)
+
+    def _clear_checkpoint(self, checkpoint):
+        if checkpoint and Path(checkpoint).exists():
+            Path(checkpoint).unlink()
+
+    def _chunks(self, rows, size):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @transaction.atomic
+    def _save_users(self, users, groups, upsert, update_fields):
+        """ Create users and their group memberships in bulk, and update
+            update_fields of existing ones in upsert mode. Return the number
+            of saved users. """
+        username_field = UserModel.USERNAME_FIELD
+        existing = UserModel.objects.in_bulk(
+            [getattr(user, username_field) for user in users],
+            field_name=username_field)
+
+        created = [user for user in users
+                   if getattr(user, username_field) not in existing]
+        updated = []
+        for user in users:
+            name = getattr(user, username_field)
+            if name not in existing:
+                continue
+            if not upsert:
+                self.stderr.write(f'{name} already exists, skipped')
+                continue
+
+            for field in update_fields:
+                setattr(existing[name], field, getattr(user, field))
+            updated.append(existing[name])
+
+        UserModel.objects.bulk_create(created)
+        UserModel.objects.bulk_update(updated, update_fields)
+
+        Membership = UserModel.groups.through
+        user_field = UserModel.groups.field.m2m_field_name()
+        Membership.objects.bulk_create([
+            Membership(**{'group': group, f'{user_field}_id': user.pk})
+            for user in created + updated
+            for group in groups
+        ], ignore_conflicts=True)
 
-            user.groups.add(*groups)
+        return len(created) + len(updated)
@@ -0,0 +1,249 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from rest_framework.exceptions import ValidationError
+
+from terracommon.data_importers.helpers import (csv_records, ogr_records,
+                                                parse_geometry)
+from terracommon.events.signals import event
+from terracommon.trrequests.serializers import UserRequestSerializer
+
+UserModel = get_user_model()
+
+
+class Command(BaseCommand):
+    help = _('Import user requests, with their geometry, from CSV, GeoJSON '
+             'or GeoPackage files. Properties and states are validated as by '
+             'the API.')
+
+    formats = ['csv', 'geojson', 'gpkg']
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--source',
+                            dest='source',
+                            required=True,
+                            help=_('Specify source path'),
+                            )
+        parser.add_argument('-f', '--format',
+                            choices=self.formats,
+                            dest='format',
+                            required=False,
+                            help=_('Format of the source. By default, it '
+                                   'is given by its extension'),
+                            )
+        parser.add_argument('-o', '--owner',
+                            dest='owner',
+                            required=True,
+                            help=_('Username of the owner of the requests'),
+                            )
+        parser.add_argument('--state',
+                            type=int,
+                            dest='state',
+                            required=False,
+                            help=_('State of the requests'),
+                            )
+        parser.add_argument('-m', '--map',
+                            action='append',
+                            dest='mapping',
+                            default=[],
+                            help=_('Import a column as a property, as '
+                                   'column=property. Without mappings, all '
+                                   'columns are imported with their name'),
+                            )
+        parser.add_argument('--wkt-field',
+                            dest='wkt_field',
+                            help=_('CSV column of WKT geometries'),
+                            )
+        parser.add_argument('--lat-field',
+                            dest='lat_field',
+                            help=_('CSV column of latitudes'),
+                            )
+        parser.add_argument('--lon-field',
+                            dest='lon_field',
+                            help=_('CSV column of longitudes'),
+                            )
+        parser.add_argument('--srid',
+                            type=int,
+                            default=4326,
+                            dest='srid',
+                            help=_('SRID of CSV geometries'),
+                            )
+        parser.add_argument('-cd', '--delimiter',
+                            default=';',
+                            dest='delimiter',
+                            help=_('Specify CSV delimiter'),
+                            )
+        parser.add_argument('-cq', '--quotechar',
+                            default='"',
+                            dest='quotechar',
+                            help=_('Specify CSV quotechar'),
+                            )
+        parser.add_argument('-ce', '--encoding',
+                            dest='encoding',
+                            help=_('Specify CSV encoding. By default, it is '
+                                   'detected'),
+                            )
+        parser.add_argument('--layer',
+                            default='0',
+                            dest='layer',
+                            help=_('Name or index of the layer to import, '
+                                   'for GeoJSON and GeoPackage'),
+                            )
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=500,
+                            dest='chunk_size',
+                            help=_('Number of requests saved in each '
+                                   'transaction'),
+                            )
+        parser.add_argument('--workers',
+                            type=int,
+                            default=os.cpu_count(),
+                            dest='workers',
+                            help=_('Number of processes parsing geometries'),
+                            )
+        parser.add_argument('--events',
+                            action='store_true',
+                            dest='events',
+                            help=_('Send the USERREQUEST_CREATED event of '
+                                   'each request'),
+                            )
+
+    def handle(self, *args, **options):
+        owner = self._get_owner(options['owner'])
+
+        try:
+            mapping = dict(item.split('=', 1) for item in options['mapping'])
+        except ValueError:
+            raise CommandError('Mappings are column=property')
+
+        # Only the fields given by records are validated
+        list_serializer = UserRequestSerializer(many=True, partial=True)
+        values = {}
+        if options['state'] is not None:
+            values['state'] = options['state']
+
+        imported, rejected = 0, 0
+        with self._open_records(options) as records, \
+                ProcessPoolExecutor(
+                    max_workers=options['workers']) as executor:
+            for chunk in self._chunks(records, options['chunk_size']):
+                # Parsing is the slowest part, so it is spread on processes
+                geometries = executor.map(
+                    parse_geometry,
+                    [geometry for properties, geometry in chunk],
+                    [options['srid']] * len(chunk),
+                    chunksize=max(1, len(chunk) // options['workers']))
+
+                data = self._get_data(list_serializer.child, chunk,
+                                      geometries, mapping, values,
+                                      first=imported + rejected + 1)
+                rejected += len(chunk) - len(data)
+
+                # Layers, features and requests are created in bulk, in a
+                # transaction
+                instances = list_serializer.create(
+                    [{**item, 'owner': owner} for item in data]
+                ) if data else []
+                imported += len(instances)
+
+                if options['events']:
+                    self._send_events(instances, owner)
+
+                if options['verbosity'] > 0:
+                    self.stdout.write(f'{imported} requests imported, '
+                                      f'{rejected} records rejected')
+
+    def _get_owner(self, username):
+        try:
+            return UserModel.objects.get(
+                **{UserModel.USERNAME_FIELD: username})
+        except UserModel.DoesNotExist:
+            raise CommandError(f'User {username} does not exist')
+
+    @contextmanager
+    def _open_records(self, options):
+        """ Context manager of the (properties, geometry) records of the
+            source """
+        source_format = (options['format']
+                         or Path(options['source']).suffix[1:].lower())
+        if source_format not in self.formats:
+            raise CommandError(f'Unknown format {source_format}')
+
+        if source_format != 'csv':
+            layer = options['layer']
+            yield ogr_records(options['source'],
+                              int(layer) if layer.isdigit() else layer)
+            return
+
+        if options['wkt_field']:
+            geometry_fields = options['wkt_field']
+        elif options['lat_field'] and options['lon_field']:
+            geometry_fields = (options['lat_field'], options['lon_field'])
+        else:
+            raise CommandError('CSV sources need --wkt-field, or '
+                               '--lat-field and --lon-field')
+
+        with open(options['source'], 'rb') as source:
+            yield csv_records(source,
+                              geometry_fields,
+                              encoding=options['encoding'],
+                              delimiter=options['delimiter'],
+                              quotechar=options['quotechar'])
+
+    def _get_data(self, serializer, chunk, geometries, mapping, values,
+                  first):
+        """ Return the validated data of the records of the chunk whose
+            geometry and properties are valid. Others are reported, numbered
+            from first. """
+        data = []
+        for index, (record, (geometry, error)) in enumerate(
+                zip(chunk, geometries), first):
+            if error is None:
+                try:
+                    validated_data = serializer.run_validation({
+                        **values,
+                        'properties': self._map(record[0], mapping),
+                    })
+                except ValidationError as exc:
+                    error = json.dumps(exc.detail)
+            if error is not None:
+                self.stderr.write(f'Record {index}: {error}')
+                continue
+
+            wkb, srid = geometry
+            data.append({
+                **validated_data,
+                'geometries': [GEOSGeometry(memoryview(wkb), srid=srid)],
+            })
+        return data
+
+    def _send_events(self, instances, owner):
+        for instance in instances:
+            event.send(self.__class__,
+                       action='USERREQUEST_CREATED',
+                       user=owner,
+                       instance=instance)
+
+    def _map(self, properties, mapping):
+        if not mapping:
+            return properties
+        return {name: properties.get(column)
+                for column, name in mapping.items()}
+
+    def _chunks(self, records, size):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
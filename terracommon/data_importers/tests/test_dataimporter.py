@@ -1,9 +1,18 @@
+import csv
+import json
 import os
+import tempfile
+from io import StringIO
+from unittest.mock import MagicMock
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.management import call_command
 from django.test import TestCase
+from terra_utils.settings import STATES
+
+from terracommon.events.signals import event
+from terracommon.trrequests.models import UserRequest
 
 UserModel = get_user_model()
 
@@ -25,3 +34,138 @@ class DataImporterTestCase(TestCase):
 
         for user in UserModel.objects.all():
             self.assertListEqual(groups, [g.name for g in user.groups.all()])
+
+    def test_csv_user_import_upsert(self):
+        UserModel.objects.create(email='user1@user.fr',
+                                 properties={'prop': 'old'})
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as source:
+            source.write('email;password;prop\n'
+                         'user1@user.fr;secret1;abc\n'
+                         'user2@user.fr;secret2;def\n'
+                         'user3@user.fr;secret3;ghi\n')
+            source.flush()
+
+            stderr = StringIO()
+            call_command('import_csv_users',
+                         f'-cs={source.name}',
+                         '-u=email',
+                         '-p=password',
+                         '--chunk-size=2',
+                         '--workers=1',
+                         stdout=StringIO(), stderr=stderr)
+            self.assertIn('user1@user.fr', stderr.getvalue())
+            self.assertEqual(
+                {'prop': 'old'},
+                UserModel.objects.get(email='user1@user.fr').properties)
+
+            call_command('import_csv_users',
+                         f'-cs={source.name}',
+                         '-u=email',
+                         '-p=password',
+                         '--upsert',
+                         stdout=StringIO())
+
+        self.assertEqual(3, UserModel.objects.count())
+        for index, user in enumerate(UserModel.objects.order_by('email')):
+            self.assertTrue(user.check_password(f'secret{index + 1}'))
+        self.assertEqual(
+            {'prop': 'abc'},
+            UserModel.objects.get(email='user1@user.fr').properties)
+
+    def test_csv_user_import_rejected_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'users.csv')
+            rejected = os.path.join(directory, 'rejected.csv')
+            checkpoint = os.path.join(directory, 'checkpoint')
+
+            with open(source, 'w', encoding='iso-8859-15') as f:
+                f.write('email;prop\n'
+                        'skipped@user.fr;abc\n'
+                        'user1@user.fr;éèà\n'
+                        'not an email;def\n'
+                        'user2@user.fr;ghi;extra\n'
+                        'user3@user.fr;jkl\n')
+            # A previous import stopped after the first row
+            with open(checkpoint, 'w') as f:
+                f.write('1')
+
+            call_command('import_csv_users',
+                         f'-cs={source}',
+                         '-u=email',
+                         f'--rejected={rejected}',
+                         f'--checkpoint={checkpoint}',
+                         '--chunk-size=2',
+                         stdout=StringIO(), stderr=StringIO())
+
+            self.assertListEqual(
+                ['user1@user.fr', 'user3@user.fr'],
+                list(UserModel.objects.order_by('email').values_list(
+                    'email', flat=True)))
+            self.assertEqual(
+                {'prop': 'éèà'},
+                UserModel.objects.get(email='user1@user.fr').properties)
+
+            with open(rejected, encoding='iso-8859-15') as f:
+                rows = list(csv.DictReader(f, delimiter=';'))
+            self.assertListEqual(['not an email', 'user2@user.fr'],
+                                 [row['email'] for row in rows])
+            self.assertEqual('Too many columns', rows[1]['error'])
+
+            # The import is complete
+            self.assertFalse(os.path.exists(checkpoint))
+
+    def test_userrequests_import(self):
+        owner = UserModel.objects.create(email='owner@user.fr')
+
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'requests.csv')
+            with open(source, 'w') as f:
+                f.write('ref;wkt;ignored\n'
+                        'A1;POINT(2 48);x\n'
+                        'A2;POINT(2;x\n'
+                        'A3;LINESTRING(1 43, 2 48);x\n')
+
+            handler = MagicMock()
+            event.connect(handler)
+            call_command('import_userrequests',
+                         f'-s={source}',
+                         f'-o={owner.email}',
+                         '--wkt-field=wkt',
+                         '-m=ref=reference',
+                         '--chunk-size=2',
+                         '--workers=1',
+                         '--events',
+                         stdout=StringIO(), stderr=StringIO())
+            event.disconnect(handler)
+
+            source = os.path.join(directory, 'requests.geojson')
+            with open(source, 'w') as f:
+                json.dump({
+                    'type': 'FeatureCollection',
+                    'features': [{
+                        'type': 'Feature',
+                        'geometry': {'type': 'Point', 'coordinates': [3, 45]},
+                        'properties': {'reference': 'B1'},
+                    }],
+                }, f)
+
+            call_command('import_userrequests',
+                         f'-s={source}',
+                         f'-o={owner.email}',
+                         '--state=2',
+                         '--workers=1',
+                         stdout=StringIO())
+
+        userrequests = UserRequest.objects.filter(owner=owner).order_by('pk')
+        self.assertListEqual(
+            [{'reference': 'A1'}, {'reference': 'A3'}, {'reference': 'B1'}],
+            [userrequest.properties for userrequest in userrequests])
+        self.assertListEqual(
+            ['Point', 'LineString', 'Point'],
+            [userrequest.layer.features.get().geom.geom_type
+             for userrequest in userrequests])
+        self.assertListEqual(
+            [STATES.DRAFT, STATES.DRAFT, 2],
+            [userrequest.state for userrequest in userrequests])
+        self.assertEqual(2, handler.call_count)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DatastoreConfig(AppConfig):
     name = 'terracommon.datastore'
+
+    def ready(self):
+        from . import signals  # noqa
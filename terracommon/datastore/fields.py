@@ -1,9 +1,10 @@
 import base64
 import binascii
 import logging
+from tempfile import SpooledTemporaryFile
 
 import magic
-from django.core.files.base import ContentFile
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
 from django.db.models.fields.files import FieldFile
 from rest_framework import serializers
@@ -12,6 +13,13 @@ logger = logging.getLogger(__name__)
 
 
 class FileBase64Field(serializers.FileField):
+    # Must be a multiple of 3 bytes, so encoded chunks have no padding
+    encode_chunk_size = 3 * 256 * 1024
+    # Must be a multiple of 4 characters
+    decode_chunk_size = 4 * 256 * 1024
+    # Bytes used to guess the mime type
+    mime_header_size = 2048
+
     def to_representation(self, value):
         if not value:
             return None
@@ -21,18 +29,41 @@ class FileBase64Field(serializers.FileField):
                 f'Expect a django FieldFile, instead get {type(value)}'
             )
 
+        if value.size > settings.DATASTORE_INLINE_DOCUMENT_MAX_SIZE:
+            logger.warning(f'{value.name} is too large to be serialized '
+                           'inline')
+            return self.get_download_representation(value)
+
         with value.open() as f:
-            content = f.read()
-            return (f'data:{magic.from_buffer(content, mime=True)};'
-                    f'base64,{(base64.b64encode(content)).decode("utf-8")}')
+            chunk = f.read(self.encode_chunk_size)
+            content_type = magic.from_buffer(chunk[:self.mime_header_size],
+                                             mime=True)
+
+            encoded = [f'data:{content_type};base64,']
+            while chunk:
+                encoded.append(base64.b64encode(chunk).decode('utf-8'))
+                chunk = f.read(self.encode_chunk_size)
+
+            return ''.join(encoded)
+
+    def get_download_representation(self, value):
+        """ Representation of a document too large to be inline, with the
+            url to download it from. The parent serializer gives it with
+            get_document_url(instance), else it is the storage url. """
+        get_url = getattr(getattr(self, 'parent', None), 'get_document_url',
+                          None)
+        return {
+            'size': value.size,
+            'url': get_url(value.instance) if get_url else value.url,
+        }
 
     def to_internal_value(self, data):
         try:
             content_type = data.split(":", 1)[1].split(";", 1)[0]
-            encoded = data.split(",", 1)[1]
+            start = data.index(',') + 1
 
         # Caught the error to log it then re-raised it
-        except IndexError:
+        except (IndexError, ValueError):
             logger.warning(
                 f"cannot read document {data}"
             )
@@ -42,14 +73,42 @@ class FileBase64Field(serializers.FileField):
 
         else:
             try:
-                decoded = base64.b64decode(encoded)
+                decoded, size = self._decode(data, start)
+                # A rolled over temporary file has no usable name
                 return UploadedFile(
-                    ContentFile(decoded),
-                    content_type=content_type
+                    decoded,
+                    name='',
+                    content_type=content_type,
+                    size=size,
                 )
             # Caught the error to log it then re-raised it
             except binascii.Error:
-                logger.warning(f'{data} is not a base64 format')
+                logger.warning(f'{data[:start]}... is not a base64 format')
                 raise serializers.ValidationError(
                     f'expected a base64, get instead {type(data)}'
                 )
+
+    def _decode(self, data, start):
+        """ Decode base64 data by chunks, into a temporary file which is
+            spooled to disk above FILE_UPLOAD_MAX_MEMORY_SIZE """
+        decoded = SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE,
+            dir=settings.FILE_UPLOAD_TEMP_DIR,
+        )
+
+        remainder = ''
+        for i in range(start, len(data), self.decode_chunk_size):
+            # Non base64 characters like line breaks are ignored, as
+            # b64decode does.
+            chunk = remainder + ''.join(
+                data[i:i + self.decode_chunk_size].split())
+            length = len(chunk) - len(chunk) % 4
+            decoded.write(base64.b64decode(chunk[:length]))
+            remainder = chunk[length:]
+
+        if remainder:
+            decoded.write(base64.b64decode(remainder))
+
+        size = decoded.tell()
+        decoded.seek(0)
+        return decoded, size
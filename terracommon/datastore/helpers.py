@@ -0,0 +1,64 @@
+import hashlib
+
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import parse_etags
+
+from .exceptions import PreconditionFailed
+
+
+def get_etag(content):
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def check_if_match(request, etag):
+    """ Raise PreconditionFailed if the If-Match header of the request does
+        not match the current ETag of the resource """
+    if_match = request.META.get('HTTP_IF_MATCH')
+    if if_match is None:
+        return
+
+    etags = parse_etags(if_match)
+    if '*' not in etags and etag not in etags:
+        raise PreconditionFailed()
+
+
+def get_value_cache_key(key, version):
+    """ Cache key of a version of the serialized value of a DataStore """
+    key_hash = hashlib.md5(key.encode()).hexdigest()
+    return f'datastore_value_{key_hash}_{version}'
+
+
+def get_value_version_key(key):
+    """ Cache key of the current version of the value of a DataStore """
+    return f'datastore_version_{hashlib.md5(key.encode()).hexdigest()}'
+
+
+def parse_json_pointer(pointer):
+    """ Return the unescaped reference tokens of a RFC 6901 JSON pointer """
+    if not pointer:
+        return []
+    if not pointer.startswith('/'):
+        raise ValueError(f'Invalid JSON pointer {pointer}')
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+
+def to_json_pointer(tokens):
+    return ''.join('/' + token.replace('~', '~0').replace('/', '~1')
+                   for token in tokens)
+
+
+def get_json_response(request, content, etag=None, cache_control=None):
+    """ Return rendered JSON content, or a 304 response if the client
+        already has it. cache_control are patch_cache_control directives """
+    etag = etag or get_etag(content)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type='application/json')
+
+    response['ETag'] = etag
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
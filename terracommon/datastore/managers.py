@@ -1,6 +1,68 @@
+import hashlib
+from bisect import bisect_right
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import connections, transaction
 from django.db.models import Q, QuerySet
+from psycopg2.extras import Json, execute_values
 
 from . import models as ds_models
+from .helpers import get_value_version_key, to_json_pointer
+
+PERMISSIONS_VERSION_KEY = 'datastore_permissions_version'
+
+
+def collapse_prefixes(prefixes):
+    """ Return the sorted minimal list of prefixes matching the same keys
+
+    Once sorted, prefixes starting with another one directly follow it, as
+    its children in a prefix trie would, so they are dropped in one pass.
+    """
+    collapsed = []
+    for prefix in sorted(set(prefixes)):
+        if not collapsed or not prefix.startswith(collapsed[-1]):
+            collapsed.append(prefix)
+    return collapsed
+
+
+def match_prefixes(key, prefixes):
+    """ Whether the key starts with one of the collapsed prefixes """
+    # Only the greatest prefix lower than the key can match it
+    index = bisect_right(prefixes, key)
+    return index > 0 and key.startswith(prefixes[index - 1])
+
+
+def get_permissions_version():
+    return cache.get_or_set(PERMISSIONS_VERSION_KEY, 1, None)
+
+
+def invalidate_permissions():
+    """ Make all cached prefixes of groups obsolete """
+    try:
+        cache.incr(PERMISSIONS_VERSION_KEY)
+    except ValueError:
+        # Version is not in cache anymore, so neither are the prefixes
+        pass
+
+
+def get_value_version(key):
+    """ Version of the cached value of a key. It is read before the value,
+        so a value read before a write is cached under an obsolete version
+        and never served. """
+    return cache.get_or_set(get_value_version_key(key),
+                            lambda: uuid4().hex, None)
+
+
+def invalidate_values(keys):
+    """ Make cached values obsolete, for writes which do not send signals.
+        Versions are random, so an evicted version is never reused. """
+    cache.set_many({get_value_version_key(key): uuid4().hex for key in keys},
+                   None)
+
+
+class JSONPatchConflict(Exception):
+    """ A JSON-Patch operation does not apply to the current value """
 
 
 class DataStoreQuerySet(QuerySet):
@@ -9,20 +71,212 @@ class DataStoreQuerySet(QuerySet):
 
         return self.filter(prefixes)
 
+    def get_datastores_for_prefixes(self, prefixes):
+        return self.filter(self._get_prefixes_query(prefixes))
+
     def _get_user_prefixes_query(self, user, perms=None):
-        prefixes_query = Q()
-        query_args = {
-            'group__in': user.groups.all(),
-        }
-        if perms:
-            query_args['permission__in'] = perms
+        prefixes = ds_models.DataStorePermission.objects.get_group_prefixes(
+            user.groups.values_list('pk', flat=True))
+
+        if perms is not None:
+            codenames = {perm.codename for perm in perms}
+            prefixes = {codename: codename_prefixes
+                        for codename, codename_prefixes in prefixes.items()
+                        if codename in codenames}
 
-        permissions = ds_models.DataStorePermission.objects.filter(
-                                                            **query_args)
-        if not permissions:
+        return self._get_prefixes_query(
+            prefix for codename_prefixes in prefixes.values()
+            for prefix in codename_prefixes)
+
+    def _get_prefixes_query(self, prefixes):
+        prefixes = collapse_prefixes(prefixes)
+        if not prefixes:
             return Q(key=None)
 
-        for ds_perm in permissions:
-            prefixes_query |= Q(key__startswith=ds_perm.prefix)
+        # Each prefix is a range scan of the key's varchar_pattern_ops index
+        prefixes_query = Q()
+        for prefix in prefixes:
+            prefixes_query |= Q(key__startswith=prefix)
 
         return prefixes_query
+
+    def upsert(self, values):
+        """ Insert or update the {key: value} items in one statement """
+        if not values:
+            return
+
+        # Rows are locked in key order, so concurrent batches do not deadlock
+        with connections[self.db].cursor() as cursor:
+            execute_values(
+                cursor,
+                f'INSERT INTO {self.model._meta.db_table} (key, value) '
+                f'VALUES %s '
+                f'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value',
+                [(key, Json(values[key])) for key in sorted(values)])
+
+        transaction.on_commit(lambda: invalidate_values(values))
+
+    def apply_json_patch(self, key, operations):
+        """ Apply RFC 6902 operations to the value of a key, in SQL and
+            under a row lock. operations are validated by
+            JSONPatchOperationSerializer, with paths as lists of tokens.
+
+            Raise JSONPatchConflict, and leave the value unchanged, when an
+            operation does not apply. """
+        with transaction.atomic(using=self.db):
+            self.select_for_update().get(key=key)
+
+            with connections[self.db].cursor() as cursor:
+                patch = JSONPatch(cursor, self.model._meta.db_table, key)
+                for operation in operations:
+                    patch.apply(operation)
+
+        transaction.on_commit(lambda: invalidate_values([key]))
+        return self.get(key=key)
+
+
+class JSONPatch:
+    """ Run JSON-Patch operations on the locked value of a key """
+    def __init__(self, cursor, table, key):
+        self.cursor = cursor
+        self.table = table
+        self.key = key
+
+    def apply(self, operation):
+        operations = {
+            'test': self._apply_test,
+            'remove': self._apply_remove,
+            'add': self._apply_add,
+            'replace': self._apply_replace,
+            'copy': self._apply_copy,
+            'move': self._apply_move,
+        }
+        operations[operation['op']](operation['path'], operation)
+
+    def _apply_test(self, path, operation):
+        equal, = self._select('(value #> %s::text[]) = %s::jsonb',
+                              path, Json(operation['value']))
+        if not equal:
+            raise JSONPatchConflict(f'Test failed at {to_json_pointer(path)}')
+
+    def _apply_remove(self, path, operation):
+        self._remove(path)
+
+    def _apply_add(self, path, operation):
+        self._add(path, operation['value'])
+
+    def _apply_replace(self, path, operation):
+        self._check_exists(path)
+        self._add(path, operation['value'], insert=False)
+
+    def _apply_copy(self, path, operation):
+        self._add(path, self._get_value(operation['from']))
+
+    def _apply_move(self, path, operation):
+        from_path = operation['from']
+        if path[:len(from_path)] == from_path:
+            self._check_exists(from_path)
+            if path == from_path:
+                return
+            raise JSONPatchConflict(
+                'A value can not be moved into one of its children')
+
+        value = self._get_value(from_path)
+        self._remove(from_path)
+        self._add(path, value)
+
+    def _get_value(self, path):
+        self._check_exists(path)
+        value, = self._select('value #> %s::text[]', path)
+        return value
+
+    def _select(self, expressions, *params):
+        self.cursor.execute(
+            f'SELECT {expressions} FROM {self.table} WHERE key = %s',
+            [*params, self.key])
+        return self.cursor.fetchone()
+
+    def _update(self, expression, *params):
+        self.cursor.execute(
+            f'UPDATE {self.table} SET value = {expression} WHERE key = %s',
+            [*params, self.key])
+
+    def _check_exists(self, path):
+        # An existing JSON null is not a SQL NULL
+        exists, = self._select('(value #> %s::text[]) IS NOT NULL', path)
+        if not exists:
+            raise JSONPatchConflict(f'No value at {to_json_pointer(path)}')
+
+    def _remove(self, path):
+        if not path:
+            raise JSONPatchConflict('The whole value can not be removed')
+        self._check_exists(path)
+        self._update('value #- %s::text[]', path)
+
+    def _add(self, path, value, insert=True):
+        """ Add or replace the value at path. Values are inserted in arrays,
+            unless insert is False """
+        if not path:
+            self._update('%s::jsonb', Json(value))
+            return
+
+        parent, token = path[:-1], path[-1]
+        parent_type, length = self._select(
+            "jsonb_typeof(value #> %s::text[]), "
+            "jsonb_array_length(CASE WHEN jsonb_typeof(value #> %s::text[]) "
+            "= 'array' THEN value #> %s::text[] END)",
+            parent, parent, parent)
+
+        if parent_type == 'object':
+            self._update('jsonb_set(value, %s::text[], %s::jsonb)',
+                         path, Json(value))
+        elif parent_type == 'array':
+            index = length if token == '-' else self._get_index(token)
+            if index > length or (index == length and not insert):
+                raise JSONPatchConflict(f'Index {token} is out of range')
+
+            if not insert:
+                self._update('jsonb_set(value, %s::text[], %s::jsonb)',
+                             path, Json(value))
+            elif index == length:
+                # Inserted after the last item, which also fits empty arrays
+                self._update(
+                    'jsonb_insert(value, %s::text[], %s::jsonb, true)',
+                    [*parent, '-1'], Json(value))
+            else:
+                self._update('jsonb_insert(value, %s::text[], %s::jsonb)',
+                             [*parent, str(index)], Json(value))
+        else:
+            raise JSONPatchConflict(
+                f'No object or array at {to_json_pointer(parent)}')
+
+    @staticmethod
+    def _get_index(token):
+        if not token.isdigit() or (token != '0' and token.startswith('0')):
+            raise JSONPatchConflict(f'Invalid array index {token}')
+        return int(token)
+
+
+class DataStorePermissionQuerySet(QuerySet):
+    def get_group_prefixes(self, group_ids):
+        """ Return the collapsed prefixes allowed to these groups, by
+            permission codename. They are cached for each set of groups. """
+        group_ids = sorted(set(group_ids))
+        if not group_ids:
+            return {}
+
+        groups_hash = hashlib.md5(
+            ','.join(str(pk) for pk in group_ids).encode()).hexdigest()
+        return cache.get_or_set(
+            f'datastore_prefixes_{groups_hash}',
+            lambda: self._get_group_prefixes(group_ids),
+            version=get_permissions_version())
+
+    def _get_group_prefixes(self, group_ids):
+        prefixes = {}
+        for codename, prefix in self.filter(group__in=group_ids).values_list(
+                'permission__codename', 'prefix'):
+            prefixes.setdefault(codename, []).append(prefix)
+
+        return {codename: collapse_prefixes(codename_prefixes)
+                for codename, codename_prefixes in prefixes.items()}
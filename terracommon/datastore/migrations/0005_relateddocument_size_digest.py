@@ -0,0 +1,23 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastore', '0004_relateddocument_properties'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='relateddocument',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='relateddocument',
+            name='size',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+    ]
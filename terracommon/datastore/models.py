@@ -1,3 +1,4 @@
+import hashlib
 from pathlib import Path
 
 from django.contrib.auth.models import Group, Permission
@@ -7,7 +8,7 @@ from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.db.models.manager import BaseManager
 
-from .managers import DataStoreQuerySet
+from .managers import DataStorePermissionQuerySet, DataStoreQuerySet
 
 
 class DataStore(models.Model):
@@ -25,6 +26,8 @@ class DataStorePermission(models.Model):
     prefix = models.CharField(max_length=255, blank=False, null=False)
     permission = models.ForeignKey(Permission, on_delete=models.CASCADE)
 
+    objects = BaseManager.from_queryset(DataStorePermissionQuerySet)()
+
     class Meta:
         ordering = ['prefix']
         permissions = (
@@ -46,8 +49,19 @@ class RelatedDocument(models.Model):
     object_id = models.PositiveIntegerField()
     linked_object = GenericForeignKey('content_type', 'object_id')
     document = models.FileField(upload_to=related_document_path, null=False)
+    size = models.BigIntegerField(null=True, editable=False)
+    digest = models.CharField(max_length=64, blank=True, editable=False)
     properties = JSONField(default=dict)
 
     class Meta:
         ordering = ['key']
         unique_together = ('key', 'content_type', 'object_id')
+
+    def save_document(self, name, content):
+        """ Write the file to the storage, with its size and sha256 digest """
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+
+        self.size, self.digest = content.size, sha256.hexdigest()
+        self.document.save(name, content, save=False)
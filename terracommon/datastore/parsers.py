@@ -0,0 +1,8 @@
+from rest_framework.parsers import JSONParser
+
+
+class JSONPatchParser(JSONParser):
+    """
+    Parse RFC 6902 JSON-Patch documents.
+    """
+    media_type = 'application/json-patch+json'
@@ -1,8 +1,30 @@
 from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
 
+from terracommon.permissions import get_permissions_snapshot
+
+from .managers import collapse_prefixes, match_prefixes
 from .models import DataStorePermission
 
 
+def get_datastore_prefixes(request, codenames=None):
+    """ Prefixes allowed to the request's user by any of these permissions,
+        or by any permission if codenames is None. Prefixes of each
+        permission are loaded once per request. """
+    # Shared by the DRF request and the underlying django request
+    request = getattr(request, '_request', request)
+
+    if not hasattr(request, '_datastore_prefixes'):
+        request._datastore_prefixes = (
+            DataStorePermission.objects.get_group_prefixes(
+                get_permissions_snapshot(request).group_ids))
+
+    if codenames is None:
+        codenames = request._datastore_prefixes.keys()
+    return collapse_prefixes(
+        prefix for codename in codenames
+        for prefix in request._datastore_prefixes.get(codename, ()))
+
+
 class IsAuthenticatedAndDataStoreAllowed(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
         permissions = ['can_readwrite_datastore', ]
@@ -10,9 +32,6 @@ class IsAuthenticatedAndDataStoreAllowed(IsAuthenticated):
         if request.method in SAFE_METHODS:
             permissions.append('can_read_datastore')
 
-        perms = DataStorePermission.objects.filter(
-            permission__codename__in=permissions,
-            group__in=request.user.groups.all()
-        )
+        prefixes = get_datastore_prefixes(request, permissions)
 
-        return any([obj.key.startswith(perm.prefix) for perm in perms])
+        return match_prefixes(obj.key, prefixes)
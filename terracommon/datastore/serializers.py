@@ -1,8 +1,10 @@
 import logging
 
 from rest_framework import serializers
+from rest_framework.fields import empty
 
 from .fields import FileBase64Field
+from .helpers import parse_json_pointer
 from .models import DataStore, RelatedDocument
 
 logger = logging.getLogger(__name__)
@@ -15,6 +17,49 @@ class DataStoreSerializer(serializers.ModelSerializer):
         read_only_fields = ('key', )
 
 
+class JSONPointerField(serializers.CharField):
+    """ RFC 6901 JSON pointer, as a list of reference tokens """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('trim_whitespace', False)
+        super().__init__(**kwargs)
+
+    def run_validation(self, data=empty):
+        # The empty pointer is the whole document
+        if data == '':
+            return []
+        return super().run_validation(data)
+
+    def to_internal_value(self, data):
+        try:
+            return parse_json_pointer(super().to_internal_value(data))
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
+
+class JSONPatchOperationSerializer(serializers.Serializer):
+    """ One RFC 6902 operation """
+    op = serializers.ChoiceField(
+        choices=('add', 'remove', 'replace', 'move', 'copy', 'test'))
+    path = JSONPointerField()
+    value = serializers.JSONField(required=False, allow_null=True)
+    from_path = JSONPointerField(required=False)
+
+    def get_fields(self):
+        # "from" is a reserved word
+        fields = super().get_fields()
+        fields['from'] = fields.pop('from_path')
+        return fields
+
+    def validate(self, attrs):
+        if attrs['op'] in ('add', 'replace', 'test') and 'value' not in attrs:
+            raise serializers.ValidationError(
+                {'value': f'Required by the {attrs["op"]} operation'})
+        if attrs['op'] in ('move', 'copy') and 'from' not in attrs:
+            raise serializers.ValidationError(
+                {'from': f'Required by the {attrs["op"]} operation'})
+        return attrs
+
+
 class RelatedDocumentSerializer(serializers.ModelSerializer):
     document = FileBase64Field()
 
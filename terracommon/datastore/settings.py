@@ -0,0 +1,8 @@
+# Cache-Control directives of datastore values, by key prefix. The longest
+# matching prefix applies, ie: {'terra.translations': {'max_age': 3600}}
+DATASTORE_CACHE_CONTROL = {}
+
+# Documents larger than this size, in bytes, are not serialized inline as
+# base64, as their whole representation is built in memory. They are
+# represented as {"size": <bytes>, "url": <download url>} instead.
+DATASTORE_INLINE_DOCUMENT_MAX_SIZE = 10 * 1024 * 1024
@@ -0,0 +1,20 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .managers import invalidate_permissions, invalidate_values
+from .models import DataStore, DataStorePermission
+
+
+@receiver(post_save, sender=DataStorePermission)
+@receiver(post_delete, sender=DataStorePermission)
+def invalidate_datastore_permissions(sender, **kwargs):
+    invalidate_permissions()
+
+
+@receiver(post_save, sender=DataStore)
+@receiver(post_delete, sender=DataStore)
+def invalidate_datastore_value(sender, instance, **kwargs):
+    invalidate_values([instance.key])
+    # Values read before the transaction is committed are obsolete too
+    transaction.on_commit(lambda: invalidate_values([instance.key]))
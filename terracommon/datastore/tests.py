@@ -1,13 +1,31 @@
 
+import base64
+import json
+import tempfile
+from unittest import mock
+
 from django.contrib.auth.models import Group, Permission
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection
+from django.db.models import FileField
+from django.db.models.fields.files import FieldFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.status import (HTTP_200_OK, HTTP_401_UNAUTHORIZED,
-                                   HTTP_403_FORBIDDEN)
+from rest_framework.exceptions import ValidationError
+from rest_framework.status import (HTTP_200_OK, HTTP_304_NOT_MODIFIED,
+                                   HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED,
+                                   HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND,
+                                   HTTP_409_CONFLICT,
+                                   HTTP_412_PRECONDITION_FAILED)
 from rest_framework.test import APIClient
 from terra_accounts.tests.factories import TerraUserFactory
 
+from .fields import FileBase64Field
+from .managers import collapse_prefixes, match_prefixes
 from .models import DataStore, DataStorePermission
+from .views import DataStoreViewSet
 
 
 class DataStoreTestCase(TestCase):
@@ -156,3 +174,316 @@ class DataStoreTestCase(TestCase):
         response = self.client.post(reverse('datastore:datastore-detail', args=['terracommon.forbiddenprefix']),
                                     data=test_value)
         self.assertEqual(response.status_code, HTTP_403_FORBIDDEN)
+
+    def test_permissions_loaded_once(self):
+        group = Group.objects.create(name='readers')
+        self.user.groups.add(group)
+        perm = Permission.objects.get(codename='can_read_datastore')
+        for prefix in ('terracommon.test', 'terracommon.prefix'):
+            DataStorePermission.objects.create(group=group,
+                                               permission=perm,
+                                               prefix=prefix)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('datastore:datastore-detail',
+                        args=['terracommon.test.data.store']))
+        self.assertEqual(HTTP_200_OK, response.status_code)
+
+        # Shared by the queryset and the object permission check
+        self.assertEqual(1, len([
+            query for query in queries
+            if DataStorePermission._meta.db_table in query['sql']
+        ]))
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_cached_prefixes(self):
+        group = Group.objects.create(name='can_read')
+        self.user.groups.add(group)
+        perm = Permission.objects.get(codename='can_read_datastore')
+        for prefix in ('terracommon.test', 'terracommon.test.data'):
+            DataStorePermission.objects.create(group=group,
+                                               permission=perm,
+                                               prefix=prefix)
+
+        self.assertDictEqual(
+            {'can_read_datastore': ['terracommon.test']},
+            DataStorePermission.objects.get_group_prefixes([group.pk]))
+
+        response = self.client.get(reverse('datastore:datastore-list'))
+        self.assertEqual(2, response.json()['count'])
+
+        # Cached prefixes are invalidated by permission changes
+        DataStorePermission.objects.create(group=group,
+                                           permission=perm,
+                                           prefix='terracommon.prefix')
+        response = self.client.get(reverse('datastore:datastore-list'))
+        self.assertEqual(3, response.json()['count'])
+
+    @override_settings(
+        CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            }
+        },
+        DATASTORE_CACHE_CONTROL={
+            'terracommon': {'private': True},
+            'terracommon.test': {'max_age': 3600},
+        })
+    def test_conditional_retrieve(self):
+        group = Group.objects.create(name='can_readwrite')
+        self.user.groups.add(group)
+        DataStorePermission.objects.create(
+            group=group,
+            permission=Permission.objects.get(
+                codename='can_readwrite_datastore'),
+            prefix='terracommon',
+        )
+        url = reverse('datastore:datastore-detail',
+                      args=['terracommon.test.data.store'])
+
+        response = self.client.get(url)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertDictEqual({'key': 'value'}, response.json()['value'])
+        self.assertEqual('max-age=3600', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_304_NOT_MODIFIED, response.status_code)
+
+        # Cached value is invalidated by writes
+        response = self.client.put(url, data={'key': 'new value'},
+                                   format='json')
+        self.assertEqual(HTTP_200_OK, response.status_code)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertDictEqual({'key': 'new value'}, response.json()['value'])
+        self.assertNotEqual(etag, response['ETag'])
+
+        response = self.client.get(
+            reverse('datastore:datastore-detail',
+                    args=['terracommon.prefix.dot.com']))
+        self.assertEqual('private', response['Cache-Control'])
+
+        # Keys without permission stay hidden, even when cached
+        self.user.groups.clear()
+        response = self.client.get(url)
+        self.assertEqual(HTTP_404_NOT_FOUND, response.status_code)
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_retrieve_concurrent_write(self):
+        group = Group.objects.create(name='can_read')
+        self.user.groups.add(group)
+        DataStorePermission.objects.create(
+            group=group,
+            permission=Permission.objects.get(codename='can_read_datastore'),
+            prefix='terracommon',
+        )
+        url = reverse('datastore:datastore-detail',
+                      args=['terracommon.test.data.store'])
+        get_object = DataStoreViewSet.get_object
+
+        def get_object_then_write(view):
+            # The value is written after it is read, and before it is cached
+            obj = get_object(view)
+            stored = DataStore.objects.get(pk=obj.pk)
+            stored.value = {'key': 'new value'}
+            stored.save()
+            return obj
+
+        with mock.patch.object(DataStoreViewSet, 'get_object',
+                               get_object_then_write):
+            response = self.client.get(url)
+        self.assertDictEqual({'key': 'value'}, response.json()['value'])
+
+        response = self.client.get(url)
+        self.assertDictEqual({'key': 'new value'}, response.json()['value'])
+
+    def test_bulk(self):
+        group = Group.objects.create(name='can_readwrite')
+        self.user.groups.add(group)
+        DataStorePermission.objects.create(
+            group=group,
+            permission=Permission.objects.get(
+                codename='can_readwrite_datastore'),
+            prefix='terracommon.test',
+        )
+
+        response = self.client.get(
+            reverse('datastore:datastore-list'),
+            {'keys': 'terracommon.test.data.store,terracommon.prefix.dot.com'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(['terracommon.test.data.store'],
+                         [item['key'] for item in response.json()['results']])
+
+        values = {
+            'terracommon.test.data.store': {'key': 'new value'},
+            'terracommon.test.data.created': [1, 2],
+        }
+        response = self.client.post(reverse('datastore:datastore-list'),
+                                    values, format='json')
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        for key, value in values.items():
+            self.assertEqual(value, DataStore.objects.get(key=key).value)
+
+        # Nothing is written if a key is not allowed
+        response = self.client.post(reverse('datastore:datastore-list'), {
+            'terracommon.test.data.store': {},
+            'terracommon.prefix.dot.com': {'a': 'b'},
+        }, format='json')
+        self.assertEqual(HTTP_403_FORBIDDEN, response.status_code)
+        self.assertEqual(
+            {'key': 'new value'},
+            DataStore.objects.get(key='terracommon.test.data.store').value)
+
+    def test_json_patch(self):
+        group = Group.objects.create(name='can_readwrite')
+        self.user.groups.add(group)
+        DataStorePermission.objects.create(
+            group=group,
+            permission=Permission.objects.get(
+                codename='can_readwrite_datastore'),
+            prefix='terracommon.test',
+        )
+        DataStore.objects.filter(key='terracommon.test.data.store').update(
+            value={'a': {'b': 1}, 'list': [1, 3], 'removed': None})
+        url = reverse('datastore:datastore-detail',
+                      args=['terracommon.test.data.store'])
+
+        response = self.client.patch(url, json.dumps([
+            {'op': 'test', 'path': '/a/b', 'value': 1},
+            {'op': 'replace', 'path': '/a/b', 'value': 2},
+            {'op': 'add', 'path': '/a/c~1d', 'value': {'e': True}},
+            {'op': 'add', 'path': '/list/1', 'value': 2},
+            {'op': 'add', 'path': '/list/-', 'value': 4},
+            {'op': 'remove', 'path': '/removed'},
+            {'op': 'copy', 'from': '/a/b', 'path': '/copy'},
+            {'op': 'move', 'from': '/copy', 'path': '/list/0'},
+        ]), content_type='application/json-patch+json')
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        value = {'a': {'b': 2, 'c/d': {'e': True}}, 'list': [2, 1, 2, 3, 4]}
+        self.assertDictEqual(value, response.json())
+
+        # Operations are applied all or nothing
+        response = self.client.patch(url, json.dumps([
+            {'op': 'add', 'path': '/a/b', 'value': 3},
+            {'op': 'remove', 'path': '/missing'},
+        ]), content_type='application/json-patch+json')
+        self.assertEqual(HTTP_409_CONFLICT, response.status_code)
+        self.assertDictEqual(
+            value,
+            DataStore.objects.get(key='terracommon.test.data.store').value)
+
+        response = self.client.patch(url, json.dumps([
+            {'op': 'replace', 'path': '/a/b'},
+        ]), content_type='application/json-patch+json')
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_if_match(self):
+        group = Group.objects.create(name='can_readwrite')
+        self.user.groups.add(group)
+        DataStorePermission.objects.create(
+            group=group,
+            permission=Permission.objects.get(
+                codename='can_readwrite_datastore'),
+            prefix='terracommon.test',
+        )
+        url = reverse('datastore:datastore-detail',
+                      args=['terracommon.test.data.store'])
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.put(url, {'key': 'new value'}, format='json',
+                                   HTTP_IF_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(self.client.get(url)['ETag'], response['ETag'])
+
+        response = self.client.patch(url, json.dumps([
+            {'op': 'add', 'path': '/other', 'value': 1},
+        ]), content_type='application/json-patch+json', HTTP_IF_MATCH=etag)
+        self.assertEqual(HTTP_412_PRECONDITION_FAILED, response.status_code)
+        self.assertDictEqual(
+            {'key': 'new value'},
+            DataStore.objects.get(key='terracommon.test.data.store').value)
+
+
+class FileBase64FieldTestCase(SimpleTestCase):
+    def setUp(self):
+        self.field = FileBase64Field()
+        # Small chunks, to test content spanning several of them
+        self.field.encode_chunk_size = 3 * 4
+        self.field.decode_chunk_size = 4 * 4
+        self.content = bytes(range(256)) * 4
+
+    def test_to_representation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=directory)
+            name = storage.save('file.bin', ContentFile(self.content))
+
+            value = FieldFile(None, FileField(storage=storage), name)
+            self.assertEqual(
+                'data:application/octet-stream;base64,'
+                f'{base64.b64encode(self.content).decode()}',
+                self.field.to_representation(value))
+
+    def test_to_representation_too_large(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=directory)
+            name = storage.save('file.bin', ContentFile(self.content))
+
+            value = FieldFile(None, FileField(storage=storage), name)
+            with override_settings(
+                    DATASTORE_INLINE_DOCUMENT_MAX_SIZE=len(self.content) - 1):
+                self.assertDictEqual(
+                    {'size': len(self.content), 'url': value.url},
+                    self.field.to_representation(value))
+
+    def test_to_internal_value(self):
+        encoded = base64.b64encode(self.content).decode()
+        # Line breaks are ignored, whatever the chunk boundaries
+        encoded = '\n'.join(encoded[i:i + 7]
+                            for i in range(0, len(encoded), 7))
+
+        value = self.field.to_internal_value(
+            f'data:application/octet-stream;base64,{encoded}')
+        self.assertEqual('application/octet-stream', value.content_type)
+        self.assertEqual(len(self.content), value.size)
+        self.assertEqual(self.content, value.read())
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100)
+    def test_to_internal_value_spooled(self):
+        value = self.field.to_internal_value(
+            'data:application/octet-stream;base64,'
+            f'{base64.b64encode(self.content).decode()}')
+        self.assertTrue(value.file._rolled)
+        self.assertEqual(self.content, value.read())
+
+    def test_to_internal_value_invalid(self):
+        for data in ('not a data url', 'data:text/plain;base64,abc'):
+            with self.assertRaises(ValidationError):
+                self.field.to_internal_value(data)
+
+
+class PrefixesTestCase(SimpleTestCase):
+    def test_collapse_prefixes(self):
+        self.assertListEqual(
+            ['a.b', 'ab', 'b'],
+            collapse_prefixes(['a.b.c', 'ab', 'a.b', 'b', 'a.bc', 'b.a']))
+        self.assertListEqual([''], collapse_prefixes(['a', '', 'b']))
+        self.assertListEqual([], collapse_prefixes([]))
+
+    def test_match_prefixes(self):
+        prefixes = collapse_prefixes(['a.b', 'ab', 'c'])
+        for key in ('a.b', 'a.b.c', 'ab.c', 'c'):
+            self.assertTrue(match_prefixes(key, prefixes))
+        for key in ('a', 'a.c', 'aa', 'b', ''):
+            self.assertFalse(match_prefixes(key, prefixes))
+        self.assertFalse(match_prefixes('a', []))
@@ -1,15 +1,35 @@
-from rest_framework import viewsets
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.shortcuts import get_object_or_404
+from rest_framework import serializers, viewsets
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.status import HTTP_409_CONFLICT
 
+from .helpers import (check_if_match, get_etag, get_json_response,
+                      get_value_cache_key)
+from .managers import JSONPatchConflict, get_value_version
 from .models import DataStore
-from .permissions import IsAuthenticatedAndDataStoreAllowed
-from .serializers import DataStoreSerializer
+from .parsers import JSONPatchParser
+from .permissions import (IsAuthenticatedAndDataStoreAllowed,
+                          get_datastore_prefixes)
+from .serializers import DataStoreSerializer, JSONPatchOperationSerializer
+
+
+def get_cache_control(key):
+    """ Cache-Control directives of the longest prefix matching the key """
+    prefixes = [prefix for prefix in settings.DATASTORE_CACHE_CONTROL
+                if key.startswith(prefix)]
+    if prefixes:
+        return settings.DATASTORE_CACHE_CONTROL[max(prefixes, key=len)]
+    return None
 
 
 class DataStoreViewSet(viewsets.ModelViewSet):
     renderer_classes = (JSONRenderer, )
+    parser_classes = (*api_settings.DEFAULT_PARSER_CLASSES, JSONPatchParser)
 
     permission_classes = (IsAuthenticatedAndDataStoreAllowed, )
     serializer_class = DataStoreSerializer
@@ -17,17 +37,103 @@ class DataStoreViewSet(viewsets.ModelViewSet):
     lookup_value_regex = '[^/]+'
 
     def get_queryset(self):
-        return DataStore.objects.get_datastores_for_user(self.request.user)
+        queryset = DataStore.objects.get_datastores_for_prefixes(
+            get_datastore_prefixes(self.request))
 
-    def update(self, request, key=None):
-        obj = self.get_object()
+        # Several keys can be read at once with ?keys=a,b,c
+        keys = self.request.query_params.get('keys')
+        if self.action == 'list' and keys:
+            queryset = queryset.filter(key__in=keys.split(','))
 
-        serializer = self.get_serializer(obj, data={'value': request.data})
+        return queryset
+
+    def retrieve(self, request, key=None):
+        """ Serialized values are cached until they are written """
+        cache_key = get_value_cache_key(key, get_value_version(key))
+
+        # Permissions only depend on the key, so they are checked before the
+        # cache is read. Denied keys are answered as not found below.
+        cached = None
+        if all(permission.has_object_permission(request, self,
+                                                DataStore(key=key))
+               for permission in self.get_permissions()):
+            cached = cache.get(cache_key)
+
+        if cached is None:
+            content = JSONRenderer().render(
+                self.get_serializer(self.get_object()).data)
+            cached = (get_etag(content), content)
+            cache.set(cache_key, cached, None)
+
+        etag, content = cached
+        return get_json_response(request, content, etag=etag,
+                                 cache_control=get_cache_control(key))
+
+    def get_etag(self, obj):
+        """ ETag of the retrieved representation of the object """
+        return get_etag(JSONRenderer().render(self.get_serializer(obj).data))
+
+    def get_locked_object(self):
+        """ Lock the object until the end of the transaction, and check it
+            still matches the If-Match header of the request """
+        obj = get_object_or_404(
+            self.filter_queryset(self.get_queryset()).select_for_update(),
+            key=self.kwargs[self.lookup_field])
+        self.check_object_permissions(self.request, obj)
+
+        if 'HTTP_IF_MATCH' in self.request.META:
+            check_if_match(self.request, self.get_etag(obj))
+        return obj
+
+    def update(self, request, key=None, **kwargs):
+        with transaction.atomic():
+            obj = self.get_locked_object()
+
+            serializer = self.get_serializer(obj, data={'value': request.data})
 
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+
+        return Response(serializer.data.get('value'),
+                        headers={'ETag': self.get_etag(obj)})
+
+    def partial_update(self, request, key=None):
+        """ Apply a RFC 6902 JSON-Patch document to the value """
+        if not isinstance(request.data, list):
+            return super().partial_update(request, key=key)
+
+        serializer = JSONPatchOperationSerializer(data=request.data, many=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
 
-        return Response(serializer.data.get('value'))
+        with transaction.atomic():
+            obj = self.get_locked_object()
+
+            try:
+                obj = DataStore.objects.apply_json_patch(
+                    obj.key, serializer.validated_data)
+            except JSONPatchConflict as exc:
+                return Response({'detail': str(exc)},
+                                status=HTTP_409_CONFLICT)
+
+        return Response(obj.value, headers={'ETag': self.get_etag(obj)})
+
+    def create(self, request):
+        """ Insert or update several keys at once, from a {key: value}
+            object. Nothing is written if any key is not allowed. """
+        if not isinstance(request.data, dict) or not request.data:
+            raise serializers.ValidationError(
+                {'non_field_errors': ['Expected a {key: value} object']})
+
+        max_length = DataStore._meta.get_field('key').max_length
+        for key in request.data:
+            if len(key) > max_length:
+                raise serializers.ValidationError(
+                    {key: [f'Keys are limited to {max_length} characters']})
+            self.check_object_permissions(request, DataStore(key=key))
+
+        DataStore.objects.upsert(request.data)
+
+        return Response(request.data)
 
     def post(self, request, *args, **kwargs):
         attrs = {self.lookup_field: kwargs.get(self.lookup_field)}
@@ -1,6 +1,6 @@
 import base64
 from datetime import timedelta
-from tempfile import NamedTemporaryFile
+from io import BytesIO
 
 from django.utils.dateparse import parse_datetime
 from docx.shared import Mm
@@ -34,9 +34,7 @@ def todate_filter(value):
 
 @contextfilter
 def b64_to_inlineimage(context, value):
+    """ Inline image of a base64 data URL, decoded in memory """
     b64str = value.split(',', 1)[1]
-    decoded = base64.b64decode(b64str)
-    tmp_f = NamedTemporaryFile(mode='wb', dir=context['tmpdir'], delete=False)
-    tmp_f.write(decoded)
-    tmp_f.seek(0)
-    return InlineImage(context['tpl'], tmp_f.name, width=Mm(40))
+    return InlineImage(context['tpl'], BytesIO(base64.b64decode(b64str)),
+                       width=Mm(40))
@@ -3,10 +3,9 @@ import hashlib
 import io
 import logging
 import os
-import shutil
 import subprocess
 import zipfile
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import TemporaryDirectory
 
 import jinja2
 import magic
@@ -31,22 +30,76 @@ from .filters import (b64_to_inlineimage, timedelta_filter, todate_filter,
 logger = logging.getLogger(__name__)
 
 
-class DocumentGenerator:
-
-    def __init__(self, downloadabledoc):
-        if not isinstance(downloadabledoc, DownloadableDocument):
-            raise TypeError("downloadabledoc must be a DownloadableDocument")
-        self.template = downloadabledoc.document.documenttemplate.path
+def get_datamodel_data(datamodel):
+    """ Serialized data of an object, used to render its documents """
+    serializer = (datamodel.get_pdf_serializer()
+                  if hasattr(datamodel, 'get_pdf_serializer')
+                  else datamodel.get_serializer())
+    return serializer(datamodel).data
+
+
+def docx_to_pdf(docx, profile=None):
+    """ Convert a docx io.BytesIO to PDF with libreoffice, and return its
+        content. Concurrent conversions need their own libreoffice profile
+        directory. """
+    # libreoffice only converts files, which are written in memory when
+    # DOCUMENT_CONVERSION_DIR is a tmpfs
+    with TemporaryDirectory(dir=settings.DOCUMENT_CONVERSION_DIR) as tmpdir:
+        tmp_docx = os.path.join(tmpdir, 'document.docx')
+        with open(tmp_docx, 'wb') as docx_file:
+            docx_file.write(docx.getbuffer())  # docx is an io.BytesIO
+
+        # Call libreoffice to convert docx to pdf
+        subprocess.run([
+            'lowriter',
+            *([f'-env:UserInstallation=file://{profile}'] if profile else []),
+            '--headless',
+            '--convert-to',
+            'pdf:writer_pdf_Export',
+            '--outdir',
+            tmpdir,
+            tmp_docx
+        ])
+
+        with open(os.path.join(tmpdir, 'document.pdf'), 'rb') as pdf:
+            return pdf.read()
+
+
+class TemplateRenderer:
+    """ Render a docx or html template file with data """
+
+    def __init__(self, template, libreoffice_profile=None):
+        self.template = template
         try:
             self.type = from_file(self.template, mime=True)
         except FileNotFoundError:
             logger.warning(f"File {self.template} not found.")
             raise
-        self.datamodel = downloadabledoc.linked_object
-        self.mime_type_mapping = {
-            'text/html': self._get_html_as_pdf,
-            'application/octet-stream': self._get_docx_as_pdf,
-        }
+        self.libreoffice_profile = libreoffice_profile
+
+    @property
+    def output_types(self):
+        """ Types the template can be rendered as """
+        if self.type == 'text/html':
+            return ('html', 'pdf')
+        return ('docx', 'pdf')
+
+    def render(self, data, output_type='pdf'):
+        """ Return the content of the template rendered with data """
+        if output_type not in self.output_types:
+            raise ValueError(f'{self.template} can not be rendered as '
+                             f'{output_type}')
+
+        if self.type == 'text/html':
+            html_content = self.get_html(data)
+            if output_type == 'html':
+                return html_content.encode()
+            return HTML(string=html_content).write_pdf()
+
+        docx = self.get_docx(data)
+        if output_type == 'docx':
+            return docx.getvalue()
+        return docx_to_pdf(docx, profile=self.libreoffice_profile)
 
     def get_docx(self, data):
         doc = DocxTemplator(self.template)
@@ -59,16 +112,7 @@ class DocumentGenerator:
         jinja_env.globals['now'] = datetime.datetime.now
         jinja_env.filters.update(self.filters)
 
-        # render is perform in a temp dir
-        # Because some custom jinja filter used temp files
-        # which are not removed during render
-        with TemporaryDirectory() as tmpdir:
-            updated_data['tmpdir'] = tmpdir  # used by tempfile in custom filter
-            doc.render(context=updated_data, jinja_env=jinja_env)
-
-        # tmpdir is not removed if not empty. Ensure it's cleaned anyway
-        if os.path.isdir(tmpdir):
-            shutil.rmtree(tmpdir)
+        doc.render(context=updated_data, jinja_env=jinja_env)
         return doc.save()
 
     def get_html(self, data):
@@ -77,6 +121,34 @@ class DocumentGenerator:
         html_content = template.render(Context(data))
         return html_content
 
+    def _get_image(self, data, tpl):
+        for document in data['documents']:
+            img_path = os.path.join(settings.MEDIA_ROOT, document['document'])
+            # Set as image of 170mm width
+            document['document'] = InlineImage(tpl, img_path, width=Mm(170))
+        return data
+
+    # TODO make it a function in filters.py
+    filters = {
+        'timedelta_filter': timedelta_filter,
+        'translate_filter': translate_filter,
+        'todate_filter': todate_filter,
+        'b64_to_inlineimage': b64_to_inlineimage,
+    }
+
+
+class DocumentGenerator(TemplateRenderer):
+
+    def __init__(self, downloadabledoc):
+        if not isinstance(downloadabledoc, DownloadableDocument):
+            raise TypeError("downloadabledoc must be a DownloadableDocument")
+        super().__init__(downloadabledoc.document.documenttemplate.path)
+        self.datamodel = downloadabledoc.linked_object
+        self.mime_type_mapping = {
+            'text/html': self._get_html_as_pdf,
+            'application/octet-stream': self._get_docx_as_pdf,
+        }
+
     def get_pdf(self, reset_cache=False):
         cachepath = os.path.join(
             self.datamodel.__class__.__name__,
@@ -91,18 +163,14 @@ class DocumentGenerator:
             if reset_cache:
                 cache.clear()
 
-            serializer = (self.datamodel.get_pdf_serializer()
-                          if hasattr(self.datamodel, 'get_pdf_serializer')
-                          else self.datamodel.get_serializer())
-            serialized_model = serializer(self.datamodel)
-
-            self.mime_type_mapping[self.type](cache, serialized_model)
+            self.mime_type_mapping[self.type](
+                cache, get_datamodel_data(self.datamodel))
 
         return cache.name
 
-    def _get_html_as_pdf(self, cache, serialized_model):
+    def _get_html_as_pdf(self, cache, data):
         try:
-            html_content = self.get_html(serialized_model.data)
+            html_content = self.get_html(data)
         except DjangoTemplateSyntaxError:
             cache.remove()
             logger.warning(f'TemplateSyntaxError for {self.template}')
@@ -111,48 +179,18 @@ class DocumentGenerator:
         with cache.open() as cached_pdf:
             cached_pdf.write(pdf)
 
-    def _get_docx_as_pdf(self, cache, serialized_model):
+    def _get_docx_as_pdf(self, cache, data):
         try:
-            docx = self.get_docx(data=serialized_model.data)
+            docx = self.get_docx(data=data)
         except TemplateSyntaxError as e:
             cache.remove()
             logger.warning(f'TemplateSyntaxError for {self.template} '
                            f'at line {e.lineno}: {e.message}')
             raise
 
-        # Create a temporary docx file on disk so libreoffice can use it
-        with TemporaryDirectory() as tmpdir, NamedTemporaryFile(mode='wb',
-                                                                dir=tmpdir,
-                                                                suffix='.docx') as tmp_docx:
-            tmp_docx.write(docx.getvalue())  # docx is an io.BytesIO
-
-            # Call libreoffice to convert docx to pdf
-            subprocess.run([
-                'lowriter',
-                '--headless',
-                '--convert-to',
-                'pdf:writer_pdf_Export',
-                '--outdir',
-                tmpdir,
-                tmp_docx.name
-            ])
-
-            # Get pdf name of the file created from libreoffice writer
-            tmp_pdf_root = os.path.splitext(os.path.basename(tmp_docx.name))[0]
-            tmp_pdf = os.path.join(tmpdir, f'{tmp_pdf_root}.pdf')
-
-            with cache.open() as cached_pdf, open(tmp_pdf, 'rb') as pdf:
-                cached_pdf.write(pdf.read())
-
-            # We don't need it anymore
-            os.remove(tmp_pdf)
-
-    def _get_image(self, data, tpl):
-        for document in data['documents']:
-            img_path = os.path.join(settings.MEDIA_ROOT, document['document'])
-            # Set as image of 170mm width
-            document['document'] = InlineImage(tpl, img_path, width=Mm(170))
-        return data
+        pdf = docx_to_pdf(docx)
+        with cache.open() as cached_pdf:
+            cached_pdf.write(pdf)
 
     @cached_property
     def _document_checksum(self):
@@ -165,14 +203,6 @@ class DocumentGenerator:
 
         return hashlib.md5(content).hexdigest()
 
-    # TODO make it a function in filters.py
-    filters = {
-        'timedelta_filter': timedelta_filter,
-        'translate_filter': translate_filter,
-        'todate_filter': todate_filter,
-        'b64_to_inlineimage': b64_to_inlineimage,
-    }
-
 
 class CachedDocument(File):
     cache_root = 'cache'
@@ -1,32 +1,82 @@
 import argparse
 import json
 import logging
+import multiprocessing
+import os
 import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
-from django.core.management import BaseCommand
+import django
+from django.apps import apps
+from django.core.management import BaseCommand, CommandError
 from django.utils.translation import ugettext as _
 
-from terracommon.document_generator.helpers import DocumentGenerator
+from terracommon.document_generator.helpers import (TemplateRenderer,
+                                                    get_datamodel_data)
+from terracommon.document_generator.models import DocumentTemplate
 
 logger = logging.getLogger(__name__)
 
 
+def _render(template, output_type, profiles_dir, data):
+    """ Render a document in a worker. Return its content, or the error """
+    try:
+        # Concurrent libreoffice conversions can not share a profile
+        renderer = TemplateRenderer(
+            template,
+            libreoffice_profile=os.path.join(profiles_dir, str(os.getpid())))
+        return renderer.render(data, output_type), None
+    except Exception as e:
+        logger.exception('Document rendering failed')
+        return None, f'{e.__class__.__name__}: {e}'
+
+
 class Command(BaseCommand):
-    help = _('Completion and document file conversion')
+    help = _('Completion and document file conversion, of JSON data or of '
+             'objects')
 
-    possible_types = ['odt', 'pdf']
+    possible_types = ['docx', 'html', 'pdf']
 
     def add_arguments(self, parser):
         parser.add_argument('--template',
                             dest='template',
-                            type=argparse.FileType('rb'),
-                            default=sys.stdin,
                             required=True,
-                            help=_('ODT model to be completed'),
+                            help=_('Path, or name of the DocumentTemplate, '
+                                   'of the docx or html template to be '
+                                   'completed'),
                             )
         parser.add_argument('--data',
                             dest='data',
-                            help=_('Data to use to complete'),
+                            help=_('JSON data to use to complete'),
+                            )
+        parser.add_argument('--data-file',
+                            dest='data_file',
+                            type=argparse.FileType('r'),
+                            help=_('JSON file of the data to use to '
+                                   'complete. A list renders a document by '
+                                   'item'),
+                            )
+        parser.add_argument('--model',
+                            dest='model',
+                            help=_('Complete with objects of the model, as '
+                                   'app_label.ModelName'),
+                            )
+        parser.add_argument('--pk',
+                            dest='pk',
+                            help=_('Primary key of the object to complete '
+                                   'with'),
+                            )
+        parser.add_argument('--filter',
+                            action='append',
+                            dest='filters',
+                            default=[],
+                            help=_('Complete with the objects matching a '
+                                   'lookup, as lookup=value. Values are JSON, '
+                                   'or strings'),
                             )
         parser.add_argument('--type',
                             choices=self.possible_types,
@@ -35,29 +85,159 @@ class Command(BaseCommand):
                             dest='output_type',
                             help=_('Extension of the output file')
                             )
-        parser.add_argument('--ouput',
+        parser.add_argument('--output',
                             dest='output_path',
-                            type=argparse.FileType('wb'),
-                            default=sys.stdin,
                             required=False,
-                            help=_(''),
+                            help=_('Directory, or .zip file, of the '
+                                   'documents. A single document is written '
+                                   'on the standard output by default'),
+                            )
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=100,
+                            dest='chunk_size',
+                            help=_('Number of objects serialized at once'),
+                            )
+        parser.add_argument('--workers',
+                            type=int,
+                            default=os.cpu_count(),
+                            dest='workers',
+                            help=_('Number of processes rendering documents'),
                             )
 
     def handle(self, *args, **options):
-        dg = DocumentGenerator(options.get('template'))
+        template = self._get_template(options['template'])
+        output_type = options['output_type']
+        if output_type not in TemplateRenderer(template).output_types:
+            raise CommandError(f'{template} can not be rendered as '
+                               f'{output_type}')
+
+        items, count = self._get_items(options)
+        output_path = options.get('output_path')
+        if output_path is None and count != 1:
+            raise CommandError('--output is required for several documents')
+
+        # Workers are spawned, so they do not share the database connection
+        # of the command, which template filters can use
+        rendered, failed = 0, 0
+        with TemporaryDirectory() as profiles_dir, \
+                ProcessPoolExecutor(
+                    max_workers=options['workers'],
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup) as executor, \
+                self._get_writer(output_path) as write:
+            for chunk in self._chunks(items, options['chunk_size']):
+                names = [name for name, data in chunk]
+                results = executor.map(
+                    _render,
+                    [template] * len(chunk),
+                    [output_type] * len(chunk),
+                    [profiles_dir] * len(chunk),
+                    [data for name, data in chunk])
+
+                for name, (content, error) in zip(names, results):
+                    if error is not None:
+                        failed += 1
+                        self.stderr.write(f'{name}: {error}')
+                        continue
+
+                    write(f'{name}.{output_type}', content)
+                    rendered += 1
 
-        data = {}
-        if options.get('data'):
-            data = json.loads(options.get('data'))
+                if options['verbosity'] > 1:
+                    self.stderr.write(f'{rendered} documents rendered, '
+                                      f'{failed} failed')
+
+        if failed:
+            raise CommandError(f'{failed} of {count} documents failed')
+
+    def _get_template(self, template):
+        if os.path.isfile(template):
+            return template
+
+        try:
+            return DocumentTemplate.objects.get(
+                name=template).documenttemplate.path
+        except DocumentTemplate.DoesNotExist:
+            raise CommandError(f'Template {template} does not exist')
+        except DocumentTemplate.MultipleObjectsReturned:
+            raise CommandError(f'Several templates are named {template}')
+
+    def _get_items(self, options):
+        """ Return an iterable of (name, data) of each document, and the
+            number of documents """
+        if options['model']:
+            return self._get_objects(options)
+
+        if options['data_file']:
+            data = json.load(options['data_file'])
+        elif options['data']:
+            data = json.loads(options['data'])
         else:
             logger.warning('No data passed')
+            data = {}
+
+        if not isinstance(data, list):
+            data = [data]
+        return ((f'document_{index}', item)
+                for index, item in enumerate(data, 1)), len(data)
 
-        if options.get('output_type') == 'odt':
-            result = dg.get_odt(data=data)
-        else:  # pdf
-            result = dg.get_pdf(data=data)
+    def _get_objects(self, options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError):
+            raise CommandError(f'Unknown model {options["model"]}')
 
-        if options.get('output_path'):
-            return options.get('output_path').write(result)
+        filters = self._parse_filters(options['filters'])
+        if options['pk'] is not None:
+            filters['pk'] = options['pk']
+
+        queryset = model._default_manager.filter(**filters).order_by('pk')
+        count = queryset.count()
+        if count == 0:
+            raise CommandError('No object matches')
+
+        # Objects are read with a server-side cursor, and serialized by
+        # chunks as they are rendered
+        return ((f'{model._meta.model_name}_{obj.pk}',
+                 get_datamodel_data(obj))
+                for obj in queryset.iterator()), count
+
+    def _parse_filters(self, items):
+        """ Return the lookups of lookup=value items, whose values are JSON,
+            or strings """
+        filters = {}
+        for item in items:
+            try:
+                lookup, value = item.split('=', 1)
+            except ValueError:
+                raise CommandError('Filters are lookup=value')
+            try:
+                filters[lookup] = json.loads(value)
+            except ValueError:
+                filters[lookup] = value
+        return filters
+
+    @contextmanager
+    def _get_writer(self, output_path):
+        """ Context manager of a function writing a document """
+        if output_path is None:
+            yield lambda name, content: sys.stdout.buffer.write(content)
+        elif Path(output_path).suffix.lower() == '.zip':
+            with zipfile.ZipFile(output_path, 'w',
+                                 zipfile.ZIP_DEFLATED) as archive:
+                yield archive.writestr
         else:
-            return result
+            os.makedirs(output_path, exist_ok=True)
+            yield lambda name, content: Path(output_path,
+                                             name).write_bytes(content)
+
+    def _chunks(self, items, size):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
@@ -1,3 +1,8 @@
 import os
 
 MEDIA_ACCEL_REDIRECT = os.getenv('MEDIA_ACCEL_REDIRECT', default="False") == "True"
+
+# Directory of the files converted by libreoffice, in memory when available
+DOCUMENT_CONVERSION_DIR = os.getenv(
+    'DOCUMENT_CONVERSION_DIR',
+    default='/dev/shm' if os.path.isdir('/dev/shm') else None)
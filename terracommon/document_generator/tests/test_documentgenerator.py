@@ -1,16 +1,21 @@
 import io
+import json
 import os
+import zipfile
+from tempfile import TemporaryDirectory
 from unittest.mock import MagicMock, patch
 from uuid import uuid4
 
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
 from django.template.exceptions import \
     TemplateSyntaxError as DjangoTemplateSyntaxError
 from django.test import TestCase
 from jinja2 import TemplateSyntaxError
 from terra_accounts.tests.factories import TerraUserFactory
 
-from terracommon.document_generator.helpers import DocumentGenerator
+from terracommon.document_generator.helpers import (DocumentGenerator,
+                                                    docx_to_pdf)
 from terracommon.document_generator.models import (DocumentTemplate,
                                                    DownloadableDocument)
 from terracommon.trrequests.tests.factories import UserRequestFactory
@@ -231,3 +236,67 @@ class DocumentGeneratorTestCase(TestCase):
         self.assertTrue(os.path.isfile(pdf_path_bis))
         self.assertNotEqual(os.path.getmtime(pdf_path_bis), pdf_mtime)
         os.remove(pdf_path_bis)
+
+    def test_generate_document_command(self):
+        html_file = os.path.join(os.path.dirname(__file__),
+                                 'simple_html_template.html')
+        with open(html_file, 'rb') as read_file:
+            DocumentTemplate.objects.create(
+                name='htmltemplate',
+                documenttemplate=SimpleUploadedFile(str(uuid4()),
+                                                    read_file.read())
+            )
+        other = UserRequestFactory()
+
+        with TemporaryDirectory() as directory:
+            data_file = os.path.join(directory, 'data.json')
+            with open(data_file, 'w') as f:
+                json.dump([{'current_date': 'today'}, {}], f)
+
+            call_command('generate_document',
+                         f'--template={html_file}',
+                         f'--data-file={data_file}',
+                         '--type=html',
+                         f'--output={directory}/documents',
+                         '--workers=1')
+            with open(os.path.join(directory, 'documents',
+                                   'document_1.html')) as document:
+                self.assertEqual('<html><body>It is now today.</body></html>',
+                                 document.read())
+            self.assertTrue(os.path.isfile(
+                os.path.join(directory, 'documents', 'document_2.html')))
+
+            # Objects are rendered with their data, in a ZIP
+            archive = os.path.join(directory, 'documents.zip')
+            call_command('generate_document',
+                         '--template=htmltemplate',
+                         '--model=trrequests.UserRequest',
+                         f'--filter=pk__in=[{self.userrequest.pk}, '
+                         f'{other.pk}]',
+                         '--type=html',
+                         f'--output={archive}',
+                         '--chunk-size=1',
+                         '--workers=1')
+            with zipfile.ZipFile(archive) as documents:
+                self.assertEqual(
+                    [f'userrequest_{self.userrequest.pk}.html',
+                     f'userrequest_{other.pk}.html'],
+                    documents.namelist())
+
+            with self.assertRaises(CommandError):
+                call_command('generate_document',
+                             f'--template={self.docx_file}',
+                             '--type=html')
+
+    @patch('subprocess.run', side_effect=mock_libreoffice)
+    def test_docx_is_converted_in_conversion_dir(self, mock_run):
+        with TemporaryDirectory() as directory, \
+                self.settings(DOCUMENT_CONVERSION_DIR=directory):
+            self.assertEqual(b'some content',
+                             docx_to_pdf(io.BytesIO(b'docx')))
+
+            arguments = mock_run.call_args[0][0]
+            outdir = arguments[arguments.index('--outdir') + 1]
+            self.assertEqual(directory, os.path.dirname(outdir))
+            # Files are removed once converted
+            self.assertEqual([], os.listdir(directory))
@@ -1,9 +1,13 @@
+import base64
+import os
 from datetime import datetime, timedelta
 
 from django.test import TestCase
+from docxtpl import DocxTemplate
 
 from terracommon.datastore.models import DataStore
-from terracommon.document_generator.filters import (timedelta_filter,
+from terracommon.document_generator.filters import (b64_to_inlineimage,
+                                                    timedelta_filter,
                                                     todate_filter,
                                                     translate_filter)
 
@@ -51,3 +55,17 @@ class FilterTestCase(TestCase):
     def test_todate_filter(self):
         date_result = todate_filter(str(self.date))
         self.assertEqual(date_result, self.date.date())
+
+    def test_b64_to_inlineimage(self):
+        image_path = os.path.join(os.path.dirname(__file__), 'new_img.png')
+        with open(image_path, 'rb') as image_file:
+            image = image_file.read()
+        tpl = DocxTemplate(os.path.join(os.path.dirname(__file__),
+                                        'template_with_img.docx'))
+
+        inline_image = b64_to_inlineimage(
+            {'tpl': tpl},
+            f'data:image/png;base64,{base64.b64encode(image).decode()}')
+        # Images are decoded in memory, without temporary files
+        self.assertEqual(image, inline_image.image_descriptor.getvalue())
+        tpl.render({'logo': inline_image})
@@ -15,6 +15,7 @@ from rest_framework.response import Response
 from terra_accounts.permissions import TokenBasedPermission
 
 from terracommon.document_generator.helpers import get_media_response
+from terracommon.permissions import get_permissions_snapshot
 from terracommon.trrequests.models import UserRequest
 
 from .helpers import DocumentGenerator
@@ -33,21 +34,21 @@ class DocumentTemplateViewSets(viewsets.ModelViewSet):
         return DocumentTemplate.objects.none()
 
     def create(self, request, *args, **kwargs):
-        if not request.user.has_perm(
+        if not get_permissions_snapshot(request).has_perm(
                 'document_generator.can_upload_template'):
             raise PermissionDenied
 
         return super().create(request, *args, **kwargs)
 
     def update(self, request, *args, **kwargs):
-        if not request.user.has_perm(
+        if not get_permissions_snapshot(request).has_perm(
                 'document_generator.can_update_template'):
             raise PermissionDenied
 
         return super().update(request, *args, **kwargs)
 
     def destroy(self, request, *args, **kwargs):
-        if not request.user.has_perm(
+        if not get_permissions_snapshot(request).has_perm(
                 'document_generator.can_delete_template'):
             raise PermissionDenied
 
@@ -93,7 +94,8 @@ class DocumentTemplateViewSets(viewsets.ModelViewSet):
             'object_id': userrequest.pk,
         }
         if not ((request.user.is_superuser
-                 or request.user.has_perm('trrequests.can_download_all_pdf')
+                 or get_permissions_snapshot(request).has_perm(
+                     'trrequests.can_download_all_pdf')
                 or request.user.downloadabledocument_set.filter(
                     **downloadable_properties).exists())):
             return Response(status=status.HTTP_404_NOT_FOUND)
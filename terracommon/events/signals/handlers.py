@@ -217,20 +217,30 @@ class TimeDeltaHandler(AbstractHandler):
 
 
 class SendNotificationHandler(AbstractHandler):
+    """
+    Notify the user. Within coalesce_window seconds, notifications of the
+    same event_code and instance update the unread one instead.
+    It defaults to the NOTIFICATIONS_COALESCE_WINDOW setting.
+    """
 
     default_settings = {
         'condition': 'True',
         'level': 'info',
         'message': "New notifications received",
         'event_code': 'default_notification',
+        'coalesce_window': None,
     }
 
     def __call__(self):
         message = self.settings['message'].format(**self.vars)
         uuid = (self.args['instance'].uuid
                 if hasattr(self.args['instance'], 'uuid') else None)
+        window = self.settings['coalesce_window']
+        if window is None:
+            window = settings.NOTIFICATIONS_COALESCE_WINDOW
 
-        self.args['user'].notifications.create(
+        self.args['user'].notifications.coalesce_or_create(
+            int(window),
             level=self.settings.get('level'),
             message=message,
             event_code=self.settings.get('event_code'),
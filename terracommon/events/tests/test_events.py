@@ -145,6 +145,31 @@ class UserNotificationHandlerTestCase(TestCase):
             f'notification {event} {self.userrequest.owner.email}')
         self.assertEqual(notification.event_code, 'test_notification')
 
+    def test_coalesce(self):
+        args = {
+            'instance': self.userrequest,
+            'user': self.userrequest.owner,
+        }
+        settings = {
+            'message': 'notification {event}',
+            'event_code': 'test_notification',
+            'coalesce_window': 60,
+        }
+
+        for action in ('USERREQUEST_CREATED', 'USERREQUEST_STATE_CHANGED'):
+            SendNotificationHandler(action, settings, **args)()
+
+        self.assertEqual(1, self.userrequest.owner.notifications.count())
+        notification = self.userrequest.owner.notifications.first()
+        self.assertEqual(2, notification.occurrences)
+        self.assertEqual('notification USERREQUEST_STATE_CHANGED',
+                         notification.message)
+
+        # Read notifications are not updated anymore
+        self.userrequest.owner.notifications.read_all()
+        SendNotificationHandler('USERREQUEST_CREATED', settings, **args)()
+        self.assertEqual(2, self.userrequest.owner.notifications.count())
+
 
 class SetGroupHandlerTestCase(TestCase):
 
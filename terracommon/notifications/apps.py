@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class NotificationsConfig(AppConfig):
     name = 'terracommon.notifications'
+
+    def ready(self):
+        from . import checks, signals  # noqa
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def check_stream_settings(app_configs, **kwargs):
+    if (settings.NOTIFICATIONS_STREAM_KEEPALIVE
+            >= settings.NOTIFICATIONS_STREAM_DURATION):
+        return [Error(
+            'NOTIFICATIONS_STREAM_KEEPALIVE must be lower than '
+            'NOTIFICATIONS_STREAM_DURATION',
+            hint='Idle streams would be polled, instead of kept alive',
+            id='notifications.E001',
+        )]
+    return []
@@ -0,0 +1,58 @@
+import select
+
+from django.db import connection
+
+REVISION_SEQUENCE = 'notifications_revision_seq'
+
+
+def get_next_revision():
+    """ Next revision of a notification, bumped each time it changes """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(%s)', [REVISION_SEQUENCE])
+        return cursor.fetchone()[0]
+
+
+def get_channel(user_id):
+    """ Postgres channel notified of the new notifications of a user """
+    return f'notifications_{user_id}'
+
+
+def notify(notification):
+    """ Notify listeners of the user of a new or changed notification, once
+        the transaction is committed """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)',
+                       [get_channel(notification.user_id),
+                        str(notification.pk)])
+
+
+class NotificationsListener:
+    """
+    Listen to a Postgres channel, on its own connection since it stays open
+    as long as the listener is used.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = connection.get_new_connection(
+            connection.get_connection_params())
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            # Channels are identifiers, not values
+            cursor.execute(f'LISTEN "{self.channel}"')
+        return self
+
+    def __exit__(self, *args):
+        self.connection.close()
+
+    def wait(self, timeout):
+        """ Whether the channel was notified before the timeout """
+        if not select.select([self.connection], [], [], timeout)[0]:
+            return False
+
+        self.connection.poll()
+        notified = bool(self.connection.notifies)
+        self.connection.notifies.clear()
+        return notified
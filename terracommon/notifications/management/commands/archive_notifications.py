@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from terracommon.notifications.models import (ArchivedNotification,
+                                              UserNotifications)
+
+
+class Command(BaseCommand):
+    help = _('Archive or purge read notifications older than a number of '
+             'days, in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--days',
+                            type=int,
+                            dest='days',
+                            default=settings.NOTIFICATIONS_RETENTION_DAYS,
+                            help=_('Age in days of the read notifications '
+                                   'to archive'),
+                            )
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=settings.NOTIFICATIONS_ARCHIVE_BATCH_SIZE,
+                            help=_('Notifications archived in each '
+                                   'transaction'),
+                            )
+        parser.add_argument('--purge',
+                            action='store_true',
+                            dest='purge',
+                            help=_('Delete notifications without archiving '
+                                   'them'),
+                            )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        archive_model = None if options['purge'] else ArchivedNotification
+
+        # Each batch is its own short transaction, so locks are not held
+        total = 0
+        while True:
+            count = UserNotifications.objects.delete_expired(
+                before, options['batch_size'], archive_model=archive_model)
+            if not count:
+                break
+            total += count
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{total} notifications done')
+
+        action = _('purged') if options['purge'] else _('archived')
+        self.stdout.write(f'{total} notifications {action}')
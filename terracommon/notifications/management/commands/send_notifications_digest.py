@@ -0,0 +1,51 @@
+from itertools import groupby
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management import BaseCommand
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from terracommon.notifications.models import UserNotifications
+
+
+class Command(BaseCommand):
+    help = _('Email each user a digest of their unread notifications not '
+             'digested yet. To be run periodically.')
+
+    def handle(self, *args, **options):
+        notifications = (
+            UserNotifications.objects.unread()
+            .filter(digested_at=None, user__is_active=True)
+            .exclude(user__email='')
+            .select_related('user')
+            .order_by('user', 'pk')
+        )
+
+        sent = 0
+        with get_connection() as connection:
+            for user, user_notifications in groupby(
+                    notifications.iterator(), key=attrgetter('user')):
+                user_notifications = list(user_notifications)
+                self._send_digest(connection, user, user_notifications)
+
+                # Marked for each user, so a failure does not send twice
+                UserNotifications.objects.filter(
+                    pk__in=[notification.pk
+                            for notification in user_notifications]
+                ).update(digested_at=timezone.now())
+                sent += 1
+
+        self.stdout.write(f'{sent} digests sent')
+
+    def _send_digest(self, connection, user, notifications):
+        subject = settings.NOTIFICATIONS_DIGEST_SUBJECT_TPL.format(
+            recipient=user, count=len(notifications))
+        body = '\n'.join(
+            settings.NOTIFICATIONS_DIGEST_LINE_TPL.format(
+                recipient=user, notification=notification)
+            for notification in notifications)
+
+        EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+                     [user.email], connection=connection).send()
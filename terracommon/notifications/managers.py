@@ -1,10 +1,88 @@
-from django.db import models
+import hashlib
+from datetime import timedelta
+
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+from .helpers import get_next_revision
 
 
 class NotificationManager(models.Manager):
 
     def read_all(self):
-        return self.update(read=True)
+        """ Mark unread notifications as read, and return their number """
+        return self.unread().update(read=True)
 
     def unread(self):
         return self.filter(read=False)
+
+    def coalesce_or_create(self, window, event_code, identifier, **fields):
+        """ Update the unread notification with the same event_code and
+            identifier, created less than window seconds ago, or create a
+            new one. Return whether it was created. """
+        if not window:
+            self.create(event_code=event_code, identifier=identifier,
+                        **fields)
+            return True
+
+        with transaction.atomic(using=self.db):
+            # Concurrent events wait for each other, so only one creates it
+            self._lock(event_code, identifier)
+            notification = self.unread().filter(
+                event_code=event_code,
+                identifier=identifier,
+                created_at__gte=timezone.now() - timedelta(seconds=window),
+            ).select_for_update().order_by('-pk').first()
+
+            if notification is None:
+                self.create(event_code=event_code, identifier=identifier,
+                            **fields)
+                return True
+
+            for name, value in fields.items():
+                setattr(notification, name, value)
+            notification.occurrences += 1
+            notification.revision = get_next_revision()
+            # Saved through the model, so that listeners are notified
+            notification.save()
+            return False
+
+    def _lock(self, event_code, identifier):
+        """ Lock notifications of an event and identifier until the end of
+            the transaction """
+        key = hashlib.md5(f'{self.model._meta.db_table}:{event_code}:'
+                          f'{identifier}'.encode()).digest()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                           [int.from_bytes(key[:8], 'big', signed=True)])
+
+    def expired(self, before):
+        """ Read notifications created before that date """
+        return self.filter(read=True, created_at__lt=before)
+
+    def delete_expired(self, before, batch_size, archive_model=None):
+        """ Delete a batch of expired notifications, and return their number.
+
+        They are copied to the table of archive_model, in the same statement.
+        Rows locked by other transactions are skipped, so they are not
+        waited for. """
+        table = self.model._meta.db_table
+
+        with transaction.atomic(using=self.db):
+            batch, params = (
+                self.expired(before).order_by('pk').values('pk')[:batch_size]
+                .select_for_update(skip_locked=True).query.sql_with_params())
+            deleted = f'DELETE FROM {table} WHERE id IN ({batch})'
+
+            if archive_model is not None:
+                columns = ', '.join(
+                    field.column for field in self.model._meta.concrete_fields)
+                deleted = (
+                    f'WITH deleted AS ({deleted} RETURNING {columns}) '
+                    f'INSERT INTO {archive_model._meta.db_table} '
+                    f'({columns}, archived_at) '
+                    f'SELECT {columns}, now() FROM deleted')
+
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(deleted, params)
+                return cursor.rowcount
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0002_auto_20181120_1059'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usernotifications',
+            index=models.Index(condition=models.Q(read=False), fields=['user'], name='notifications_unread_user'),
+        ),
+    ]
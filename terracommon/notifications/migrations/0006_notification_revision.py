@@ -0,0 +1,46 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:55
+
+from django.db import migrations, models
+
+import terracommon.notifications.helpers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0005_notification_occurrences_digested_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE SEQUENCE notifications_revision_seq',
+            'DROP SEQUENCE notifications_revision_seq',
+        ),
+        migrations.AddField(
+            model_name='archivednotification',
+            name='revision',
+            field=models.BigIntegerField(default=terracommon.notifications.helpers.get_next_revision),
+        ),
+        migrations.AddField(
+            model_name='usernotifications',
+            name='revision',
+            field=models.BigIntegerField(default=terracommon.notifications.helpers.get_next_revision),
+        ),
+        # Existing notifications keep their id, which streams used as
+        # Last-Event-ID, and new revisions follow them
+        migrations.RunSQL(
+            '''
+            UPDATE notifications_usernotifications SET revision = id;
+            UPDATE notifications_archivednotification SET revision = id;
+            SELECT setval('notifications_revision_seq', GREATEST(
+                (SELECT MAX(id) FROM notifications_usernotifications),
+                (SELECT MAX(id) FROM notifications_archivednotification),
+                1));
+            ''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='usernotifications',
+            index=models.Index(fields=['user', 'revision'], name='notifications_user_revision'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import Q
 
+from .helpers import get_next_revision
 from .managers import NotificationManager
 
 UserModel = get_user_model()
@@ -14,19 +16,54 @@ LEVELS = (
 )
 
 
-class UserNotifications(models.Model):
-    user = models.ForeignKey(UserModel,
-                             on_delete=models.PROTECT,
-                             related_name='notifications')
-    created_at = models.DateTimeField(auto_now_add=True)
+class BaseNotification(models.Model):
     read = models.BooleanField(default=False)
     level = models.CharField(choices=LEVELS, max_length=255, blank=False)
     event_code = models.CharField(max_length=255)
     message = models.TextField(blank=True)
     identifier = models.IntegerField()
     uuid = models.UUIDField(null=True)
+    # Number of notifications coalesced into this one
+    occurrences = models.PositiveIntegerField(default=1)
+    # When the notification was sent in a digest email
+    digested_at = models.DateTimeField(null=True)
+    # Bumped each time the notification changes, so streams catch up on
+    # changed notifications too
+    revision = models.BigIntegerField(default=get_next_revision)
+
+    class Meta:
+        abstract = True
+
+
+class UserNotifications(BaseNotification):
+    user = models.ForeignKey(UserModel,
+                             on_delete=models.PROTECT,
+                             related_name='notifications')
+    created_at = models.DateTimeField(auto_now_add=True)
 
     objects = NotificationManager()
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            # Only unread notifications are counted and updated by users
+            models.Index(fields=['user'], name='notifications_unread_user',
+                         condition=Q(read=False)),
+            # Streams catch up on the revisions of a user
+            models.Index(fields=['user', 'revision'],
+                         name='notifications_user_revision'),
+        ]
+
+
+class ArchivedNotification(BaseNotification):
+    """ Old notifications, moved out of UserNotifications by the
+        archive_notifications command. They keep their ids. """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(UserModel,
+                             on_delete=models.PROTECT,
+                             related_name='archived_notifications')
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
@@ -0,0 +1,25 @@
+# Seconds a notifications stream stays open. Clients then reconnect, and get
+# what they missed with the Last-Event-ID header. Each open stream holds a
+# worker and a listening database connection, so streams require async
+# workers, like gunicorn's gevent worker class.
+NOTIFICATIONS_STREAM_DURATION = 300
+
+# Seconds between keepalive comments of idle notifications streams. It must
+# be lower than NOTIFICATIONS_STREAM_DURATION.
+NOTIFICATIONS_STREAM_KEEPALIVE = 15
+
+# Days read notifications are kept before the archive_notifications command
+# moves them to the archive
+NOTIFICATIONS_RETENTION_DAYS = 90
+
+# Notifications archived in each transaction of archive_notifications
+NOTIFICATIONS_ARCHIVE_BATCH_SIZE = 1000
+
+# Seconds during which notifications with the same event code and identifier
+# are coalesced into the unread one of the user. 0 disables coalescing.
+NOTIFICATIONS_COALESCE_WINDOW = 0
+
+# Emails of the send_notifications_digest command, formatted with the
+# recipient user and the count of notifications, and each notification
+NOTIFICATIONS_DIGEST_SUBJECT_TPL = '{count} new notifications'
+NOTIFICATIONS_DIGEST_LINE_TPL = '{notification.message}'
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .helpers import notify
+from .models import UserNotifications
+
+
+@receiver(post_save, sender=UserNotifications)
+def notify_new_notification(sender, instance, **kwargs):
+    # Changed notifications are sent again, with their new revision
+    notify(instance)
@@ -1,8 +1,17 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from io import StringIO
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from terracommon.notifications.checks import check_stream_settings
+
 from .factories import UserFactory
 
 
@@ -26,3 +35,139 @@ class NotificationsTestCase(TestCase):
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
         self.assertTrue(self.user.notifications.first().read)
+        self.assertEqual(1, response.json()['count'])
+
+    def test_unread_count(self):
+        for read in (True, False, False):
+            self.user.notifications.create(level='INFO',
+                                           event_code='test_code',
+                                           identifier=42,
+                                           read=read)
+        url = reverse('notifications:notifications-unread-count')
+
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(2, response.json()['count'])
+
+        response = self.client.get(
+            reverse('notifications:notifications-read-all'))
+        self.assertEqual(2, response.json()['count'])
+        self.assertEqual(0, self.client.get(url).json()['count'])
+
+    @override_settings(NOTIFICATIONS_STREAM_DURATION=0)
+    def test_stream(self):
+        notifications = [
+            self.user.notifications.create(level='INFO',
+                                           event_code='test_code',
+                                           identifier=identifier)
+            for identifier in range(3)
+        ]
+        url = reverse('notifications:notifications-stream')
+
+        response = self.client.get(url, {'since': notifications[0].revision},
+                                   HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        events = [
+            dict(line.split(': ', 1) for line in event.splitlines())
+            for event in b''.join(response.streaming_content).decode().split(
+                '\n\n') if event
+        ]
+        self.assertEqual([str(notification.revision)
+                          for notification in notifications[1:]],
+                         [event['id'] for event in events])
+        self.assertEqual(1, json.loads(events[0]['data'])['identifier'])
+
+        # Reconnections resume after the last received event
+        response = self.client.get(url, HTTP_ACCEPT='text/event-stream',
+                                   HTTP_LAST_EVENT_ID=events[-1]['id'])
+        self.assertEqual(b'', b''.join(response.streaming_content))
+
+    @override_settings(NOTIFICATIONS_STREAM_DURATION=0)
+    def test_stream_coalesced(self):
+        fields = {'level': 'INFO', 'event_code': 'test_code',
+                  'identifier': 42}
+        self.assertTrue(self.user.notifications.coalesce_or_create(
+            60, message='first', **fields))
+        notification = self.user.notifications.get()
+        url = reverse('notifications:notifications-stream')
+
+        # Coalesced notifications are sent again to reconnecting clients
+        self.assertFalse(self.user.notifications.coalesce_or_create(
+            60, message='second', **fields))
+        response = self.client.get(
+            url, HTTP_ACCEPT='text/event-stream',
+            HTTP_LAST_EVENT_ID=str(notification.revision))
+        event = dict(
+            line.split(': ', 1)
+            for line in b''.join(response.streaming_content).decode()
+            .splitlines() if line)
+        notification.refresh_from_db()
+        self.assertEqual(str(notification.revision), event['id'])
+        data = json.loads(event['data'])
+        self.assertEqual(notification.pk, data['id'])
+        self.assertEqual('second', data['message'])
+        self.assertEqual(2, data['occurrences'])
+
+    @override_settings(NOTIFICATIONS_STREAM_DURATION=10,
+                       NOTIFICATIONS_STREAM_KEEPALIVE=15)
+    def test_stream_settings_check(self):
+        self.assertEqual(['notifications.E001'],
+                         [error.id for error in check_stream_settings(None)])
+
+    def test_archive_notifications(self):
+        for read in (True, True, False):
+            self.user.notifications.create(level='INFO',
+                                           event_code='test_code',
+                                           identifier=42,
+                                           read=read)
+        recent = self.user.notifications.create(level='INFO',
+                                                event_code='test_code',
+                                                identifier=42,
+                                                read=True)
+        self.user.notifications.exclude(pk=recent.pk).update(
+            created_at=timezone.now() - timedelta(days=31))
+
+        call_command('archive_notifications', days=30, batch_size=1,
+                     stdout=StringIO())
+
+        # Only old read notifications are archived
+        self.assertEqual(2, self.user.notifications.count())
+        self.assertFalse(self.user.notifications.filter(
+            read=True, created_at__lt=recent.created_at).exists())
+        self.assertEqual(2, self.user.archived_notifications.count())
+        self.assertTrue(all(
+            notification.created_at < recent.created_at
+            for notification in self.user.archived_notifications.all()))
+
+        self.user.notifications.update(
+            read=True, created_at=timezone.now() - timedelta(days=31))
+        call_command('archive_notifications', days=30, purge=True,
+                     stdout=StringIO())
+        self.assertEqual(0, self.user.notifications.count())
+        self.assertEqual(2, self.user.archived_notifications.count())
+
+    @override_settings(
+        NOTIFICATIONS_DIGEST_SUBJECT_TPL='{count} notifications',
+        NOTIFICATIONS_DIGEST_LINE_TPL='{notification.message} '
+                                      '({notification.occurrences})')
+    def test_notifications_digest(self):
+        for message in ('first', 'second'):
+            self.user.notifications.create(level='INFO',
+                                           event_code='test_code',
+                                           identifier=42,
+                                           message=message)
+        self.user.notifications.create(level='INFO',
+                                       event_code='test_code',
+                                       identifier=42,
+                                       read=True)
+
+        call_command('send_notifications_digest', stdout=StringIO())
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual([self.user.email], mail.outbox[0].to)
+        self.assertEqual('2 notifications', mail.outbox[0].subject)
+        self.assertEqual('first (1)\nsecond (1)', mail.outbox[0].body)
+
+        # Notifications are only sent in one digest
+        call_command('send_notifications_digest', stdout=StringIO())
+        self.assertEqual(1, len(mail.outbox))
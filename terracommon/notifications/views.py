@@ -1,7 +1,16 @@
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import StreamingHttpResponse
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
+from .helpers import NotificationsListener, get_channel
+from .renderers import EventStreamRenderer
 from .serializers import UserNotificationSerializer
 
 
@@ -13,5 +22,75 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
 
     @action(detail=False, methods=['get'])
     def read_all(self, *args, **kwargs):
-        self.request.user.notifications.read_all()
-        return Response(status.HTTP_200_OK)
+        count = self.request.user.notifications.read_all()
+        return Response({'count': count}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='unread-count',
+            url_name='unread-count')
+    def unread_count(self, request):
+        """ Number of unread notifications of the user """
+        return Response({'count': request.user.notifications.unread().count()})
+
+    @action(detail=False, methods=['get'],
+            renderer_classes=(EventStreamRenderer, ))
+    def stream(self, request):
+        """ Server-Sent Events of the new and changed notifications of the
+        user, identified by their revision
+
+        Notifications changed after the revision of the Last-Event-ID header,
+        or of the since query parameter, are sent first, so reconnecting
+        clients miss none.
+        """
+        since = request.META.get('HTTP_LAST_EVENT_ID',
+                                 request.query_params.get('since'))
+        if since is None:
+            since = self.get_queryset().order_by('-revision').values_list(
+                'revision', flat=True).first() or 0
+        else:
+            try:
+                since = int(since)
+            except ValueError:
+                raise ValidationError('since must be a notification revision')
+
+        response = StreamingHttpResponse(self._get_events(since),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Events must not be buffered by nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _get_events(self, since):
+        deadline = time.monotonic() + settings.NOTIFICATIONS_STREAM_DURATION
+        keepalive = settings.NOTIFICATIONS_STREAM_KEEPALIVE
+        listener = NotificationsListener(get_channel(self.request.user.pk))
+
+        # Listening starts before catching up, so nothing is missed between
+        with listener:
+            notified = True
+            while True:
+                if notified:
+                    for notification in self.get_queryset().filter(
+                            revision__gt=since).order_by('revision'):
+                        since = notification.revision
+                        yield self._get_event(notification)
+                    self._release_connection()
+                else:
+                    yield ': keepalive\n\n'
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                notified = listener.wait(min(keepalive, remaining))
+
+    @staticmethod
+    def _release_connection():
+        """ Close the connection of catch-up queries while waiting, unless a
+            transaction still uses it. Queries reopen it. """
+        if not connection.in_atomic_block:
+            connection.close()
+
+    def _get_event(self, notification):
+        data = JSONRenderer().render(
+            self.get_serializer(notification).data).decode()
+        return (f'id: {notification.revision}\nevent: notification\n'
+                f'data: {data}\n\n')
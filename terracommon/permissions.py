@@ -0,0 +1,50 @@
+from django.utils.functional import cached_property
+
+
+class PermissionsSnapshot:
+    """
+    Permissions of a user, loaded once and shared for the whole request.
+
+    Use get_permissions_snapshot(request) to get the snapshot of a user.
+    """
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def permissions(self):
+        return self.user.get_all_permissions()
+
+    @cached_property
+    def serialized_permissions(self):
+        """ Permissions as serialized by terra_accounts' user serializer """
+        if hasattr(self.user, 'get_all_terra_permissions'):
+            return list(self.user.get_all_terra_permissions())
+        return list(self.permissions)
+
+    @cached_property
+    def group_ids(self):
+        return list(self.user.groups.values_list('pk', flat=True))
+
+    def has_perm(self, perm):
+        # Same rule as User.has_perm
+        if self.user.is_active and self.user.is_superuser:
+            return True
+        return perm in self.permissions
+
+
+def get_permissions_snapshot(request, user=None):
+    """ Return the permissions snapshot of a user, by default the request's
+        one. Snapshots are kept until the end of the request. """
+    if user is None:
+        user = request.user
+    # Shared by the DRF request and the underlying django request
+    request = getattr(request, '_request', request)
+
+    if not hasattr(request, '_permissions_snapshots'):
+        request._permissions_snapshots = {}
+
+    snapshot = request._permissions_snapshots.get(user.pk)
+    if snapshot is None:
+        snapshot = PermissionsSnapshot(user)
+        request._permissions_snapshots[user.pk] = snapshot
+    return snapshot
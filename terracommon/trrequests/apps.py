@@ -1,5 +1,18 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def create_properties_indexes(sender, using, **kwargs):
+    from .indexes import sync_properties_indexes
+    from .models import UserRequest
+
+    sync_properties_indexes(connections[using], UserRequest)
 
 
 class TrrequestsConfig(AppConfig):
     name = 'terracommon.trrequests'
+
+    def ready(self):
+        from . import signals  # noqa
+        post_migrate.connect(create_properties_indexes, sender=self)
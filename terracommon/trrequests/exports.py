@@ -0,0 +1,222 @@
+import csv
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Transform
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Func
+
+# Columns of each request, before its properties
+FIELDS = ('id', 'owner', 'state', 'expiry', 'created_at', 'updated_at')
+
+# Columns of GeoPackage features, besides FIELDS
+GPKG_COLUMNS = ('fid', 'geom')
+
+# SRID of exported geometries, as GeoJSON requires
+EXPORT_SRID = 4326
+
+# GeoPackage 1.2, as PRAGMA application_id and user_version
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10200
+
+
+class Echo:
+    """ File-like object returning what is written, for csv.writer """
+    def write(self, value):
+        return value
+
+
+class UserRequestExport:
+    """
+    Export the requests of a queryset, one row per request, with the
+    geometries of its features collected.
+
+    Rows are read with a server-side cursor, and written as they are read,
+    so memory does not depend on the number of requests.
+    """
+    content_types = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+        'geojson': 'application/geo+json',
+        'gpkg': 'application/geopackage+sqlite3',
+    }
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def get_rows(self):
+        """ Yield the fields of each request, with its properties and
+            geometry """
+        # Filters joining other tables would repeat features in collections
+        queryset = (
+            self.queryset.model.objects
+            .filter(pk__in=self.queryset.values('pk'))
+            .order_by('pk')
+            .annotate(owner_name=F('owner__email'),
+                      geom=Collect(Transform('layer__features__geom',
+                                             EXPORT_SRID)))
+            .values(*FIELDS[2:], 'pk', 'owner_name', 'properties', 'geom')
+        )
+        for row in queryset.iterator():
+            row['id'], row['owner'] = row.pop('pk'), row.pop('owner_name')
+            yield row
+
+    def get_property_keys(self):
+        """ Sorted top level keys of the properties of all requests """
+        return sorted(
+            self.queryset.order_by()
+            .annotate(key=Func(F('properties'), function='jsonb_object_keys'))
+            .values_list('key', flat=True)
+            .distinct())
+
+    def get_property_columns(self, keys):
+        """ Column names of the property keys. Keys matching another
+            column, case insensitively as SQLite does, are prefixed. """
+        taken = {'', *(column.lower() for column in (*GPKG_COLUMNS, *FIELDS))}
+        columns = []
+        for key in keys:
+            column = (f'properties.{key}' if key.lower() in taken
+                      else key)
+            index = 1
+            while column.lower() in taken:
+                index += 1
+                column = f'properties.{key}_{index}'
+            taken.add(column.lower())
+            columns.append(column)
+        return columns
+
+    def flatten(self, row, keys):
+        """ Values of a row, with a column for each property """
+        properties = row['properties'] or {}
+        return [
+            *(row[field] for field in FIELDS),
+            *(value if value is None or isinstance(value, (str, int, float))
+              else json.dumps(value, cls=DjangoJSONEncoder)
+              for value in (properties.get(key) for key in keys)),
+        ]
+
+    def to_json(self, row):
+        return {**{field: row[field] for field in FIELDS},
+                'properties': row['properties']}
+
+    def csv(self):
+        keys = self.get_property_keys()
+        writer = csv.writer(Echo())
+
+        yield writer.writerow([*FIELDS, *self.get_property_columns(keys),
+                               'geometry'])
+        for row in self.get_rows():
+            yield writer.writerow([*self.flatten(row, keys),
+                                   row['geom'].wkt if row['geom'] else ''])
+
+    def ndjson(self):
+        for row in self.get_rows():
+            yield json.dumps(
+                {**self.to_json(row),
+                 'geometry': json.loads(row['geom'].json)
+                 if row['geom'] else None},
+                cls=DjangoJSONEncoder) + '\n'
+
+    def geojson(self):
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ''
+        for row in self.get_rows():
+            feature = {
+                'type': 'Feature',
+                'id': row['id'],
+                'geometry': json.loads(row['geom'].json)
+                if row['geom'] else None,
+                'properties': self.to_json(row),
+            }
+            yield separator + json.dumps(feature, cls=DjangoJSONEncoder)
+            separator = ', '
+        yield ']}'
+
+    def gpkg(self):
+        """ Return a GeoPackage file. SQLite needs a file, so it is written
+            on disk, and removed once closed. """
+        keys = self.get_property_keys()
+        fd, path = tempfile.mkstemp(suffix='.gpkg')
+        os.close(fd)
+
+        try:
+            with sqlite3.connect(path) as db:
+                self._create_gpkg(db, keys)
+                db.executemany(
+                    f'INSERT INTO userrequests VALUES '
+                    f'(NULL, ?, {", ".join("?" * (len(FIELDS) + len(keys)))})',
+                    ((self.gpkg_geometry(row['geom']),
+                      *(str(value) if value is not None
+                        and not isinstance(value, (str, int, float))
+                        else value
+                        for value in self.flatten(row, keys)))
+                     for row in self.get_rows()))
+            db.close()
+            return open(path, 'rb')
+        finally:
+            # Still readable from the returned file
+            os.unlink(path)
+
+    def _create_gpkg(self, db, keys):
+        db.execute(f'PRAGMA application_id = {GPKG_APPLICATION_ID}')
+        db.execute(f'PRAGMA user_version = {GPKG_USER_VERSION}')
+        db.execute('''
+            CREATE TABLE gpkg_spatial_ref_sys (
+                srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY,
+                organization TEXT NOT NULL,
+                organization_coordsys_id INTEGER NOT NULL,
+                definition TEXT NOT NULL, description TEXT)''')
+        db.executemany(
+            'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined',
+                 None),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined',
+                 None),
+                ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+                 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",'
+                 '6378137,298.257223563]],PRIMEM["Greenwich",0],'
+                 'UNIT["degree",0.0174532925199433]]', None),
+            ])
+        db.execute('''
+            CREATE TABLE gpkg_contents (
+                table_name TEXT NOT NULL PRIMARY KEY,
+                data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+                description TEXT DEFAULT '',
+                last_change DATETIME NOT NULL DEFAULT
+                    (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                srs_id INTEGER)''')
+        db.execute('''
+            CREATE TABLE gpkg_geometry_columns (
+                table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+                geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+                z TINYINT NOT NULL, m TINYINT NOT NULL,
+                CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))''')
+
+        columns = ', '.join(f'"{column.replace(chr(34), chr(34) * 2)}"'
+                            for column in (*FIELDS,
+                                           *self.get_property_columns(keys)))
+        db.execute(f'CREATE TABLE userrequests ('
+                   f'fid INTEGER PRIMARY KEY AUTOINCREMENT, geom BLOB, '
+                   f'{columns})')
+        db.execute("INSERT INTO gpkg_contents "
+                   "(table_name, data_type, identifier, srs_id) "
+                   f"VALUES ('userrequests', 'features', 'userrequests', "
+                   f"{EXPORT_SRID})")
+        db.execute(f"INSERT INTO gpkg_geometry_columns VALUES "
+                   f"('userrequests', 'geom', 'GEOMETRY', {EXPORT_SRID}, "
+                   f"0, 0)")
+
+    @staticmethod
+    def gpkg_geometry(geom):
+        """ GeoPackage binary of a geometry: a header without envelope,
+            followed by its WKB """
+        if geom is None:
+            return None
+        # Version 0, little endian header, standard binary and no envelope
+        return (b'GP' + struct.pack('<BBi', 0, 0b00000001, EXPORT_SRID)
+                + bytes(geom.wkb))
@@ -0,0 +1,138 @@
+import mercantile
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Polygon
+from django.db.models import Exists, OuterRef
+from django.db.models.expressions import OrderBy, RawSQL
+from django.db.models.functions import Lower
+from geostore.models import Feature
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from terra_utils.filters import JSONFieldOrderingFilter
+
+from .indexes import get_indexed_properties, properties_expression
+
+
+class PropertiesFilterBackend(BaseFilterBackend):
+    """
+    Filter on properties with properties__<path>=<value> query params.
+
+    Indexed properties paths are compared on the text expression of their
+    index, others are filtered by containment, which is served by the GIN
+    index of properties but only matches string values.
+    """
+    prefix = 'properties__'
+
+    def filter_queryset(self, request, queryset, view):
+        indexed = get_indexed_properties()
+
+        for param, value in request.query_params.items():
+            if not param.startswith(self.prefix):
+                continue
+
+            path = tuple(param[len(self.prefix):].split('__'))
+            if path in indexed:
+                alias = f'indexed_{"_".join(path)}'
+                queryset = queryset.annotate(
+                    **{alias: properties_expression(path)}
+                ).filter(**{alias: value})
+            else:
+                contains = value
+                for key in reversed(path):
+                    contains = {key: contains}
+                queryset = queryset.filter(properties__contains=contains)
+
+        return queryset
+
+
+class IndexedJSONFieldOrderingFilter(JSONFieldOrderingFilter):
+    """
+    Order on indexed properties paths with the expressions of their indexes,
+    other fields keep the JSONFieldOrderingFilter behavior.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not ordering:
+            return ordering
+
+        indexed = get_indexed_properties()
+        return [self._get_indexed_term(term, indexed) for term in ordering]
+
+    def _get_indexed_term(self, term, indexed):
+        expression = getattr(term, 'expression', None)
+
+        if (isinstance(expression, RawSQL)
+                and expression.sql.startswith('lower(properties->>')
+                and tuple(expression.params) in indexed):
+            return OrderBy(Lower(properties_expression(expression.params)),
+                           descending=term.descending)
+        return term
+
+
+class SpatialFilterBackend(BaseFilterBackend):
+    """
+    Filter requests having a feature of their layer in a geometry.
+
+    in_bbox: xmin,ymin,xmax,ymax
+    intersects: a GeoJSON geometry
+    tile: z/x/y
+
+    Coordinates are WGS84, unless a GeoJSON geometry gives its crs.
+    Features are looked up by layer and geometry, which is served by the
+    geostore GiST index on (layer, geom).
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for param, parser in (('in_bbox', self.parse_bbox),
+                              ('intersects', self.parse_geometry),
+                              ('tile', self.parse_tile)):
+            value = request.query_params.get(param)
+            if value:
+                queryset = self.filter_geometry(queryset, parser(value))
+
+        return queryset
+
+    def filter_geometry(self, queryset, geometry):
+        srid = Feature._meta.get_field('geom').srid
+        if geometry.srid != srid:
+            geometry.transform(srid)
+        features = Feature.objects.filter(layer=OuterRef('layer'),
+                                          geom__intersects=geometry)
+        return queryset.annotate(
+            in_geometry=Exists(features)
+        ).filter(in_geometry=True)
+
+    @staticmethod
+    def parse_bbox(value):
+        try:
+            bbox = Polygon.from_bbox([float(v) for v in value.split(',')])
+        except (ValueError, TypeError):
+            raise ValidationError(
+                'in_bbox must be "xmin,ymin,xmax,ymax" format')
+        bbox.srid = 4326
+        return bbox
+
+    @staticmethod
+    def parse_geometry(value):
+        try:
+            geometry = GEOSGeometry(value)
+        except (GDALException, GEOSException, ValueError):
+            raise ValidationError('intersects must be a GeoJSON geometry')
+
+        if geometry.srid is None:
+            geometry.srid = 4326
+        return geometry
+
+    @staticmethod
+    def parse_tile(value):
+        try:
+            z, x, y = (int(v) for v in value.split('/'))
+        except ValueError:
+            raise ValidationError('tile must be "z/x/y" format')
+        if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValidationError(f'tile {value} does not exist')
+
+        bounds = mercantile.bounds(x, y, z)
+        tile = Polygon.from_bbox(bounds)
+        tile.srid = 4326
+        return tile
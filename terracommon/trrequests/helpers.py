@@ -1,5 +1,13 @@
 import datetime
+import json
 import os
+import uuid
+
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.db import transaction
+from geostore.models import Feature
+
+from .tiles import invalidate_tiles
 
 
 def rename_comment_attachment(instance, filename):
@@ -8,3 +16,86 @@ def rename_comment_attachment(instance, filename):
     ur_month = ur.created_at.month
     return os.path.join(f'userrequests/{ur_year}/{ur_month:02d}/{ur.pk}',
                         f'comment_{datetime.date.today():%d}')
+
+
+def feature_hash(feature):
+    return (bytes(feature.geom.wkb),
+            json.dumps(feature.properties, sort_keys=True))
+
+
+def features_from_geojson(layer, geojson):
+    """ Return unsaved features of a GeoJSON FeatureCollection """
+    projection = geojson.get('crs', {}).get('properties', {}).get('name')
+    if projection and not layer.is_projection_allowed(projection):
+        raise GEOSException(f'GeoJSON projection {projection} is not allowed')
+
+    return [
+        Feature(layer=layer,
+                identifier=data.get('id') or uuid.uuid4(),
+                geom=geometry_from_geojson(data.get('geometry')),
+                properties=data.get('properties') or {})
+        for data in geojson.get('features', [])
+    ]
+
+
+def geometry_from_geojson(geometry):
+    """ Return a GeoJSON geometry in the SRID of stored features, so that
+        they can be compared """
+    geom = GEOSGeometry(json.dumps(geometry))
+    if geom.srid is None:
+        geom.srid = 4326
+    srid = Feature._meta.get_field('geom').srid
+    if geom.srid != srid:
+        geom.transform(srid)
+    return geom
+
+
+@transaction.atomic
+def update_layer_from_geojson(layer, geojson):
+    """
+    Apply the differences between a GeoJSON FeatureCollection and the
+    features of a layer.
+
+    Incoming features are matched with the stored ones by identifier if they
+    have an id, else by geometry and properties. Only new, modified and
+    removed features are written.
+    Return True if the layer was modified.
+    """
+    stored = {feature.identifier: feature for feature in layer.features.all()}
+    stored_hashes = {
+        feature_hash(feature): identifier
+        for identifier, feature in stored.items()
+    }
+
+    created, updated = [], []
+    for data, feature in zip(geojson.get('features', []),
+                             features_from_geojson(layer, geojson)):
+        identifier = data.get('id')
+
+        if identifier is not None and str(identifier) in stored:
+            stored_feature = stored.pop(str(identifier))
+            if feature_hash(stored_feature) != feature_hash(feature):
+                stored_feature.geom = feature.geom
+                stored_feature.properties = feature.properties
+                updated.append(stored_feature)
+            continue
+
+        identifier = stored_hashes.pop(feature_hash(feature), None)
+        if identifier in stored:
+            # Same feature, nothing to write
+            del stored[identifier]
+        else:
+            created.append(feature)
+
+    if stored:
+        layer.features.filter(
+            pk__in=[feature.pk for feature in stored.values()]
+        ).delete()
+    for feature in updated:
+        feature.save()
+    if created:
+        Feature.objects.bulk_create(created)
+        # bulk_create does not send the signals invalidating tiles
+        invalidate_tiles()
+
+    return bool(stored or updated or created)
@@ -0,0 +1,91 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Func, TextField
+
+INDEX_PREFIX = 'trrequests_props_'
+
+PROPERTY_KEY_REGEX = re.compile(r'^\w+$')
+
+
+def parse_properties_paths(paths):
+    """ Return properties paths, in filters notation, as tuples of keys """
+    parsed = []
+    for path in paths:
+        keys = tuple(path.split('__'))
+        if not all(PROPERTY_KEY_REGEX.match(key) for key in keys):
+            raise ImproperlyConfigured(f'Invalid property path: {path}')
+        parsed.append(keys)
+    return parsed
+
+
+def get_indexed_properties():
+    return parse_properties_paths(settings.REQUEST_INDEXED_PROPERTIES)
+
+
+def properties_sql(path, column='properties'):
+    """ Return the SQL of the text value of a properties path. Keys are
+        always object keys, even digit-only ones which KeyTransform reads as
+        array indexes. """
+    return f"({column} #>> '{{{','.join(path)}}}')"
+
+
+class PropertiesPath(Func):
+    """ Text value of a properties path, as written in the database
+        indexes by properties_sql """
+    output_field = TextField()
+
+    def __init__(self, path, expression='properties'):
+        super().__init__(expression)
+        self.path = path
+
+    def as_sql(self, compiler, connection):
+        column, params = compiler.compile(self.source_expressions[0])
+        return properties_sql(self.path, column), params
+
+
+def properties_expression(path):
+    """ Return the text expression of a properties path, as written in the
+        database indexes """
+    return PropertiesPath(tuple(path))
+
+
+def get_properties_indexes():
+    indexes = {}
+    for path in get_indexed_properties():
+        expression = properties_sql(path)
+        # Indexes are named by their expression, so that indexes written
+        # by another version are replaced
+        name = INDEX_PREFIX + hashlib.md5(
+            expression.encode()).hexdigest()[:12]
+
+        # Used by filters on the property
+        indexes[name] = f'({expression})'
+        # Used by lists filtered by state and ordered by the property
+        indexes[f'{name}_state'] = f'(state, lower({expression}))'
+    return indexes
+
+
+def sync_properties_indexes(connection, model):
+    """ Create indexes of REQUEST_INDEXED_PROPERTIES and drop the ones
+        which are not configured anymore """
+    table = model._meta.db_table
+    indexes = get_properties_indexes()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+            [table, ])
+        existing = {name for name, in cursor.fetchall()
+                    if name.startswith(INDEX_PREFIX)}
+
+        for name in existing - indexes.keys():
+            cursor.execute(
+                f'DROP INDEX IF EXISTS {connection.ops.quote_name(name)}')
+
+        for name in indexes.keys() - existing:
+            cursor.execute(
+                f'CREATE INDEX {connection.ops.quote_name(name)} '
+                f'ON {connection.ops.quote_name(table)} {indexes[name]}')
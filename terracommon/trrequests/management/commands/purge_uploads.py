@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from terracommon.trrequests.models import Upload
+
+
+class Command(BaseCommand):
+    help = _('Delete the uploads without new chunks for a number of hours, '
+             'with their staged parts')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours',
+                            type=int,
+                            dest='hours',
+                            default=settings.REQUEST_UPLOAD_EXPIRY_HOURS,
+                            help=_('Hours since the last chunk of the '
+                                   'uploads to delete'),
+                            )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(hours=options['hours'])
+        count = Upload.objects.purge_expired(before)
+        self.stdout.write(f'{count} uploads purged')
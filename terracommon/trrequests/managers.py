@@ -0,0 +1,239 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import (Case, Count, Exists, ExpressionWrapper, F, Func,
+                              IntegerField, OuterRef, Q, QuerySet, Subquery,
+                              Sum, Value, When)
+from django.db.models.functions import Coalesce
+from terra_accounts.models import ReadModel
+
+from . import models as tr_models
+
+
+def get_visible_counters(permissions):
+    """ Return the counters of comments allowed by the permissions snapshot
+        of a user, as UserRequest.get_comments_for_user filters them """
+    counters = []
+
+    if permissions.has_perm('trrequests.can_internal_comment_requests'):
+        counters.append(('internal_count', 'internal_unread'))
+
+    if (permissions.has_perm('trrequests.can_comment_requests')
+            or permissions.has_perm('trrequests.can_read_comment_requests')):
+        counters.append(('public_count', 'public_unread'))
+
+    return counters
+
+
+def get_readers(userrequest=None, user_ids=()):
+    """ Return the users allowed to read all requests, the owner and
+        reviewers of the request if given, and the users of user_ids """
+    permission = Permission.objects.filter(
+        content_type__app_label='trrequests',
+        codename='can_read_all_requests')
+    readers = (Q(is_superuser=True)
+               | Q(user_permissions__in=permission)
+               | Q(groups__permissions__in=permission)
+               | Q(pk__in=user_ids))
+    if userrequest is not None:
+        readers |= (Q(pk=userrequest.owner_id)
+                    | Q(pk__in=userrequest.reviewers.values('pk')))
+    return get_user_model().objects.filter(readers, is_active=True).distinct()
+
+
+class CommentCounterQuerySet(QuerySet):
+    """
+    Counters are created with the requests, for their owners, and when a
+    user reads a request, is added as reviewer, or a comment is posted.
+    Requests without comments need no counters, so other readers have none
+    until the first comment. Existing counters are never recomputed.
+    """
+    def create_empty(self, userrequests):
+        """ Create the counters of the owners of new requests, which have no
+            comments """
+        self.bulk_create([
+            self.model(user_id=userrequest.owner_id, userrequest=userrequest)
+            for userrequest in userrequests
+        ], ignore_conflicts=True)
+
+    def add_readers(self, userrequest, users):
+        """ Create the missing counters of these users for a request, whose
+            counts are aggregated in a single query """
+        last_read = ReadModel.objects.filter(
+            user=OuterRef('pk'),
+            contenttype=ContentType.objects.get_for_model(
+                tr_models.UserRequest),
+            identifier=userrequest.pk,
+        ).values('last_read')[:1]
+        comments = (tr_models.Comment.objects
+                    .filter(userrequest=userrequest)
+                    .order_by())
+
+        def count(**filters):
+            return Subquery(comments.filter(**filters).annotate(
+                count=Func(F('pk'), function='COUNT')).values('count'),
+                output_field=IntegerField())
+
+        def unread(is_internal):
+            # Users who never read it have a null last_read, so no comment
+            # is read
+            return ExpressionWrapper(
+                count(is_internal=is_internal)
+                - count(is_internal=is_internal,
+                        updated_at__lte=OuterRef('last_read')),
+                output_field=IntegerField())
+
+        missing = (
+            users
+            .exclude(pk__in=self.filter(
+                userrequest=userrequest).values('user_id'))
+            .annotate(last_read=Subquery(last_read))
+            .annotate(public_count=count(is_internal=False),
+                      internal_count=count(is_internal=True),
+                      public_unread=unread(False),
+                      internal_unread=unread(True))
+            .values_list('pk', 'public_count', 'internal_count',
+                         'public_unread', 'internal_unread')
+        )
+
+        self.bulk_create([
+            self.model(user_id=pk,
+                       userrequest=userrequest,
+                       public_count=public_count,
+                       internal_count=internal_count,
+                       public_unread=public_unread,
+                       internal_unread=internal_unread)
+            for (pk, public_count, internal_count,
+                 public_unread, internal_unread) in missing
+        ], ignore_conflicts=True)
+
+    def initialize(self, user, userrequests):
+        """ Create the missing counters of the user for these requests. A
+            counter created concurrently is kept. """
+        last_read = ReadModel.objects.filter(
+            user=user,
+            contenttype=ContentType.objects.get_for_model(
+                tr_models.UserRequest),
+            identifier=OuterRef('pk'),
+        ).values('last_read')[:1]
+
+        unread = (Q(last_read__isnull=True)
+                  | Q(comments__updated_at__gt=F('last_read')))
+        missing = (
+            tr_models.UserRequest.objects
+            .filter(pk__in=userrequests.values('pk'))
+            .exclude(comment_counters__user=user)
+            .annotate(last_read=Subquery(last_read))
+            .annotate(
+                public_count=Count(
+                    'comments', filter=Q(comments__is_internal=False)),
+                internal_count=Count(
+                    'comments', filter=Q(comments__is_internal=True)),
+                public_unread=Count(
+                    'comments', filter=Q(comments__is_internal=False) & unread),
+                internal_unread=Count(
+                    'comments', filter=Q(comments__is_internal=True) & unread),
+            )
+            .values_list('pk', 'public_count', 'internal_count',
+                         'public_unread', 'internal_unread')
+        )
+
+        self.bulk_create([
+            self.model(user=user,
+                       userrequest_id=pk,
+                       public_count=public_count,
+                       internal_count=internal_count,
+                       public_unread=public_unread,
+                       internal_unread=internal_unread)
+            for (pk, public_count, internal_count,
+                 public_unread, internal_unread) in missing
+        ], ignore_conflicts=True)
+
+    def with_visible_counts(self, permissions):
+        """ Annotate counters with the visible_count and unread_count of
+            comments the permissions snapshot of a user allows to see """
+        visible_count = Value(0, output_field=IntegerField())
+        unread_count = Value(0, output_field=IntegerField())
+        for count_field, unread_field in get_visible_counters(permissions):
+            visible_count += F(count_field)
+            unread_count += F(unread_field)
+
+        return self.annotate(
+            visible_count=ExpressionWrapper(visible_count,
+                                            output_field=IntegerField()),
+            unread_count=ExpressionWrapper(unread_count,
+                                           output_field=IntegerField()))
+
+    def add_comment(self, comment):
+        """ Count a new comment, as unread by everyone """
+        prefix = 'internal' if comment.is_internal else 'public'
+        self.filter(userrequest_id=comment.userrequest_id).update(**{
+            f'{prefix}_count': F(f'{prefix}_count') + 1,
+            f'{prefix}_unread': F(f'{prefix}_unread') + 1,
+        })
+
+        # Counters created from now on already count the comment
+        userrequest = comment.userrequest
+        self.add_readers(userrequest,
+                         get_readers(userrequest, [comment.owner_id]))
+
+    def mark_read(self, user, userrequest):
+        if not self.filter(user=user, userrequest=userrequest).update(
+                public_unread=0, internal_unread=0):
+            self.initialize(user, tr_models.UserRequest.objects.filter(
+                pk=userrequest.pk))
+
+    def annotate_userrequests(self, permissions, userrequests):
+        """ Annotate requests with the comments_count and
+            unread_comments_count of the user of the permissions snapshot.
+            They are 0 for requests without comments, else null for requests
+            the user has no counter of. """
+        counters = self.filter(
+            user=permissions.user,
+            userrequest=OuterRef('pk')).with_visible_counts(permissions)
+        no_comments = Case(When(has_comments=False, then=Value(0)),
+                           output_field=IntegerField())
+        return userrequests.annotate(
+            has_comments=Exists(tr_models.Comment.objects.filter(
+                userrequest=OuterRef('pk'))),
+        ).annotate(
+            comments_count=Coalesce(
+                Subquery(counters.values('visible_count')[:1]), no_comments,
+                output_field=IntegerField()),
+            unread_comments_count=Coalesce(
+                Subquery(counters.values('unread_count')[:1]), no_comments,
+                output_field=IntegerField()),
+        )
+
+    def get_unread_summary(self, permissions, userrequests):
+        """ Return the number of requests with unread comments, and the
+            number of unread comments, of the user of the permissions
+            snapshot """
+        return (
+            self.filter(user=permissions.user,
+                        userrequest__in=userrequests.values('pk'))
+                .with_visible_counts(permissions)
+                .aggregate(
+                    requests=Count('pk', filter=Q(unread_count__gt=0)),
+                    comments=Coalesce(Sum('unread_count'), 0))
+        )
+
+
+class UploadQuerySet(QuerySet):
+    def expired(self, before):
+        """ Uploads not updated since before """
+        return self.filter(updated_at__lt=before)
+
+    def purge_expired(self, before):
+        """ Delete expired uploads with their staged parts, and return their
+            number. Uploads receiving a chunk meanwhile are kept. """
+        count = 0
+        for pk in self.expired(before).values_list('pk', flat=True).iterator():
+            with transaction.atomic():
+                upload = self.select_for_update(skip_locked=True).expired(
+                    before).filter(pk=pk).first()
+                if upload is not None:
+                    upload.delete()
+                    count += 1
+        return count
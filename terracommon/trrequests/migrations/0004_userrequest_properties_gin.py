@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trrequests', '0003_auto_20181120_1059'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userrequest',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['properties'], name='trrequests_properties_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trrequests', '0005_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('public_count', models.PositiveIntegerField(default=0)),
+                ('internal_count', models.PositiveIntegerField(default=0)),
+                ('public_unread', models.PositiveIntegerField(default=0)),
+                ('internal_unread', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('userrequest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='comment_counters', to='trrequests.UserRequest')),
+            ],
+            options={
+                'unique_together': {('user', 'userrequest')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trrequests', '0006_commentcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userrequest',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
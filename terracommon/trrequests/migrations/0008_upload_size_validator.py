@@ -0,0 +1,19 @@
+# Generated by Django 2.2.5 on 2026-10-19 12:47
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trrequests', '0007_userrequest_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='upload',
+            name='size',
+            field=models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+    ]
@@ -1,6 +1,13 @@
+import uuid
+
+import magic
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.validators import MinValueValidator
 from django.db import models
 from django.db.models import Q
 from django.utils.translation import gettext_lazy as _
@@ -11,8 +18,10 @@ from terra_utils.settings import STATES
 
 from terracommon.datastore.models import RelatedDocument
 from terracommon.document_generator.models import DownloadableDocument
+from terracommon.permissions import PermissionsSnapshot
 
 from .helpers import rename_comment_attachment
+from .managers import CommentCounterQuerySet, UploadQuerySet
 
 
 class UserRequest(BaseUpdatableModel, ReadableModelMixin):
@@ -28,27 +37,38 @@ class UserRequest(BaseUpdatableModel, ReadableModelMixin):
                                        blank=True,
                                        related_name='to_review')
     properties = JSONField(default=dict, blank=True)
+    # Incremented by each update, to detect concurrent ones
+    version = models.PositiveIntegerField(default=1, editable=False)
     downloadable = GenericRelation(DownloadableDocument)
     documents = GenericRelation(RelatedDocument)
 
-    def get_comments_for_user(self, user):
+    def get_comments_for_user(self, user, permissions=None):
+        """ Comments the user is allowed to see. permissions is the
+            snapshot of the user's permissions, if already loaded. """
         query = self.comments.all()
         if not user:
             return query.none()
 
+        if permissions is None:
+            permissions = PermissionsSnapshot(user)
         filter = Q()
 
         # exclude comments if the user have no permission
-        if not user.has_perm(
+        if not permissions.has_perm(
                 'trrequests.can_internal_comment_requests'):
             filter |= Q(is_internal=True)
 
-        if (not user.has_perm('trrequests.can_comment_requests') and
-                not user.has_perm('trrequests.can_read_comment_requests')):
+        if (not permissions.has_perm('trrequests.can_comment_requests') and
+                not permissions.has_perm(
+                    'trrequests.can_read_comment_requests')):
             filter |= Q(is_internal=False)
 
         return query.exclude(filter)
 
+    def user_read(self, user):
+        super().user_read(user)
+        CommentCounter.objects.mark_read(user, self)
+
     def get_serializer(self):
         # Exceptionnally,
         # to avoid circular dependencies between model and serializer
@@ -63,6 +83,11 @@ class UserRequest(BaseUpdatableModel, ReadableModelMixin):
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            GinIndex(fields=['properties'],
+                     name='trrequests_properties_gin',
+                     opclasses=['jsonb_path_ops']),
+        ]
         permissions = (
             ('can_create_requests', 'Is able to create a new requests'),
             ('can_read_self_requests', 'Is able to get own requests'),
@@ -105,3 +130,79 @@ class Comment(BaseUpdatableModel):
 
     class Meta:
         ordering = ['id']
+
+
+class CommentCounter(models.Model):
+    """
+    Number of comments of a request, and of the ones a user has not read.
+
+    Public and internal comments are counted apart, so the comments visible
+    by the user are selected from its permissions.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE,
+                             related_name='+')
+    userrequest = models.ForeignKey(UserRequest,
+                                    on_delete=models.CASCADE,
+                                    related_name='comment_counters')
+    public_count = models.PositiveIntegerField(default=0)
+    internal_count = models.PositiveIntegerField(default=0)
+    public_unread = models.PositiveIntegerField(default=0)
+    internal_unread = models.PositiveIntegerField(default=0)
+
+    objects = models.Manager.from_queryset(CommentCounterQuerySet)()
+
+    class Meta:
+        unique_together = ('user', 'userrequest')
+
+
+class Upload(BaseUpdatableModel):
+    """
+    File uploaded by chunks, to be attached to a comment or a request.
+
+    Each chunk is staged as a part in the default storage, until the upload
+    is attached by its token. Abandoned uploads are deleted by the
+    purge_uploads command.
+    """
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL,
+                              on_delete=models.CASCADE,
+                              related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField(validators=[MinValueValidator(0)])
+    offset = models.BigIntegerField(default=0, editable=False)
+    parts = JSONField(default=list, editable=False)
+
+    objects = models.Manager.from_queryset(UploadQuerySet)()
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+
+    def add_part(self, content):
+        """ Stage a chunk, which follows the current offset """
+        name = default_storage.save(
+            f'uploads/{self.token}/{self.offset:020d}', content)
+        self.parts.append(name)
+        self.offset += content.size
+
+    def get_file(self):
+        """ Return the parts joined in a temporary file """
+        file = TemporaryUploadedFile(self.filename, None, self.size, None)
+        for name in self.parts:
+            with default_storage.open(name) as part:
+                for chunk in part.chunks():
+                    file.write(chunk)
+
+        file.seek(0)
+        file.content_type = magic.from_buffer(file.read(2048), mime=True)
+        file.seek(0)
+        return file
+
+    def delete(self, *args, **kwargs):
+        for name in self.parts:
+            default_storage.delete(name)
+        return super().delete(*args, **kwargs)
+
+    class Meta:
+        ordering = ['id']
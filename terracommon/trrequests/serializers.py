@@ -1,39 +1,164 @@
 import json
 import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
+from django.db.models import F
 from django.urls import reverse
-from geostore.models import Layer
+from geostore.models import Feature, Layer
 from geostore.serializers import GeoJSONLayerSerializer
 from rest_framework import serializers
 from terra_accounts.mixins import UserTokenGeneratorMixin
+from terra_accounts.models import ReadModel
 from terra_accounts.serializers import DeprecatedTerraUserSerializer
 from terra_utils.mixins import SerializerCurrentUserMixin
 
+from terracommon.datastore.exceptions import PreconditionFailed
+from terracommon.datastore.fields import FileBase64Field
 from terracommon.datastore.models import RelatedDocument
 from terracommon.datastore.serializers import (RelatedDocumentPDFSerializer,
                                                RelatedDocumentSerializer)
 from terracommon.document_generator.serializers import \
     DownloadableDocumentSerializer
 from terracommon.events.signals import event
+from terracommon.permissions import get_permissions_snapshot
 
-from .models import Comment, UserRequest
+from .helpers import features_from_geojson, update_layer_from_geojson
+from .models import Comment, CommentCounter, Upload, UserRequest
+from .tiles import invalidate_tiles
 
 logger = logging.getLogger(__name__)
 
 
+class RequestUserSerializer(DeprecatedTerraUserSerializer):
+    """ Users with their permissions and groups read from the snapshots of
+        the request, so they are loaded once per user """
+    groups = serializers.SerializerMethodField()
+
+    def get_snapshot(self, obj):
+        return get_permissions_snapshot(self.context['request'], obj)
+
+    def get_permissions(self, obj):
+        if 'request' not in self.context:
+            return super().get_permissions(obj)
+        return self.get_snapshot(obj).serialized_permissions
+
+    def get_groups(self, obj):
+        if 'request' not in self.context:
+            return list(obj.groups.values_list('pk', flat=True))
+        return self.get_snapshot(obj).group_ids
+
+
+class UploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Upload
+        fields = ('token', 'filename', 'size', 'offset', 'created_at')
+        read_only_fields = ('token', 'offset', 'created_at')
+
+
+class UploadField(serializers.UUIDField, SerializerCurrentUserMixin):
+    """ Complete upload of the current user, by its token """
+    def to_internal_value(self, data):
+        token = super().to_internal_value(data)
+        try:
+            upload = Upload.objects.get(token=token, owner=self.current_user)
+        except Upload.DoesNotExist:
+            raise serializers.ValidationError(f'upload {token} does not exist')
+
+        if not upload.is_complete:
+            raise serializers.ValidationError(f'upload {token} is incomplete')
+        return upload
+
+
+class RelatedDocumentURLMixin(UserTokenGeneratorMixin):
+    def get_document_url(self, obj):
+        """ Download url of the document, for the current user """
+        uidb64, token = self.get_uidb64_token_for_user(self.current_user)
+
+        return "{}?uidb64={}&token={}".format(
+            reverse('trrequests:request-document',
+                    args=[obj.object_id, obj.key]),
+            uidb64,
+            token)
+
+
+class RelatedDocumentUploadSerializer(RelatedDocumentSerializer,
+                                      RelatedDocumentURLMixin):
+    """ The document is either inline as base64, or a completed upload.
+        Documents too large to be inline are represented by their url. """
+    document = FileBase64Field(required=False)
+    upload = UploadField(write_only=True, required=False)
+
+    def validate(self, attrs):
+        if 'document' not in attrs and 'upload' not in attrs:
+            raise serializers.ValidationError(
+                'either document or upload is required')
+        return attrs
+
+    class Meta(RelatedDocumentSerializer.Meta):
+        fields = ('key', 'document', 'upload', 'properties')
+
+
+class UserRequestListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        """ Create requests, with their layers and features, in bulk.
+            Features are given by a GeoJSON layer, or by geometries. """
+        with transaction.atomic():
+            layers = Layer.objects.bulk_create([
+                Layer(name=uuid.uuid4(), schema={}) for data in validated_data
+            ])
+
+            features, instances, documents = [], [], []
+            for layer, data in zip(layers, validated_data):
+                data = dict(data)
+                features += features_from_geojson(layer, data.pop('layer', {}))
+                features += [
+                    Feature(layer=layer, identifier=uuid.uuid4(), geom=geom,
+                            properties={})
+                    for geom in data.pop('geometries', [])
+                ]
+                documents.append(data.pop('documents', []))
+                instances.append(UserRequest(layer=layer, **data))
+
+            Feature.objects.bulk_create(features)
+            instances = UserRequest.objects.bulk_create(instances)
+            # bulk_create does not send the signals creating counters
+            CommentCounter.objects.create_empty(instances)
+
+            for instance, instance_documents in zip(instances, documents):
+                self.child._update_or_create_documents(instance,
+                                                       instance_documents)
+
+            if self.child.current_user:
+                contenttype = ContentType.objects.get_for_model(UserRequest)
+                ReadModel.objects.bulk_create([
+                    ReadModel(user=self.child.current_user,
+                              contenttype=contenttype,
+                              identifier=instance.pk)
+                    for instance in instances
+                ])
+
+            # bulk_create does not send the signals invalidating tiles
+            invalidate_tiles()
+            return instances
+
+
 class UserRequestSerializer(serializers.ModelSerializer, SerializerCurrentUserMixin):
-    owner = DeprecatedTerraUserSerializer(read_only=True)
+    owner = RequestUserSerializer(read_only=True)
     geojson = GeoJSONLayerSerializer(source='layer')
-    reviewers = DeprecatedTerraUserSerializer(read_only=True, many=True)
+    reviewers = RequestUserSerializer(read_only=True, many=True)
     has_new_comments = serializers.SerializerMethodField()
     has_new_changes = serializers.SerializerMethodField()
+    # Only available on requests annotated with their comment counters
+    comments_count = serializers.IntegerField(read_only=True)
+    unread_comments_count = serializers.IntegerField(read_only=True)
     downloadables = DownloadableDocumentSerializer(read_only=True,
                                                    many=True,
                                                    source='downloadable')
-    documents = RelatedDocumentSerializer(many=True, required=False)
+    documents = RelatedDocumentUploadSerializer(many=True, required=False)
 
     def create(self, validated_data):
         with transaction.atomic():
@@ -66,32 +191,42 @@ class UserRequestSerializer(serializers.ModelSerializer, SerializerCurrentUserMi
         return layer
 
     def update(self, instance, validated_data):
-        old_properties, old_state = instance.properties, instance.state
-
-        if 'layer' in validated_data:
-            geojson = validated_data.pop('layer')
-            instance.layer.from_geojson(json.dumps(geojson), update=True)
-
-        documents = validated_data.pop('documents', [])
-        instance = super().update(instance, validated_data)
-        self._update_or_create_documents(instance, documents)
-
-        if ('state' in validated_data
-                and old_state != validated_data['state']):
-            event.send(
-                self.__class__,
-                action="USERREQUEST_STATE_CHANGED",
-                user=self.context['request'].user,
-                instance=instance,
-                old_state=old_state)
-
-        if ('properties' in validated_data
-                and old_properties != validated_data['properties']):
-            event.send(sender=self.__class__,
-                       action='USERREQUEST_PROPERTIES_CHANGED',
-                       user=self.context['request'].user,
-                       instance=instance,
-                       old_properties=old_properties)
+        with transaction.atomic():
+            # Compare and swap the version the instance was read with. The
+            # row stays locked until commit, so the old values below are the
+            # ones being replaced, without reading them again.
+            if not UserRequest.objects.filter(
+                    pk=instance.pk, version=instance.version).update(
+                        version=F('version') + 1):
+                raise PreconditionFailed()
+            instance.version += 1
+
+            old_properties, old_state = instance.properties, instance.state
+
+            if 'layer' in validated_data:
+                update_layer_from_geojson(instance.layer,
+                                          validated_data.pop('layer'))
+
+            documents = validated_data.pop('documents', [])
+            instance = super().update(instance, validated_data)
+            self._update_or_create_documents(instance, documents)
+
+            if ('state' in validated_data
+                    and old_state != validated_data['state']):
+                event.send(
+                    self.__class__,
+                    action="USERREQUEST_STATE_CHANGED",
+                    user=self.context['request'].user,
+                    instance=instance,
+                    old_state=old_state)
+
+            if ('properties' in validated_data
+                    and old_properties != validated_data['properties']):
+                event.send(sender=self.__class__,
+                           action='USERREQUEST_PROPERTIES_CHANGED',
+                           user=self.context['request'].user,
+                           instance=instance,
+                           old_properties=old_properties)
 
         try:
             instance.user_read(self.current_user)
@@ -101,9 +236,16 @@ class UserRequestSerializer(serializers.ModelSerializer, SerializerCurrentUserMi
         return instance
 
     def get_has_new_comments(self, obj):
+        if getattr(obj, 'unread_comments_count', None) is not None:
+            return obj.unread_comments_count > 0
+
         read = obj.get_user_read(self.current_user)
+        permissions = None
+        if self.current_user:
+            permissions = get_permissions_snapshot(self.context['request'],
+                                                   self.current_user)
         last_comment = obj.get_comments_for_user(
-            self.current_user).order_by('-updated_at').first()
+            self.current_user, permissions).order_by('-updated_at').first()
 
         if read is None and last_comment is not None:
             return True
@@ -117,29 +259,86 @@ class UserRequestSerializer(serializers.ModelSerializer, SerializerCurrentUserMi
         return read is None or (read.last_read < obj.updated_at)
 
     def _update_or_create_documents(self, instance, documents):
+        if not documents:
+            return
+
+        content_type = ContentType.objects.get_for_model(instance.__class__)
+        existing = {
+            related.key: related
+            for related in RelatedDocument.objects.filter(
+                key__in=[document['key'] for document in documents],
+                content_type=content_type,
+                object_id=instance.pk)
+        }
+
+        related_documents, uploads = {}, []
         for document in documents:
-            document['document'].name = document['key']
-            RelatedDocument.objects.update_or_create(
+            related = existing.get(document['key'], RelatedDocument(
                 key=document['key'],
+                content_type=content_type,
                 object_id=instance.pk,
-                content_type=ContentType.objects.get_for_model(
-                                                instance.__class__),
-                defaults={
-                    'document': document['document'],
-                }
-            )
+            ))
+            # Paths of documents use it, and threads below must not query
+            # it on their own connections
+            related.content_type = content_type
+            if 'upload' in document:
+                uploads.append(document['upload'])
+                document['document'] = document['upload'].get_file()
+            document['document'].name = document['key']
+            related.document = document['document']
+            related_documents[document['key']] = related
+
+        # Files are written to the storage in parallel, as model save would do
+        with ThreadPoolExecutor(
+                max_workers=settings.REQUEST_DOCUMENTS_WORKERS) as executor:
+            list(executor.map(
+                lambda related: related.save_document(
+                    related.document.name, related.document.file),
+                related_documents.values()))
+
+        RelatedDocument.objects.bulk_create([
+            related for related in related_documents.values()
+            if related.pk is None
+        ])
+        RelatedDocument.objects.bulk_update([
+            related for related in related_documents.values()
+            if related.pk is not None
+        ], ['document', 'size', 'digest'])
+
+        for upload in uploads:
+            transaction.on_commit(upload.delete)
 
     class Meta:
         model = UserRequest
         exclude = ('layer',)
         read_only_fields = ('owner', 'expiry', )
+        list_serializer_class = UserRequestListSerializer
+
+
+class RelatedDocumentURLSerializer(RelatedDocumentSerializer,
+                                   RelatedDocumentURLMixin):
+    url = serializers.SerializerMethodField()
+    size = serializers.SerializerMethodField()
+
+    def get_url(self, obj):
+        return self.get_document_url(obj)
+
+    def get_size(self, obj):
+        # Documents saved before sizes were stored
+        if obj.size is None:
+            return obj.document.size
+        return obj.size
+
+    class Meta(RelatedDocumentSerializer.Meta):
+        fields = ('key', 'url', 'size', 'digest', 'properties')
 
 
 class CommentSerializer(serializers.ModelSerializer,
                         UserTokenGeneratorMixin):
-    owner = DeprecatedTerraUserSerializer(read_only=True)
+    owner = RequestUserSerializer(read_only=True)
     attachment_url = serializers.SerializerMethodField()
     geojson = GeoJSONLayerSerializer(source='layer', required=False)
+    upload = UploadField(write_only=True, required=False)
 
     def get_attachment_url(self, obj):
         uidb64, token = self.get_uidb64_token_for_user(self.current_user)
@@ -170,7 +369,14 @@ class CommentSerializer(serializers.ModelSerializer,
                     'layer': layer,
                 })
 
+            upload = validated_data.pop('upload', None)
+            if upload is not None:
+                validated_data['attachment'] = upload.get_file()
+
             instance = super().create(validated_data)
+
+            if upload is not None:
+                transaction.on_commit(upload.delete)
             try:
                 instance.userrequest.user_read(self.context['request'].user)
             except AttributeError:
@@ -189,3 +395,7 @@ class CommentSerializer(serializers.ModelSerializer,
 
 class UserRequestPDFSerializer(UserRequestSerializer):
     documents = RelatedDocumentPDFSerializer(many=True, required=False)
+
+
+class UserRequestURLSerializer(UserRequestSerializer):
+    documents = RelatedDocumentURLSerializer(many=True, read_only=True)
@@ -0,0 +1,22 @@
+# Paths of UserRequest properties that get database expression indexes.
+# They use the filters notation, ie: ('date_depot', 'address__city')
+# Indexes are synchronized with this setting at each migrate.
+REQUEST_INDEXED_PROPERTIES = ()
+
+# Properties of UserRequest added to the features of vector tiles
+REQUEST_TILES_PROPERTIES = ()
+
+# Number of user requests written in each transaction of bulk operations
+REQUEST_BULK_CHUNK_SIZE = 500
+
+# Number of documents of a request written to the storage at the same time
+REQUEST_DOCUMENTS_WORKERS = 4
+
+# Hours after which uploads without new chunks are deleted by purge_uploads
+REQUEST_UPLOAD_EXPIRY_HOURS = 24
+
+# Seconds a downloaded document can be cached by the client
+REQUEST_DOCUMENTS_MAX_AGE = 3600
+
+# Cache-Control directives of the request schema, ie: {'max_age': 3600}
+REQUEST_SCHEMA_CACHE_CONTROL = {}
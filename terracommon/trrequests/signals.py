@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from geostore.models import Feature
+
+from .models import Comment, CommentCounter, UserRequest
+from .tiles import invalidate_tiles
+
+
+@receiver(post_save, sender=UserRequest)
+@receiver(post_delete, sender=UserRequest)
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+@receiver(m2m_changed, sender=UserRequest.reviewers.through)
+def invalidate_userrequest_tiles(sender, **kwargs):
+    invalidate_tiles()
+
+
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created:
+        CommentCounter.objects.add_comment(instance)
+
+
+@receiver(post_save, sender=UserRequest)
+def create_comment_counters(sender, instance, created, **kwargs):
+    if created:
+        CommentCounter.objects.create_empty([instance])
+
+
+@receiver(m2m_changed, sender=UserRequest.reviewers.through)
+def create_reviewers_comment_counters(sender, instance, action, reverse,
+                                      pk_set, **kwargs):
+    if action != 'post_add':
+        return
+
+    if reverse:
+        users = get_user_model().objects.filter(pk=instance.pk)
+        for userrequest in UserRequest.objects.filter(pk__in=pk_set):
+            CommentCounter.objects.add_readers(userrequest, users)
+    else:
+        CommentCounter.objects.add_readers(
+            instance, get_user_model().objects.filter(pk__in=pk_set))
@@ -14,6 +14,6 @@ class TestPermissionsMixin:
         self._clean_perm_cache()
 
     def _clean_perm_cache(self):
-        for cache in ['_user_perm_cache', '_perm_cache']:
+        for cache in ['_user_perm_cache', '_group_perm_cache', '_perm_cache']:
             if hasattr(self.user, cache):
                 delattr(self.user, cache)
@@ -0,0 +1,165 @@
+from django.contrib.gis.geos import GEOSGeometry, Point
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from geostore.tests.factories import FeatureFactory
+from rest_framework import status
+from rest_framework.test import APIClient
+from terra_accounts.tests.factories import TerraUserFactory
+
+from terracommon.trrequests.filters import SpatialFilterBackend
+from terracommon.trrequests.indexes import (INDEX_PREFIX,
+                                            get_properties_indexes,
+                                            properties_expression,
+                                            properties_sql,
+                                            sync_properties_indexes)
+from terracommon.trrequests.models import UserRequest
+
+from .factories import UserRequestFactory
+from .mixins import TestPermissionsMixin
+
+
+@override_settings(REQUEST_INDEXED_PROPERTIES=('date_depot',
+                                               'address__city'))
+class PropertiesFilterTestCase(TestCase, TestPermissionsMixin):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = TerraUserFactory()
+        self.client.force_authenticate(user=self.user)
+        self._set_permissions(['can_read_self_requests', ])
+
+        for date, city in (('2019-02-01', 'Paris'),
+                           ('2019-01-01', 'Lyon'),
+                           ('2019-03-01', 'Paris')):
+            UserRequestFactory(owner=self.user, properties={
+                'date_depot': date,
+                'address': {'city': city},
+                'kind': 'permit',
+            })
+
+    def _get_dates(self, **params):
+        response = self.client.get(reverse('trrequests:request-list'), params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return [r['properties']['date_depot'] for r in response.json()['results']]
+
+    def test_ordering_on_indexed_property(self):
+        self.assertListEqual(['2019-01-01', '2019-02-01', '2019-03-01'],
+                             self._get_dates(ordering='properties__date_depot'))
+        self.assertListEqual(['2019-03-01', '2019-02-01', '2019-01-01'],
+                             self._get_dates(ordering='-properties__date_depot'))
+
+    def test_filter_on_indexed_property(self):
+        self.assertListEqual(
+            ['2019-03-01', '2019-02-01'],
+            self._get_dates(**{'properties__address__city': 'Paris',
+                               'ordering': '-properties__date_depot'}))
+
+    def test_filter_on_not_indexed_property(self):
+        self.assertEqual(3, len(self._get_dates(properties__kind='permit')))
+        self.assertEqual(0, len(self._get_dates(properties__kind='other')))
+
+    @override_settings(REQUEST_INDEXED_PROPERTIES=('1', 'address__2'))
+    def test_digit_only_keys(self):
+        UserRequestFactory(owner=self.user, properties={
+            'date_depot': '2019-04-01',
+            '1': 'a',
+            'address': {'2': 'b'},
+        })
+        self.assertListEqual(['2019-04-01'],
+                             self._get_dates(properties__1='a'))
+        self.assertListEqual(['2019-04-01'],
+                             self._get_dates(properties__address__2='b'))
+
+        # Filters are written as the expressions of the indexes
+        for path in (('1', ), ('address', '2')):
+            query = str(UserRequest.objects.annotate(
+                value=properties_expression(path)).query)
+            self.assertIn(properties_sql(
+                path, '"trrequests_userrequest"."properties"'), query)
+            self.assertIn(f'({properties_sql(path)})',
+                          get_properties_indexes().values())
+
+    def test_sync_indexes(self):
+        sync_properties_indexes(connection, UserRequest)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                [UserRequest._meta.db_table, ])
+            indexes = {name for name, in cursor.fetchall()
+                       if name.startswith(INDEX_PREFIX)}
+
+        self.assertSetEqual(set(get_properties_indexes()), indexes)
+
+        with override_settings(REQUEST_INDEXED_PROPERTIES=()):
+            sync_properties_indexes(connection, UserRequest)
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                    [UserRequest._meta.db_table, ])
+                self.assertFalse([name for name, in cursor.fetchall()
+                                  if name.startswith(INDEX_PREFIX)])
+
+
+class SpatialFilterTestCase(TestCase, TestPermissionsMixin):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = TerraUserFactory()
+        self.client.force_authenticate(user=self.user)
+        self._set_permissions(['can_read_self_requests', ])
+
+        self.paris = UserRequestFactory(owner=self.user)
+        FeatureFactory(layer=self.paris.layer,
+                       geom=GEOSGeometry('POINT(2.35 48.85)', srid=4326))
+        FeatureFactory(layer=self.paris.layer,
+                       geom=GEOSGeometry('POINT(2.36 48.86)', srid=4326))
+
+        self.marseille = UserRequestFactory(owner=self.user)
+        FeatureFactory(layer=self.marseille.layer,
+                       geom=GEOSGeometry('POINT(5.37 43.29)', srid=4326))
+
+    def _get_ids(self, **params):
+        response = self.client.get(reverse('trrequests:request-list'), params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return [r['id'] for r in response.json()['results']]
+
+    def test_in_bbox(self):
+        self.assertListEqual([self.paris.pk, ],
+                             self._get_ids(in_bbox='2,48,3,49'))
+        self.assertListEqual([self.paris.pk, self.marseille.pk],
+                             self._get_ids(in_bbox='0,40,10,50'))
+        self.assertListEqual([], self._get_ids(in_bbox='-10,0,-5,10'))
+
+        # Boxes are WGS84, as tiles, whatever the internal SRID
+        with override_settings(INTERNAL_GEOMETRY_SRID=2154):
+            bbox = SpatialFilterBackend.parse_bbox('2,48,3,49')
+        self.assertEqual(4326, bbox.srid)
+
+    def test_intersects(self):
+        geometry = ('{"type": "Polygon", "coordinates": [[[5, 43], [6, 43],'
+                    ' [6, 44], [5, 44], [5, 43]]]}')
+        self.assertListEqual([self.marseille.pk, ],
+                             self._get_ids(intersects=geometry))
+
+    def test_tile(self):
+        # Tile containing Paris at zoom 10
+        self.assertListEqual([self.paris.pk, ],
+                             self._get_ids(tile='10/518/352'))
+
+        # Tiles are WGS84, whatever the internal SRID
+        with override_settings(INTERNAL_GEOMETRY_SRID=2154):
+            tile = SpatialFilterBackend.parse_tile('10/518/352')
+        self.assertEqual(4326, tile.srid)
+        self.assertTrue(tile.contains(Point(2.35, 48.85)))
+
+    def test_invalid_parameters(self):
+        for params in ({'in_bbox': '2,48'},
+                       {'intersects': 'not a geometry'},
+                       {'tile': '10/518'},
+                       {'tile': '1/2/0'},
+                       {'tile': '0/0/-1'}):
+            response = self.client.get(reverse('trrequests:request-list'),
+                                       params)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST,
+                             response.status_code)
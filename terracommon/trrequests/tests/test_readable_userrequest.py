@@ -1,4 +1,7 @@
+from django.contrib.auth.models import Permission
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -65,6 +68,81 @@ class ReadableUserRequestTestCase(TestCase, TestPermissionsMixin):
 
         self._clean_permissions()
 
+    def test_comments_counters(self):
+        self._set_permissions(['can_read_comment_requests', ])
+
+        userrequest = UserRequestFactory(owner=self.user)
+        CommentFactory(userrequest=userrequest)
+        other = UserRequestFactory(owner=self.user)
+        # Requests without comments are counted without counters
+        other.comment_counters.all().delete()
+
+        response = self.client.get(reverse('trrequests:request-list')).json()
+        self.assertListEqual(
+            [(1, 1), (0, 0)],
+            [(r['comments_count'], r['unread_comments_count'])
+             for r in response['results']])
+
+        response = self.client.get(
+            reverse('trrequests:request-unread-summary')).json()
+        self.assertDictEqual({'requests': 1, 'comments': 1}, response)
+
+        # Counters are updated on reads and new comments
+        userrequest.user_read(self.user)
+        CommentFactory(userrequest=other)
+        CommentFactory(userrequest=other)
+        CommentFactory(userrequest=other, is_internal=True)
+
+        response = self.client.get(reverse('trrequests:request-list')).json()
+        self.assertListEqual(
+            [(1, 0), (2, 2)],
+            [(r['comments_count'], r['unread_comments_count'])
+             for r in response['results']])
+        self.assertListEqual([False, True],
+                             [r['has_new_comments']
+                              for r in response['results']])
+
+        response = self.client.get(
+            reverse('trrequests:request-unread-summary')).json()
+        self.assertDictEqual({'requests': 1, 'comments': 2}, response)
+
+        self._clean_permissions()
+
+    def test_comments_counters_created_on_writes(self):
+        reader = TerraUserFactory()
+        reader.user_permissions.add(Permission.objects.get(
+            codename='can_read_all_requests'))
+        reviewer = TerraUserFactory()
+
+        # Readers get counters with the first comment
+        userrequest = UserRequestFactory(owner=self.user)
+        self.assertSetEqual(
+            {self.user.pk},
+            set(userrequest.comment_counters.values_list('user', flat=True)))
+
+        CommentFactory(userrequest=userrequest, is_internal=True)
+        userrequest.user_read(reader)
+        comment = CommentFactory(userrequest=userrequest)
+        userrequest.reviewers.add(reviewer)
+        counters = {counter.user_id: counter
+                    for counter in userrequest.comment_counters.all()}
+        self.assertSetEqual(
+            {self.user.pk, reader.pk, comment.owner_id, reviewer.pk},
+            set(counters))
+        self.assertEqual((1, 1, 1, 0),
+                         (counters[reader.pk].public_count,
+                          counters[reader.pk].internal_count,
+                          counters[reader.pk].public_unread,
+                          counters[reader.pk].internal_unread))
+        self.assertEqual((1, 1), (counters[reviewer.pk].public_unread,
+                                  counters[reviewer.pk].internal_unread))
+
+        # Reads do not write counters
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('trrequests:request-list'))
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('INSERT')])
+
     def test_new_changes(self):
         # new userrequest, never read
         userrequest = UserRequestFactory(owner=self.user)
@@ -1,22 +1,39 @@
 import base64
+import csv
+import hashlib
+import json
 import os
-from unittest.mock import MagicMock
+import sqlite3
+import tempfile
+from copy import deepcopy
+from unittest.mock import MagicMock, patch
 
 import magic
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import GEOSGeometry
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import UploadedFile
+from django.db import connection
 from django.shortcuts import resolve_url
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from geostore.models import Feature
 from geostore.tests.factories import LayerFactory
 from rest_framework import status
 from rest_framework.test import APIClient
+from terra_accounts.serializers import DeprecatedTerraUserSerializer
 from terra_accounts.tests.factories import TerraUserFactory
 from terra_utils.settings import STATES
 
+from terracommon.datastore.exceptions import PreconditionFailed
 from terracommon.datastore.models import RelatedDocument
 from terracommon.events.signals import event
+from terracommon.trrequests.helpers import (feature_hash,
+                                            features_from_geojson,
+                                            update_layer_from_geojson)
 from terracommon.trrequests.models import UserRequest
 from terracommon.trrequests.serializers import UserRequestSerializer
 
@@ -171,10 +188,56 @@ class RequestTestCase(TestCase, TestPermissionsMixin):
                          response.json().get('count'))
         self._clean_permissions()
 
+    def test_list_permissions_queries(self):
+        self._set_permissions(['can_read_self_requests', ])
+
+        def count_permissions_queries():
+            self._clean_perm_cache()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(
+                    reverse('trrequests:request-list'))
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            return len([query for query in queries
+                        if 'auth_permission' in query['sql']
+                        or 'auth_group' in query['sql']])
+
+        UserRequestFactory(owner=self.user)
+        queries_count = count_permissions_queries()
+
+        # Permissions of the owner are loaded once, whatever the number of
+        # requests serialized
+        UserRequestFactory.create_batch(4, owner=self.user)
+        self.assertEqual(queries_count, count_permissions_queries())
+        self._clean_permissions()
+
+    def test_users_payload(self):
+        self._set_permissions(['can_read_self_requests', ])
+        userrequest = UserRequestFactory(owner=self.user)
+        userrequest.reviewers.add(self.user)
+
+        response = self.client.get(reverse('trrequests:request-detail',
+                                           args=[userrequest.pk]))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        # Users are serialized as by terra_accounts
+        self._clean_perm_cache()
+        expected = DeprecatedTerraUserSerializer(self.user).data
+        for user in [response.json()['owner'],
+                     *response.json()['reviewers']]:
+            self.assertCountEqual(expected['permissions'],
+                                  user['permissions'])
+            self.assertCountEqual(expected['groups'], user['groups'])
+            self.assertEqual(expected['email'], user['email'])
+        self._clean_permissions()
+
     def test_schema(self):
         response = self.client.get(reverse('trrequests:request-schema'))
         self.assertDictEqual(settings.REQUEST_SCHEMA, response.json())
 
+        response = self.client.get(reverse('trrequests:request-schema'),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
         settings.REQUEST_SCHEMA = None
         response = self.client.get(reverse('trrequests:request-schema'))
         self.assertEqual(500, response.status_code)
@@ -223,6 +286,138 @@ class RequestTestCase(TestCase, TestPermissionsMixin):
             userrequest.layer.features.all().count()
             )
 
+    def test_geojson_incremental_update(self):
+        userrequest = UserRequestFactory(owner=self.user)
+        serializer = UserRequestSerializer()
+        serializer.update(userrequest, {'layer': self.geojson})
+        features = set(userrequest.layer.features.values_list('pk', flat=True))
+
+        # Same geojson, nothing is written
+        self.assertFalse(
+            update_layer_from_geojson(userrequest.layer, self.geojson))
+        serializer.update(userrequest, {'layer': self.geojson})
+        self.assertSetEqual(
+            features,
+            set(userrequest.layer.features.values_list('pk', flat=True)))
+
+        # Only the modified feature is replaced
+        geojson = deepcopy(self.geojson)
+        geojson['features'][2]['properties'] = {'name': 'point'}
+        serializer.update(userrequest, {'layer': geojson})
+        updated_features = set(
+            userrequest.layer.features.values_list('pk', flat=True))
+        self.assertEqual(3, len(updated_features))
+        self.assertEqual(2, len(features & updated_features))
+        self.assertTrue(userrequest.layer.features.filter(
+            properties__name='point').exists())
+
+    def test_geojson_hash_internal_srid(self):
+        layer = LayerFactory()
+        point = self.geojson['features'][2]
+        stored = Feature(
+            layer=layer,
+            geom=GEOSGeometry(json.dumps(point['geometry'])).transform(
+                2154, clone=True),
+            properties={})
+
+        # Incoming geometries are compared in the SRID of stored ones
+        with patch.object(Feature._meta.get_field('geom'), 'srid', 2154):
+            feature, = features_from_geojson(layer, {'features': [point]})
+        self.assertEqual(2154, feature.geom.srid)
+        self.assertEqual(feature_hash(stored), feature_hash(feature))
+
+    def test_bulk(self):
+        self._set_permissions(['can_create_requests',
+                               'can_read_self_requests', ])
+        userrequest = UserRequestFactory(owner=self.user)
+        handler = MagicMock()
+        event.connect(handler)
+
+        response = self.client.post(
+            reverse('trrequests:request-bulk'),
+            [
+                {'properties': {'name': 'first'}, 'geojson': self.geojson},
+                {'properties': {'name': 'second'}, 'geojson': self.geojson},
+                {'state': 'not a state', 'geojson': self.geojson},
+                {'id': userrequest.pk, 'properties': {'name': 'updated'}},
+                {'id': 0, 'properties': {}},
+            ],
+            format='json')
+        event.disconnect(handler)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        results = response.json()
+        self.assertListEqual([201, 201, 400, 200, 404],
+                             [result['status'] for result in results])
+
+        for result, name in zip(results[:2], ['first', 'second']):
+            created = UserRequest.objects.get(pk=result['id'])
+            self.assertEqual(self.user, created.owner)
+            self.assertEqual(name, created.properties['name'])
+            self.assertEqual(len(self.geojson['features']),
+                             created.layer.features.count())
+            self.assertIsNotNone(created.get_user_read(self.user))
+
+        userrequest.refresh_from_db()
+        self.assertEqual('updated', userrequest.properties['name'])
+        self.assertEqual(2, len([
+            call for call in handler.call_args_list
+            if call[1]['action'] == 'USERREQUEST_CREATED'
+        ]))
+        self._clean_permissions()
+
+    @override_settings(REQUEST_BULK_CHUNK_SIZE=2)
+    def test_bulk_invalid_geometries(self):
+        self._set_permissions(['can_create_requests',
+                               'can_read_self_requests', ])
+        userrequest = UserRequestFactory(owner=self.user)
+        invalid = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': ['a']}},
+        ]}
+
+        response = self.client.post(
+            reverse('trrequests:request-bulk'),
+            [
+                {'properties': {'name': 'first'}, 'geojson': self.geojson},
+                {'properties': {'name': 'second'}, 'geojson': self.geojson},
+                {'properties': {'name': 'third'}, 'geojson': self.geojson},
+                {'properties': {'name': 'invalid'}, 'geojson': invalid},
+                {'id': userrequest.pk, 'properties': {'name': 'invalid'},
+                 'geojson': invalid},
+            ],
+            format='json')
+
+        # Items of the chunks written before are still reported
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        results = response.json()
+        self.assertListEqual([201, 201, 201, 400, 400],
+                             [result['status'] for result in results])
+        self.assertIn('geojson', results[3]['errors'])
+        self.assertEqual(
+            ['first', 'second', 'third'],
+            sorted(UserRequest.objects.exclude(pk=userrequest.pk)
+                   .values_list('properties__name', flat=True)))
+        userrequest.refresh_from_db()
+        self.assertNotEqual('invalid', userrequest.properties.get('name'))
+        self._clean_permissions()
+
+    def test_bulk_ndjson(self):
+        self._set_permissions(['can_create_requests', ])
+        items = [{'properties': {'line': i}, 'geojson': self.geojson}
+                 for i in range(3)]
+
+        response = self.client.post(
+            reverse('trrequests:request-bulk'),
+            '\n'.join(json.dumps(item) for item in items),
+            content_type='application/x-ndjson')
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertListEqual([201, 201, 201],
+                             [result['status'] for result in response.json()])
+        self.assertEqual(3, self.user.userrequests.count())
+        self._clean_permissions()
+
     def test_userrequest_patched(self):
         self._set_permissions(['can_read_self_requests', ])
 
@@ -303,6 +498,35 @@ class RequestTestCase(TestCase, TestPermissionsMixin):
                                     .filter(documents__key="activity-0")
                                     .exists())
 
+    def test_update_or_create_documents(self):
+        userrequest = UserRequestFactory(owner=self.user)
+        serializer = UserRequestSerializer()
+
+        serializer._update_or_create_documents(userrequest, [
+            {'key': 'first', 'document': UploadedFile(ContentFile(b'1'))},
+            {'key': 'second', 'document': UploadedFile(ContentFile(b'2'))},
+        ])
+        # Threads saving documents do not query the content type
+        save_document = RelatedDocument.save_document
+
+        def cached_save_document(related, *args):
+            self.assertTrue(RelatedDocument.content_type.is_cached(related))
+            return save_document(related, *args)
+
+        with patch.object(RelatedDocument, 'save_document',
+                          cached_save_document):
+            serializer._update_or_create_documents(userrequest, [
+                {'key': 'second',
+                 'document': UploadedFile(ContentFile(b'3'))},
+            ])
+
+        documents = userrequest.documents.all()
+        self.assertListEqual(['first', 'second'],
+                             [document.key for document in documents])
+        for document, content in zip(documents, [b'1', b'3']):
+            with document.document.open() as f:
+                self.assertEqual(content, f.read())
+
     def test_returned_document_are_base64(self):
         layer = LayerFactory()
         userrequest = UserRequest.objects.create(
@@ -337,6 +561,23 @@ class RequestTestCase(TestCase, TestPermissionsMixin):
             )
             self._clean_permissions()
 
+    @override_settings(DATASTORE_INLINE_DOCUMENT_MAX_SIZE=0)
+    def test_large_documents_are_urls(self):
+        self._set_permissions(['can_read_self_requests', ])
+        userrequest = UserRequestFactory(owner=self.user)
+        UserRequestSerializer()._update_or_create_documents(userrequest, [
+            {'key': 'large', 'document': UploadedFile(ContentFile(b'1'))},
+        ])
+
+        response = self.client.get(
+            resolve_url('trrequests:request-detail', pk=userrequest.pk))
+        document = response.json()['documents'][0]['document']
+        self.assertEqual(1, document['size'])
+        self.assertTrue(document['url'].startswith(
+            reverse('trrequests:request-document',
+                    args=[userrequest.pk, 'large'])))
+        self._clean_permissions()
+
     def test_retrieve_related_document(self):
         layer = LayerFactory()
         userrequest = UserRequest.objects.create(
@@ -367,3 +608,138 @@ class RequestTestCase(TestCase, TestPermissionsMixin):
             json_reponse['documents'][0]['document']
         )
         self._clean_permissions()
+
+    def test_documents_url_representation(self):
+        userrequest = UserRequestFactory(owner=self.user)
+        UserRequestSerializer()._update_or_create_documents(userrequest, [
+            {'key': 'doctest', 'document': UploadedFile(ContentFile(b'hello'))},
+        ])
+
+        self._set_permissions(['can_read_self_requests', ])
+        response = self.client.get(
+            resolve_url('trrequests:request-detail', pk=userrequest.pk),
+            {'documents': 'url'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        document = response.json()['documents'][0]
+        self.assertNotIn('document', document)
+        self.assertEqual(5, document['size'])
+        self.assertEqual(hashlib.sha256(b'hello').hexdigest(),
+                         document['digest'])
+
+        # The signed url does not need the user to be authenticated
+        response = APIClient().get(document['url'])
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(b'hello', b''.join(response.streaming_content))
+        self.assertEqual(f'"{document["digest"]}"', response['ETag'])
+
+        response = APIClient().get(document['url'],
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        response = APIClient().get(
+            resolve_url('trrequests:request-document',
+                        pk=userrequest.pk, key='doctest'))
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+
+        response = self.client.get(
+            resolve_url('trrequests:request-document',
+                        pk=userrequest.pk, key='missing'))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self._clean_permissions()
+
+    def test_if_match(self):
+        userrequest = UserRequestFactory(owner=self.user)
+        self._set_permissions(['can_read_self_requests', ])
+        url = resolve_url('trrequests:request-detail', pk=userrequest.pk)
+
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        etag = response['ETag']
+
+        response = self.client.patch(url, {'properties': {'a': 1}},
+                                     format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+        # The request changed since etag was read
+        response = self.client.patch(url, {'properties': {'a': 2}},
+                                     format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(status.HTTP_412_PRECONDITION_FAILED,
+                         response.status_code)
+        userrequest.refresh_from_db()
+        self.assertDictEqual({'a': 1}, userrequest.properties)
+
+        # Stale instances can not overwrite concurrent updates
+        stale = UserRequest.objects.get(pk=userrequest.pk)
+        serializer = UserRequestSerializer(
+            context={'request': MagicMock(user=self.user)})
+        serializer.update(userrequest, {'properties': {'a': 3}})
+        with self.assertRaises(PreconditionFailed):
+            serializer.update(stale, {'properties': {'a': 4}})
+        userrequest.refresh_from_db()
+        self.assertDictEqual({'a': 3}, userrequest.properties)
+        self._clean_permissions()
+
+    def test_export(self):
+        layer = LayerFactory()
+        update_layer_from_geojson(layer, self.geojson)
+        userrequest = UserRequestFactory(owner=self.user, layer=layer,
+                                         properties={'name': 'a', 'size': 2})
+        UserRequestFactory(owner=self.user, properties={'tags': ['b']})
+        self._set_permissions(['can_read_self_requests', ])
+
+        response = self.client.get(
+            resolve_url('trrequests:request-export', export_format='csv'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        rows = list(csv.reader(
+            b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(['id', 'owner', 'state', 'expiry', 'created_at',
+                          'updated_at', 'name', 'size', 'tags', 'geometry'],
+                         rows[0])
+        self.assertEqual(3, len(rows))
+        self.assertEqual([str(userrequest.pk), self.user.email],
+                         rows[1][:2])
+        self.assertEqual(['a', '2', ''], rows[1][6:9])
+        self.assertTrue(rows[1][9].startswith('GEOMETRYCOLLECTION'))
+        self.assertEqual('["b"]', rows[2][8])
+
+        # Filters of the list apply to exports
+        response = self.client.get(
+            resolve_url('trrequests:request-export', export_format='geojson'),
+            {'properties__name': 'a'})
+        collection = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(1, len(collection['features']))
+        self.assertEqual(
+            3, len(collection['features'][0]['geometry']['geometries']))
+
+        response = self.client.get(
+            resolve_url('trrequests:request-export', export_format='gpkg'))
+        with tempfile.NamedTemporaryFile(suffix='.gpkg') as gpkg:
+            gpkg.write(b''.join(response.streaming_content))
+            gpkg.flush()
+            with sqlite3.connect(gpkg.name) as db:
+                self.assertEqual(2, db.execute(
+                    'SELECT count(*) FROM userrequests').fetchone()[0])
+                self.assertEqual(('a', 2), db.execute(
+                    'SELECT name, size FROM userrequests WHERE id = ?',
+                    (userrequest.pk, )).fetchone())
+        self._clean_permissions()
+
+    def test_export_colliding_properties(self):
+        userrequest = UserRequestFactory(
+            owner=self.user, properties={'ID': 1, 'fid': 2, 'Name': 'a',
+                                         'name': 'b'})
+        self._set_permissions(['can_read_self_requests', ])
+
+        response = self.client.get(
+            resolve_url('trrequests:request-export', export_format='gpkg'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        with tempfile.NamedTemporaryFile(suffix='.gpkg') as gpkg:
+            gpkg.write(b''.join(response.streaming_content))
+            gpkg.flush()
+            with sqlite3.connect(gpkg.name) as db:
+                self.assertEqual((userrequest.pk, 1, 2, 'a', 'b'), db.execute(
+                    'SELECT id, "properties.ID", "properties.fid", Name, '
+                    '"properties.name" FROM userrequests').fetchone())
+        self._clean_permissions()
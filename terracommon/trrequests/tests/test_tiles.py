@@ -0,0 +1,63 @@
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from geostore.tests.factories import FeatureFactory
+from rest_framework import status
+from rest_framework.test import APIClient
+from terra_accounts.tests.factories import TerraUserFactory
+
+from .factories import UserRequestFactory
+from .mixins import TestPermissionsMixin
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+})
+class UserRequestTilesTestCase(TestCase, TestPermissionsMixin):
+    # Tile containing Paris at zoom 10
+    tile = (10, 518, 352)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = TerraUserFactory()
+        self.client.force_authenticate(user=self.user)
+
+        self.userrequest = UserRequestFactory(owner=self.user)
+
+    def _add_feature(self):
+        FeatureFactory(layer=self.userrequest.layer,
+                       geom=GEOSGeometry('POINT(2.35 48.85)', srid=4326))
+
+    def _get_tile(self):
+        response = self.client.get(
+            reverse('trrequests:request-tiles', args=self.tile))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('application/vnd.mapbox-vector-tile',
+                         response['Content-Type'])
+        return response.content
+
+    def test_tile_visibility(self):
+        self._add_feature()
+        self.assertFalse(self._get_tile())
+
+        self._set_permissions(['can_read_self_requests', ])
+        self.assertTrue(self._get_tile())
+
+    def test_tile_invalidation(self):
+        self._set_permissions(['can_read_self_requests', ])
+        self.assertFalse(self._get_tile())
+
+        self._add_feature()
+        self.assertTrue(self._get_tile())
+
+    def test_tile_without_permissions(self):
+        self._add_feature()
+        client = APIClient()
+        client.force_authenticate(user=TerraUserFactory())
+
+        response = client.get(
+            reverse('trrequests:request-tiles', args=self.tile))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(b'', response.content)
@@ -0,0 +1,174 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from terra_accounts.tests.factories import TerraUserFactory
+
+from terracommon.trrequests.models import Comment, Upload, UserRequest
+
+from .factories import UserRequestFactory
+from .mixins import TestPermissionsMixin
+
+
+class UploadTestCase(TestCase, TestPermissionsMixin):
+    content = b'%PDF-1.4 a large scanned document'
+    geojson = {'type': 'FeatureCollection', 'features': []}
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = TerraUserFactory()
+        self.client.force_authenticate(user=self.user)
+
+    def _create_upload(self):
+        response = self.client.post(reverse('trrequests:upload-list'), {
+            'filename': 'scan.pdf',
+            'size': len(self.content),
+        })
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual('0', response['Upload-Offset'])
+        return response['Location']
+
+    def _send_chunk(self, url, offset, chunk):
+        return self.client.patch(
+            url, chunk,
+            content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset))
+
+    def _upload(self):
+        url = self._create_upload()
+        for offset in range(0, len(self.content), 10):
+            response = self._send_chunk(url, offset,
+                                        self.content[offset:offset + 10])
+            self.assertEqual(status.HTTP_204_NO_CONTENT, response.status_code)
+        return self.client.get(url).json()['token']
+
+    def test_resumable_upload(self):
+        url = self._create_upload()
+
+        response = self._send_chunk(url, 0, self.content[:10])
+        self.assertEqual(status.HTTP_204_NO_CONTENT, response.status_code)
+        self.assertEqual('10', response['Upload-Offset'])
+
+        # A chunk which does not follow the offset is rejected
+        response = self._send_chunk(url, 20, self.content[20:])
+        self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
+
+        # The upload is resumed from its offset
+        response = self.client.head(url)
+        self.assertEqual('10', response['Upload-Offset'])
+        self.assertEqual(str(len(self.content)), response['Upload-Length'])
+
+        response = self._send_chunk(url, 10, self.content[10:])
+        self.assertEqual(status.HTTP_204_NO_CONTENT, response.status_code)
+
+        upload = Upload.objects.get()
+        self.assertTrue(upload.is_complete)
+        with upload.get_file() as f:
+            self.assertEqual(self.content, f.read())
+            self.assertEqual('application/pdf', f.content_type)
+
+    def test_invalid_chunks(self):
+        url = self._create_upload()
+
+        response = self.client.patch(url, {'chunk': 'data'}, format='json',
+                                     HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                         response.status_code)
+
+        response = self._send_chunk(url, 0, self.content + b'too long')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+        # Uploads of other users are not reachable
+        client = APIClient()
+        client.force_authenticate(user=TerraUserFactory())
+        response = client.head(url)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_comment_attachment(self):
+        token = self._upload()
+        userrequest = UserRequestFactory(owner=self.user)
+
+        self._set_permissions(['can_comment_requests', ])
+        response = self.client.post(
+            reverse('trrequests:comment-list', args=[userrequest.pk]),
+            {'properties': {}, 'upload': token},
+            format='json')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+        comment = Comment.objects.get(pk=response.json()['id'])
+        self.assertEqual('scan.pdf', comment.filename)
+        with comment.attachment.open() as f:
+            self.assertEqual(self.content, f.read())
+
+    def test_request_document(self):
+        token = self._upload()
+
+        self._set_permissions(['can_create_requests', ])
+        response = self.client.post(reverse('trrequests:request-list'), {
+            'properties': {},
+            'geojson': self.geojson,
+            'documents': [{'key': 'scan', 'upload': token}],
+        }, format='json')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+        document = UserRequest.objects.get(
+            pk=response.json()['id']).documents.get()
+        self.assertEqual(len(self.content), document.size)
+        with document.document.open() as f:
+            self.assertEqual(self.content, f.read())
+
+    def test_incomplete_upload(self):
+        url = self._create_upload()
+        self._send_chunk(url, 0, self.content[:10])
+
+        self._set_permissions(['can_create_requests', ])
+        response = self.client.post(reverse('trrequests:request-list'), {
+            'properties': {},
+            'geojson': self.geojson,
+            'documents': [{'key': 'scan',
+                           'upload': self.client.get(url).json()['token']}],
+        }, format='json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_negative_size(self):
+        response = self.client.post(reverse('trrequests:upload-list'), {
+            'filename': 'scan.pdf',
+            'size': -1,
+        })
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_purge_uploads(self):
+        url = self._create_upload()
+        self._send_chunk(url, 0, self.content[:10])
+        stale = Upload.objects.get()
+        recent_url = self._create_upload()
+
+        Upload.objects.filter(pk=stale.pk).update(
+            updated_at=timezone.now() - timedelta(hours=25))
+        call_command('purge_uploads', stdout=StringIO())
+
+        self.assertFalse(Upload.objects.filter(pk=stale.pk).exists())
+        self.assertFalse(default_storage.exists(stale.parts[0]))
+        self.assertEqual(status.HTTP_200_OK,
+                         self.client.get(recent_url).status_code)
+
+    def test_failed_chunk(self):
+        url = self._create_upload()
+        upload = Upload.objects.get()
+
+        with mock.patch.object(Upload, 'save', side_effect=IOError), \
+                self.assertRaises(IOError):
+            self._send_chunk(url, 0, self.content[:10])
+
+        # The staged part of the failed chunk is removed
+        upload.refresh_from_db()
+        self.assertEqual(0, upload.offset)
+        self.assertFalse(default_storage.exists(
+            f'uploads/{upload.token}/{0:020d}'))
@@ -0,0 +1,116 @@
+import mercantile
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from geostore.models import Feature
+
+from .indexes import parse_properties_paths, properties_sql
+
+TILES_VERSION_KEY = 'trrequests_tiles_version'
+
+EPSG_3857 = 3857
+
+
+def get_tiles_version():
+    return cache.get_or_set(TILES_VERSION_KEY, 1, None)
+
+
+def invalidate_tiles():
+    """ Make all cached tiles of user requests obsolete """
+    try:
+        cache.incr(TILES_VERSION_KEY)
+    except ValueError:
+        # Version is not in cache anymore, so neither are the tiles
+        pass
+
+
+class UserRequestVectorTile:
+    """
+    Build Mapbox vector tiles of the features of a UserRequest queryset.
+
+    Each feature carries the id and the state of its request, plus the
+    properties listed in REQUEST_TILES_PROPERTIES.
+    """
+    layer_name = 'userrequests'
+    extent = 4096
+    buffer = 256
+
+    def __init__(self, queryset, cache_key):
+        self.queryset, self.cache_key = queryset, cache_key
+
+    def get_tile(self, z, x, y):
+        return cache.get_or_set(
+            f'trrequests_tile_{self.cache_key}_{z}_{x}_{y}',
+            lambda: self._build_tile(z, x, y),
+            version=get_tiles_version())
+
+    def _get_properties_columns(self):
+        paths = parse_properties_paths(settings.REQUEST_TILES_PROPERTIES)
+        return [
+            (properties_sql(path),
+             connection.ops.quote_name('__'.join(path)))
+            for path in paths
+        ]
+
+    def _build_tile(self, z, x, y):
+        xmin, ymin, xmax, ymax = mercantile.xy_bounds(x, y, z)
+        # Features are selected in the buffer around the tile
+        margin = (xmax - xmin) * self.buffer / self.extent
+
+        try:
+            requests_sql, params = (
+                self.queryset.order_by()
+                             .values('id', 'layer_id', 'state', 'properties')
+                             .query.sql_with_params()
+            )
+        except EmptyResultSet:
+            # No request is visible, like with queryset.none()
+            return b''
+
+        columns = self._get_properties_columns()
+        properties_select = ''.join(
+            f', {expression} AS {name}' for expression, name in columns)
+        properties_columns = ''.join(
+            f', attributes.{name}' for expression, name in columns)
+
+        sql_query = f'''
+            WITH
+            userrequests AS ({requests_sql}),
+            attributes AS (
+                SELECT id, layer_id, state{properties_select}
+                FROM userrequests),
+            tilegeom AS (
+                SELECT
+                    attributes.id,
+                    attributes.state{properties_columns},
+                    ST_AsMvtGeom(
+                        ST_Transform(feature.geom, {EPSG_3857}),
+                        ST_MakeEnvelope(%s, %s, %s, %s, {EPSG_3857}),
+                        {self.extent},
+                        {self.buffer},
+                        true) AS geometry
+                FROM
+                    attributes
+                    JOIN {Feature._meta.db_table} AS feature
+                    ON feature.layer_id = attributes.layer_id
+                WHERE
+                    feature.geom && ST_Transform(
+                        ST_MakeEnvelope(%s, %s, %s, %s, {EPSG_3857}),
+                        {settings.INTERNAL_GEOMETRY_SRID}))
+            SELECT
+                ST_AsMVT(tilegeom, %s, {self.extent}, 'geometry')
+            FROM
+                tilegeom
+        '''
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql_query, (
+                *params,
+                xmin, ymin, xmax, ymax,
+                xmin - margin, ymin - margin, xmax + margin, ymax + margin,
+                self.layer_name,
+            ))
+            tile = cursor.fetchone()[0]
+
+        return bytes(tile) if tile else b''
@@ -1,6 +1,7 @@
+from django.urls import path
 from rest_framework import routers
 
-from .views import CommentViewSet, RequestViewSet
+from .views import CommentViewSet, RequestViewSet, UploadViewSet
 
 app_name = 'trrequests'
 
@@ -9,5 +10,10 @@ router = routers.SimpleRouter()
 router.register(r'userrequest', RequestViewSet, base_name='request')
 router.register(r'userrequest/(?P<request_pk>\d+)/comment',
                 CommentViewSet, base_name='comment')
+router.register(r'upload', UploadViewSet, base_name='upload')
 
-urlpatterns = router.urls
+urlpatterns = [
+    path('userrequest/tiles/<int:z>/<int:x>/<int:y>.pbf',
+         RequestViewSet.as_view({'get': 'tiles'}),
+         name='request-tiles'),
+] + router.urls
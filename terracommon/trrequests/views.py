@@ -1,34 +1,69 @@
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+
 from django.conf import settings
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.db.models import Q
-from django.http.response import Http404, HttpResponseServerError
+from django.http.response import (FileResponse, Http404, HttpResponse,
+                                  HttpResponseServerError,
+                                  StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from rest_framework import mixins, permissions, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import (PermissionDenied, UnsupportedMediaType,
+                                       ValidationError)
 from rest_framework.filters import SearchFilter
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from terra_accounts.permissions import TokenBasedPermission
-from terra_utils.filters import JSONFieldOrderingFilter
 from terra_utils.settings import STATES
 from url_filter.integrations.drf import DjangoFilterBackend
 
+from terracommon.datastore.exceptions import PreconditionFailed
+from terracommon.datastore.helpers import check_if_match, get_json_response
 from terracommon.document_generator.helpers import get_media_response
 from terracommon.events.signals import event
+from terracommon.permissions import get_permissions_snapshot
+
+from .exports import UserRequestExport
+from .filters import (IndexedJSONFieldOrderingFilter, PropertiesFilterBackend,
+                      SpatialFilterBackend)
+from .models import CommentCounter, Upload, UserRequest
+from .parsers import NDJSONParser
+from .serializers import (CommentSerializer, UploadSerializer,
+                          UserRequestSerializer, UserRequestURLSerializer)
+from .tiles import UserRequestVectorTile
+
+# Errors of invalid GeoJSON geometries, raised when they are saved
+GEOMETRY_ERRORS = (GDALException, GEOSException, ValueError)
 
-from .models import UserRequest
-from .serializers import CommentSerializer, UserRequestSerializer
+
+def get_version_etag(version):
+    return f'"{version}"'
 
 
 class RequestViewSet(viewsets.ModelViewSet):
     serializer_class = UserRequestSerializer
     permission_classes = [permissions.IsAuthenticated, ]
-    filter_backends = (SearchFilter, JSONFieldOrderingFilter,
-                       DjangoFilterBackend,)
+    filter_backends = (SearchFilter, IndexedJSONFieldOrderingFilter,
+                       DjangoFilterBackend, PropertiesFilterBackend,
+                       SpatialFilterBackend, )
     search_fields = ('id', 'properties', 'expiry')
     filter_fields = ('state', 'reviewers', 'expiry')
+    # Documents are either inline as base64, or download urls. It can be
+    # overridden with the documents query parameter.
+    documents_representation = 'base64'
 
     def get_queryset(self):
-        if self.request.user.has_perm('trrequests.can_read_all_requests'):
+        user_permissions = get_permissions_snapshot(self.request)
+        if user_permissions.has_perm('trrequests.can_read_all_requests'):
 
             # Return  all non-draft request
             # except for the one the user is the owner.
@@ -36,15 +71,31 @@ class RequestViewSet(viewsets.ModelViewSet):
                 ~Q(owner=self.request.user)
                 & Q(state=STATES.DRAFT)
             )
-        elif self.request.user.has_perm('trrequests.can_read_self_requests'):
+        elif user_permissions.has_perm('trrequests.can_read_self_requests'):
             return UserRequest.objects.filter(
                 Q(owner=self.request.user)
                 | Q(reviewers__in=[self.request.user, ])
             ).distinct()
         return UserRequest.objects.none()
 
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action in ('list', 'retrieve', 'read'):
+            queryset = CommentCounter.objects.annotate_userrequests(
+                get_permissions_snapshot(self.request), queryset)
+        return queryset
+
+    def get_serializer_class(self):
+        if (self.request is not None
+                and self.request.method in permissions.SAFE_METHODS
+                and self.request.query_params.get(
+                    'documents', self.documents_representation) == 'url'):
+            return UserRequestURLSerializer
+        return super().get_serializer_class()
+
     def create(self, request, *args, **kwargs):
-        if not self.request.user.has_perm('trrequests.can_create_requests'):
+        if not get_permissions_snapshot(request).has_perm(
+                'trrequests.can_create_requests'):
             raise PermissionDenied
 
         return super().create(request, *args, **kwargs)
@@ -57,27 +108,251 @@ class RequestViewSet(viewsets.ModelViewSet):
             user=self.request.user,
             instance=instance)
 
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return Response(self.get_serializer(instance).data,
+                        headers={'ETag': get_version_etag(instance.version)})
+
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        response['ETag'] = get_version_etag(response.data['version'])
+        return response
+
+    def perform_update(self, serializer):
+        # The serializer then checks the version did not change since
+        check_if_match(self.request,
+                       get_version_etag(serializer.instance.version))
+        serializer.save()
+
     def patch(self, request, *args, **kwargs):
         return super().partial_update(request, *args, **kwargs)
 
     @action(detail=False, methods=['get'])
     def schema(self, request):
         if isinstance(settings.REQUEST_SCHEMA, dict):
-            return Response(settings.REQUEST_SCHEMA)
+            return get_json_response(
+                request, JSONRenderer().render(settings.REQUEST_SCHEMA),
+                cache_control=settings.REQUEST_SCHEMA_CACHE_CONTROL)
         else:
             return HttpResponseServerError()
 
+    @action(detail=False, methods=['get'], url_path='unread-summary',
+            url_name='unread-summary')
+    def unread_summary(self, request):
+        """ Number of requests with unread comments, and of unread comments
+            of the current user """
+        return Response(CommentCounter.objects.get_unread_summary(
+            get_permissions_snapshot(request), self.get_queryset()))
+
+    @action(detail=False, methods=['get'],
+            url_path='export/(?P<export_format>csv|ndjson|geojson|gpkg)',
+            url_name='export')
+    def export(self, request, export_format):
+        """ Filtered requests, as CSV, NDJSON, GeoJSON or GeoPackage, with a
+            column for each property """
+        export = UserRequestExport(self.filter_queryset(self.get_queryset()))
+        filename = f'userrequests.{export_format}'
+
+        if export_format == 'gpkg':
+            return FileResponse(export.gpkg(), as_attachment=True,
+                                filename=filename,
+                                content_type=export.content_types['gpkg'])
+
+        response = StreamingHttpResponse(
+            getattr(export, export_format)(),
+            content_type=export.content_types[export_format])
+        response['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
+    @action(detail=False, methods=['post'],
+            parser_classes=(JSONParser, NDJSONParser))
+    def bulk(self, request):
+        """ Create or update many requests, from a JSON array or NDJSON
+
+        Items with an id update the matching request, others are created.
+        Valid items are written in chunks of REQUEST_BULK_CHUNK_SIZE requests,
+        each in its own transaction. The response has the result of each item,
+        items with invalid geometries being rejected alone.
+        """
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of requests')
+
+        results, creations, updates = self._bulk_validate(request.data)
+        results += self._bulk_create(creations)
+        results += self._bulk_update(updates)
+
+        return Response(sorted(results, key=lambda result: result['index']))
+
+    def _bulk_validate(self, items):
+        """ Return the results of invalid items, and the serializers of the
+            valid creations and updates """
+        instances = self.get_queryset().in_bulk([
+            item['id'] for item in items
+            if isinstance(item, dict) and isinstance(item.get('id'), int)
+        ])
+        can_create = get_permissions_snapshot(self.request).has_perm(
+            'trrequests.can_create_requests')
+
+        results, creations, updates = [], [], []
+        for index, item in enumerate(items):
+            serializer, error = self._get_bulk_serializer(item, instances,
+                                                          can_create)
+            if error is not None:
+                results.append({'index': index, **error})
+            elif serializer.instance is None:
+                creations.append((index, serializer))
+            else:
+                updates.append((index, serializer))
+
+        return results, creations, updates
+
+    def _get_bulk_serializer(self, item, instances, can_create):
+        """ Return the valid serializer of an item, or the error result """
+        if not isinstance(item, dict):
+            return None, {'status': status.HTTP_400_BAD_REQUEST,
+                          'errors': ['Expected a request object']}
+
+        instance = None
+        if 'id' in item:
+            instance = instances.get(item['id'])
+            if instance is None:
+                return None, {'status': status.HTTP_404_NOT_FOUND}
+        elif not can_create:
+            return None, {'status': status.HTTP_403_FORBIDDEN}
+
+        serializer = self.get_serializer(instance, data=item,
+                                         partial=instance is not None)
+        if not serializer.is_valid():
+            return None, {'status': status.HTTP_400_BAD_REQUEST,
+                          'errors': serializer.errors}
+        return serializer, None
+
+    def _chunks(self, items):
+        size = settings.REQUEST_BULK_CHUNK_SIZE
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def _get_geometry_error(self, index, exception):
+        return {'index': index,
+                'status': status.HTTP_400_BAD_REQUEST,
+                'errors': {'geojson': [str(exception)]}}
+
+    def _bulk_create(self, creations):
+        results = []
+
+        for chunk in self._chunks(creations):
+            try:
+                created = self._create_chunk(chunk)
+            except GEOMETRY_ERRORS:
+                # The chunk was rolled back, so its items are created one by
+                # one to find the invalid geometries
+                created = []
+                for index, serializer in chunk:
+                    try:
+                        created += self._create_chunk([(index, serializer)])
+                    except GEOMETRY_ERRORS as e:
+                        results.append(self._get_geometry_error(index, e))
+
+            for index, instance in created:
+                results.append({'index': index,
+                                'status': status.HTTP_201_CREATED,
+                                'id': instance.pk})
+                event.send(
+                    self.__class__,
+                    action="USERREQUEST_CREATED",
+                    user=self.request.user,
+                    instance=instance)
+
+        return results
+
+    def _create_chunk(self, chunk):
+        """ Create the requests of a chunk, in a transaction. Return their
+            index and instance. """
+        instances = self.get_serializer(many=True).create([
+            {**serializer.validated_data, 'owner': self.request.user}
+            for index, serializer in chunk
+        ])
+        return [(index, instance)
+                for (index, serializer), instance in zip(chunk, instances)]
+
+    def _bulk_update(self, updates):
+        results = []
+
+        for chunk in self._chunks(updates):
+            with transaction.atomic():
+                results += [self._bulk_save(index, serializer)
+                            for index, serializer in chunk]
+
+        return results
+
+    def _bulk_save(self, index, serializer):
+        """ Save an update in a savepoint, and return its result """
+        try:
+            with transaction.atomic():
+                instance = serializer.save()
+        except PreconditionFailed:
+            return {'index': index,
+                    'status': status.HTTP_412_PRECONDITION_FAILED}
+        except GEOMETRY_ERRORS as e:
+            return self._get_geometry_error(index, e)
+
+        return {'index': index,
+                'status': status.HTTP_200_OK,
+                'id': instance.pk}
+
+    def get_tiles_cache_key(self):
+        """ Tiles are shared by users seeing the same requests """
+        user = self.request.user
+        user_permissions = get_permissions_snapshot(self.request)
+        if user_permissions.has_perm('trrequests.can_read_all_requests'):
+            # Drafts are only visible by their owner
+            if user.userrequests.filter(state=STATES.DRAFT).exists():
+                return f'all_{user.pk}'
+            return 'all'
+        elif user_permissions.has_perm('trrequests.can_read_self_requests'):
+            return f'self_{user.pk}'
+        return 'none'
+
+    def tiles(self, request, z, x, y):
+        tile = UserRequestVectorTile(self.get_queryset(),
+                                     self.get_tiles_cache_key())
+        return HttpResponse(tile.get_tile(z, x, y),
+                            content_type='application/vnd.mapbox-vector-tile')
+
     @action(detail=True, methods=['get'])
     def read(self, request, pk):
         self.get_object().user_read(request.user)
-        userrequest = UserRequestSerializer(
-            self.get_object(),
-            context={'request': self.request})
+        userrequest = self.get_serializer(self.get_object())
 
         return Response(
             userrequest.data,
             status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['get'],
+            url_path='documents/(?P<key>[^/]+)', url_name='document',
+            permission_classes=(TokenBasedPermission
+                                | permissions.IsAuthenticated, ))
+    def document(self, request, pk, key):
+        related = get_object_or_404(self.get_object().documents, key=key)
+
+        etag = f'"{related.digest}"' if related.digest else None
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            if settings.MEDIA_ACCEL_REDIRECT:
+                response = HttpResponse(content_type='application/octet-stream')
+                response['X-Accel-Redirect'] = related.document.url
+            else:
+                response = FileResponse(
+                    related.document.open('rb'),
+                    as_attachment=True,
+                    filename=Path(related.document.name).name)
+
+        if etag:
+            response['ETag'] = etag
+        patch_cache_control(response, private=True,
+                            max_age=settings.REQUEST_DOCUMENTS_MAX_AGE)
+        return response
+
 
 class CommentViewSet(mixins.CreateModelMixin,
                      mixins.RetrieveModelMixin,
@@ -91,19 +366,20 @@ class CommentViewSet(mixins.CreateModelMixin,
 
         return get_object_or_404(
             UserRequest,
-            pk=request_pk).get_comments_for_user(self.request.user)
+            pk=request_pk).get_comments_for_user(
+                self.request.user, get_permissions_snapshot(self.request))
 
     def perform_create(self, serializer):
 
         if 'is_internal' in serializer.validated_data:
             if (serializer.validated_data['is_internal'] is True
-                    and not self.request.user.has_perm(
+                    and not get_permissions_snapshot(self.request).has_perm(
                         'trrequests.can_internal_comment_requests')):
                 raise PermissionDenied(
                     'Permission missing to create internal comment')
 
             elif (serializer.validated_data['is_internal'] is False
-                  and not self.request.user.has_perm(
+                  and not get_permissions_snapshot(self.request).has_perm(
                         'trrequests.can_comment_requests')):
                 raise PermissionDenied(
                     'Permission missing to create public comment')
@@ -132,3 +408,117 @@ class CommentViewSet(mixins.CreateModelMixin,
         )
 
         return response
+
+
+class UploadViewSet(mixins.CreateModelMixin,
+                    mixins.RetrieveModelMixin,
+                    mixins.DestroyModelMixin,
+                    viewsets.GenericViewSet):
+    """
+    Resumable uploads, inspired by the tus protocol.
+
+    An upload is created with its filename and size, then its content is
+    sent by chunks with PATCH requests, each one starting at the current
+    Upload-Offset. Once complete, the upload token can be used in place of
+    a comment attachment or a request document.
+    """
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated, ]
+    lookup_field = 'token'
+    chunk_content_type = 'application/offset+octet-stream'
+
+    def get_queryset(self):
+        return Upload.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+    def get_upload_headers(self, upload):
+        return {
+            'Upload-Offset': upload['offset'],
+            'Upload-Length': upload['size'],
+        }
+
+    def get_success_headers(self, data):
+        return {
+            'Location': reverse('trrequests:upload-detail',
+                                args=[data['token']]),
+            **self.get_upload_headers(data),
+        }
+
+    def retrieve(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.get_object())
+        return Response(serializer.data,
+                        headers=self.get_upload_headers(serializer.data))
+
+    def partial_update(self, request, *args, **kwargs):
+        offset = self._get_chunk_offset(request)
+        upload = get_object_or_404(self.get_queryset(), token=kwargs['token'])
+        if offset != upload.offset:
+            return self._get_conflict_response(upload)
+
+        # The chunk is read before the upload is locked, so slow clients do
+        # not hold the lock, nor a transaction
+        with self._read_chunk(request) as chunk:
+            if offset + chunk.size > upload.size:
+                raise ValidationError('Chunk exceeds the upload size')
+
+            if chunk.size:
+                upload, appended = self._append_chunk(kwargs['token'],
+                                                      offset, chunk)
+                if not appended:
+                    return self._get_conflict_response(upload)
+
+        return Response(status=status.HTTP_204_NO_CONTENT,
+                        headers=self.get_upload_headers(
+                            self.get_serializer(upload).data))
+
+    def _get_conflict_response(self, upload):
+        return Response(status=status.HTTP_409_CONFLICT,
+                        headers=self.get_upload_headers(
+                            self.get_serializer(upload).data))
+
+    def _append_chunk(self, token, offset, chunk):
+        """ Stage the chunk in the locked upload, unless another chunk was
+            appended since offset. Return the upload, and whether the chunk
+            was appended. """
+        staged = None
+        try:
+            with transaction.atomic():
+                upload = get_object_or_404(
+                    self.get_queryset().select_for_update(), token=token)
+                if offset != upload.offset:
+                    return upload, False
+
+                chunk.seek(0)
+                upload.add_part(chunk)
+                staged = upload.parts[-1]
+                upload.save()
+        except Exception:
+            # The part staged by a failed transaction is referenced nowhere
+            if staged is not None:
+                default_storage.delete(staged)
+            raise
+        return upload, True
+
+    def _get_chunk_offset(self, request):
+        """ Check a chunk request, and return its Upload-Offset """
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type != self.chunk_content_type:
+            raise UnsupportedMediaType(content_type)
+
+        try:
+            return int(request.META['HTTP_UPLOAD_OFFSET'])
+        except (KeyError, ValueError):
+            raise ValidationError('Upload-Offset header is required')
+
+    def _read_chunk(self, request):
+        """ The chunk is read by pieces, and spooled to disk if large """
+        chunk = File(SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE,
+            dir=settings.FILE_UPLOAD_TEMP_DIR))
+        if request.stream is not None:
+            for piece in iter(lambda: request.stream.read(65536), b''):
+                chunk.write(piece)
+        chunk.size = chunk.tell()
+        return chunk